@@ -18,6 +18,7 @@
 #include <Ethernet.h>                // Base Ethernet lib
 #include <math.h>                    // Math function lib
 #include <EthernetUdp.h>             // UDP library from: bjoern@cs.stanford.edu 12/30/2008
+#include <EEPROM.h>                  // Setpoint table
 #include "DualMC33926MotorShield.h"  // Motor shield library
 
 // MAC address must be specified
@@ -32,14 +33,54 @@ unsigned int localPort = 8888;
 unsigned int eventPort = 8889;
 
 // Buffers for receiving and sending data
-char  packetBuffer[UDP_TX_PACKET_MAX_SIZE]; // Buffer to hold incoming packet,
+// The library UDP_TX_PACKET_MAX_SIZE (24) is too small for a batch of commands
+const int PACKET_BUFFER_SIZE = 128;
+const int BATCH_BUFFER_SIZE = 320;
+const int MAX_BATCH_COMMANDS = 8;           // Commands in one batch datagram
+const char BATCH_SEPARATOR = ';';           // Separates the commands and replies in a batch
+char  packetBuffer[PACKET_BUFFER_SIZE];     // Buffer to hold incoming packet,
 char  replyBuffer[128];                     // The response data
+char  batchBuffer[BATCH_BUFFER_SIZE];       // The combined response data for a batch
+bool  isBatch = false;                      // True if the current packet is a batch
 char  progressBuffer[128];                  // Interim data
 char  statusBuffer[128];                    // Interim data
 char  vswrBuffer[128];                      // Interim data
 char  potBuffer[128];                       // Interim data
 char  txBuffer[128];                        // Interim data
 char  almBuffer[128];                       // Interim data
+char  autoBuffer[64];                       // Interim data
+char  noiseBuffer[64];                      // Interim data
+char  tagBuffer[8];                         // Correlation tag for the response
+int   commandTag = -1;                      // Correlation tag of the current command, -1 if untagged
+IPAddress replyIP;                          // Where to send the response to the current command
+unsigned int replyPort;
+
+// Events may be sent as fixed layout binary frames rather than text, see setFraming().
+// A frame is FRAME_MAGIC, the framing version and the event type followed by the values
+// of the event copied as they are held, little endian with no padding, see sendFrame().
+// The magic byte is not ASCII so a frame is never mistaken for a text reply or event.
+const byte FRAMING_ASCII = 0;               // Text events to the event port
+const byte FRAME_VERSION = 2;               // Latest framing this sketch sends
+const byte FRAME_TELEMETRY = 2;             // First framing with EVENT_TELEMETRY
+const byte FRAME_MAGIC = 0xA5;
+const int FRAME_HEADER = 3;                 // Magic, version, event
+const int FRAME_BUFFER_SIZE = 32;
+const byte EVENT_PROGRESS = 1;              // int16 % complete
+const byte EVENT_VSWR = 2;                  // float forward, float reflected
+const byte EVENT_POT = 3;                   // int16 raw, float % extension
+const byte EVENT_TX = 4;                    // byte 1 on, 0 off
+const byte EVENT_NOISE = 5;                 // float pot, float forward, float reflected
+const byte EVENT_AUTOTUNE = 6;              // uint32 ms TX, uint32 ms mistuned, int16 searches
+const byte EVENT_ALARM = 7;                 // byte alarm
+const byte EVENT_TELEMETRY = 8;             // uint16 sequence, uint32 millis(), byte channel mask, then
+                                            // for each channel in the mask in order its values as
+                                            // EVENT_TX, EVENT_VSWR and EVENT_POT
+const byte ALARM_AUTOTUNE = 1;              // Autotune failure
+byte  eventFraming = FRAMING_ASCII;         // Framing version in use
+IPAddress frameIP;                          // Where to send frames, the client which asked for them
+unsigned int framePort;
+byte  frameBuffer[FRAME_BUFFER_SIZE];
+int   frameLength = 0;
 
 // An EthernetUDP instance to let us send and receive packets over UDP
 EthernetUDP Udp;
@@ -88,6 +129,7 @@ Loop switching
   Digital 23            - Relay 2
   Digital 24            - Relay 3
   Digital 25            - Relay 4
+  Digital 26 - 29       - Relay 5 - 8 (optional)
 
 Notes:
   1. If not using the SWR analog inputs then tie these to 0v otherwise they will float giving random values.
@@ -111,6 +153,7 @@ const int MAX_SPEED_VALUE = 400;        // Defined by the library -400 0 +400
 const int MINIMUM_SPEED_VALUE = 100;    // Motor may stall if we go slower
 const int FAST_TUNE_SPEED_VALUE = 300;  // Move to lower setpoint at this speed
 const int SLOW_TUNE_SPEED_VALUE = MINIMUM_SPEED_VALUE;
+const int COARSE_TUNE_SPEED_VALUE = 200;  // Sweep to bracket the minimum SWR at this speed
 const int MAX_EXTENSION = 100;          // mm full extension
 const int MAX_MM_SEC = 10;              // speed mm/sec at full RPM
 
@@ -121,6 +164,33 @@ int motorDirection = FORWARD;
 int motorSpeed = 400;                 // The actual speed (+ve forward, -ve reverse)
 int speedSetting = 400;               // The speed setting from the host (always +ve)
 
+// Position control
+// A move ramps up to speed and slows in proportion to the distance left so it stops on
+// the target at the minimum speed rather than overrunning and nudging back.
+const int PROFILE_ACCEL = 20;           // Speed increase per EX_LOOP_SLEEP, 0 to full in 100ms
+const float PROFILE_GAIN = 8.0;         // Speed per analog step left, full speed until ~40 steps out
+const int POSITION_TOLERANCE = 2;       // Arrived within +/- n analog steps
+const int MAX_CORRECTIONS = 2;          // Restarts after an overrun before accepting where we are
+unsigned long moveMillis = 0;           // Time taken by the last move
+int moveError = 0;                      // Final position less target in analog steps of the last move
+
+// Move task state
+const int MOVE_IDLE = 0;
+const int MOVE_RUNNING = 1;
+const int MOVE_SETTLING = 2;
+int moveState = MOVE_IDLE;
+float moveTarget;                       // Analog value
+int moveSpeed;                          // Speed limit
+int moveTolerance;                      // Arrived within +/- n analog steps
+bool moveRetarget;                      // The target may be changed by a retarget command
+int moveDir = 0;                        // +1 forward, -1 reverse, 0 stopped
+int moveNow = 0;                        // The speed now
+int moveStarts = 0;                     // Starts including corrections
+int moveTimeout;                        // Control ticks left
+int moveToMove;                         // Analog steps from the start for progress reports
+unsigned long moveStarted;              // millis() at the start
+unsigned long moveSettled;              // millis() at the end of a settle
+
 //////////////////////////////////////////////////////////////////////////
 // Potentiometer
 // This is a high precision potentiometer attached to the drive output shaft.
@@ -139,9 +209,81 @@ bool isRunning = false;
 
 //////////////////////////////////////////////////////////////////////////
 // Auto tuning
+// Autotune tracks resonance while transmitting with small dither moves either side of where we are,
+// stepping towards the lower VSWR, and only searches when it loses lock.
 bool autoTune = false;
 const int MAX_AUTOTUNE_TRIES = 10;
 int autotuneFailCount = 0;
+const int AUTOTUNE_WINDOW = 5;          // Search +/- n % extension from where we are before a full sweep
+const float AUTOTUNE_VSWR = 1.7;        // Mistuned above this
+const int DITHER_STEP = 6;              // Probe +/- n analog steps either side of the centre
+const int DITHER_MAX_MOVE = 12;         // Move the centre at most n analog steps per dither
+const int DITHER_TOLERANCE = 1;         // Dither moves arrive within +/- n analog steps
+const float DITHER_TREND_GAIN = 0.25;   // Fraction of each step added to the trend
+const int DITHER_PERIOD = 500;          // ms between dithers, none while above AUTOTUNE_VSWR
+const float DITHER_LOST_VSWR = 2.5;     // Lost lock above this
+const int DITHER_LOST_COUNT = 5;        // Lost lock after n dithers in a row above AUTOTUNE_VSWR
+const int AUTOTUNE_REPORT = 1000;       // ms between autotune events
+// Dither task state
+const int DITHER_PLUS = 0;              // Probing centre + DITHER_STEP
+const int DITHER_MINUS = 1;             // Probing centre - DITHER_STEP
+const int DITHER_CENTRE = 2;            // Moving to the new centre
+int ditherPhase;
+bool ditherSettling;                    // Settling at a probe
+unsigned long ditherSettled;            // millis() at the end of a settle
+unsigned long ditherDue = 0;            // millis() of the next dither
+float ditherCentre;                     // Analog value
+float ditherRatio0;                     // VSWR at the centre
+float ditherTrend = 0.0;                // Analog steps the resonance moves per dither
+float ditherPlus;                       // Analog value where the probe forward stopped
+float ditherRatioPlus;                  // VSWR there
+int ditherMisses = 0;                   // Dithers in a row above AUTOTUNE_VSWR
+bool ditherLost = false;                // Search on the next opportunity
+// Autotune metrics since autotune on, see sendAutotune()
+unsigned long autotuneTxMs = 0;         // ms transmitting
+unsigned long autotuneAboveMs = 0;      // ms transmitting above AUTOTUNE_VSWR
+int autotuneSearches = 0;               // Searches after losing lock
+unsigned long autotuneTick = 0;         // millis() of the last accounting
+unsigned long autotuneReportDue = 0;    // millis() of the next autotune event
+
+// Result of a tuning sweep
+const int TUNE_MATCHED = 0;
+const int TUNE_NO_MATCH = 1;
+const int TUNE_ABORTED = 2;
+// Refining the minimum SWR found by the sweep
+const int REF_RISE = 20;                // Reflected rise past the minimum which ends the sweep
+const int REFINE_MOVES = 8;             // Most probes of the golden-section search
+const float REFINE_RESOLUTION = 3.0;    // Stop when the bracket is under n analog steps
+const float GOLDEN_RATIO = 0.618034;
+
+// Tune task state
+const int TUNE_FULL = 0;                // Tune over the whole span
+const int TUNE_WINDOW = 1;              // Warm tune within the window
+const int TUNE_FALLBACK = 2;            // Warm tune over the whole span after the window
+const int TUNE_TO_END = 0;              // Moving to the start of the sweep
+const int TUNE_SWEEP = 1;               // Coarse sweep
+const int TUNE_PROBE = 2;               // Moving to a probe of the golden-section search
+const int TUNE_SETTLE = 3;              // Settling at a probe
+const int TUNE_STOPPING = 4;            // Settling after the sweep stops, before the first probe
+int tuneMode = TUNE_FULL;
+int tuneState = TUNE_TO_END;
+int tuneLow;                            // Extension at the low frequency end of the sweep
+int tuneHigh;                           // Extension at the high frequency end of the sweep
+int sweepDir;                           // +1 forward, -1 reverse
+int sweepTimeout;                       // Control ticks left
+float refMin;                           // Lowest reflected reading of the sweep, -1.0 before the first
+int rawMin;                             // Analog value at refMin
+bool descended;                         // The reflected reading has come down
+const int REFINE_FIRST = 0;
+const int REFINE_SECOND = 1;
+const int REFINE_SHRINK = 2;
+const int REFINE_FINAL = 3;
+int refinePhase;
+float goldA, goldB, goldC, goldD;       // Bracket and probes of the golden-section search
+float goldFC, goldFD;                   // Reflected readings at goldC and goldD
+bool goldAtC;                           // The last probe was at goldC
+int goldMoves;                          // Probes so far
+unsigned long probeSettled;             // millis() at the end of a probe or sweep settle
 
 //////////////////////////////////////////////////////////////////////////
 // Setpoints for low/high frequency for current loop
@@ -160,39 +302,120 @@ const bool VIRTUAL_TO_REAL = false;
 int minCapSetpoint = 10;    // Defaults clear of end stops
 int maxCapSetpoint = 1013;  //  ""
 
+//////////////////////////////////////////////////////////////////////////
+// Setpoint table for the current loop
+// The host uploads the setpoints of the selected loop and they are kept in EEPROM, so the
+// host need only send the frequency to track and the extension is worked out here, see
+// doTrack(). Each point is a frequency in Hz and the extension there in hundredths of a %.
+// Between points the extension is interpolated linearly, outside them the nearest is used.
+const int MAX_TABLE_POINTS = 32;
+const int TABLE_ADDRESS = 0;                // EEPROM address of the table
+const unsigned int TABLE_MAGIC = 0x4C54;    // Marks a table written by this sketch
+struct TablePoint {
+  long hz;
+  int extension;                            // Hundredths of a % extension
+};
+TablePoint table[MAX_TABLE_POINTS];         // In use, ascending frequency
+int tableCount = 0;
+unsigned int tableSum = 0;                  // Checksum of the table, see tableChecksum()
+TablePoint upload[MAX_TABLE_POINTS];        // Being uploaded, ascending frequency
+int uploadCount = 0;
+
 //////////////////////////////////////////////////////////////////////////
 // Loop iteration delay
-const int MAIN_LOOP_SLEEP = 10;          // 10ms sleep in main loop
-const int MAIN_LOOP_COUNT = 20;
-int mainLoopCounter = MAIN_LOOP_COUNT;   // Extra tasks every 200ms
-const int EX_LOOP_SLEEP = 5;             // 5ms sleep in command execution loops
-const int MOTOR_DELAY = 100;             // 100ms sleep between motor commands
+const int MAIN_LOOP_SLEEP = 10;          // 10ms sleep in main loop when idle
+const int EX_LOOP_SLEEP = 5;             // 5ms control tick while a task is running
+const int MOTOR_DELAY = 100;             // 100ms settle between motor commands
 
-// Execution loop timeout, dependent on the motor speed as timeouts must allow a full extension or retraction
-double msFullExtensionOrRetraction = (((double)MAX_EXTENSION/(double)MAX_MM_SEC) * ((double)MAX_SPEED_VALUE)/abs((double)speedSetting))*1000.0;
-int COMMAND_TIMEOUT = (int)((msFullExtensionOrRetraction*2.0 )/(double)EX_LOOP_SLEEP);  // speed dependent imeout
+//////////////////////////////////////////////////////////////////////////
+// Telemetry
+// The TX state, VSWR and pot position are each sent at their own period, one period while
+// idle and another while a task runs, so a tune can be followed closely without loading
+// the link when nothing is happening. A period of 0 turns the channel off. The VSWR is only
+// sent while transmitting. With framing version FRAME_TELEMETRY or later the channels due
+// go together in one EVENT_TELEMETRY frame, see sendTelemetry(), otherwise as events.
+const int TELEMETRY_CHANNELS = 3;
+const int TM_TX = 0;
+const int TM_VSWR = 1;
+const int TM_POT = 2;
+const int TELEMETRY_PERIOD = 200;        // Default period of every channel, ms
+const int MIN_TELEMETRY_PERIOD = 20;     // 50 Hz
+unsigned int telemetryIdle[TELEMETRY_CHANNELS] = {TELEMETRY_PERIOD, TELEMETRY_PERIOD, TELEMETRY_PERIOD};
+unsigned int telemetryBusy[TELEMETRY_CHANNELS] = {TELEMETRY_PERIOD, TELEMETRY_PERIOD, TELEMETRY_PERIOD};
+unsigned long telemetryDue[TELEMETRY_CHANNELS];   // millis() each channel is next due
+uint16_t telemetrySeq = 0;               // Sequence number of the next telemetry frame
+
+//////////////////////////////////////////////////////////////////////////
+// Cooperative tasks
+// A move or tune is a task advanced one control tick at a time from loop() so packets
+// are serviced between ticks, a stop takes effect on the next tick and queries and events
+// carry on while the motor runs. One task runs at a time and the command which started it
+// is replied to when it finishes.
+const int TASK_NONE = 0;
+const int TASK_MOVE = 1;
+const int TASK_TUNE = 2;
+const int TASK_DITHER = 3;               // Autotune dither, gives way to any other task or a stop
+int task = TASK_NONE;
+// Result of a step of a task
+const int STEP_BUSY = 0;
+const int STEP_DONE = 1;
+const int STEP_FAILED = 2;
+bool taskReplies = false;                // Reply when done, false for an autotune
+bool deferReply = false;                 // The current packet started a task
+bool noReply = false;                    // The current packet gets no reply
+char taskBuffer[128];                    // The response data of the running task
+IPAddress taskIP;                        // Where to send the response when the task finishes
+unsigned int taskPort;
+int taskTag = -1;
 
 //////////////////////////////////////////////////////////////////////////
 // Potentiometer
 // Analog pin allications
 const int potPin = 8;
-bool potFirstRun = true;  // Fill her up
-int potArray[10];
-int potIndex = 0;
 
 //////////////////////////////////////////////////////////////////////////
 // SWR meter
 // Analog pin allocation
 const int fwdPin = 9;
 const int refPin = 10;
+const float RF_DETECT = 0.5;            // Transmitting when the forward reading is above this
+
+//////////////////////////////////////////////////////////////////////////
+// Analog acquisition
+// Every position and SWR reading comes from here rather than a single analogRead().
+// acquire() is called once per loop() iteration, so at the control tick while a task runs,
+// and takes a burst of OVERSAMPLE conversions of each channel. The burst is decimated to
+// one reading by its median, which throws out RF spikes, or its mean, which gains a little
+// resolution. The reading may then be smoothed by an IIR filter. The spread of the bursts
+// gives the noise floor of each channel which is sent as an event and allowed for when
+// deciding a sweep has passed the minimum or a probe is as good as a match.
+const int CH_POT = 0;
+const int CH_FWD = 1;
+const int CH_REF = 2;
+const int CHANNELS = 3;
+const int channelPins[CHANNELS] = {potPin, fwdPin, refPin};
+const int FILTER_MEDIAN = 0;
+const int FILTER_MEAN = 1;
+const int OVERSAMPLE = 5;               // Conversions per reading, odd for the median
+// Decimation of each channel
+const int channelFilter[CHANNELS] = {FILTER_MEDIAN, FILTER_MEDIAN, FILTER_MEDIAN};
+// IIR weight of a new reading, 1.0 for no smoothing. None on the pot as a position
+// which lags the actuator upsets the moves.
+const float channelSmoothing[CHANNELS] = {1.0, 0.5, 0.5};
+const float NOISE_SMOOTHING = 0.05;     // IIR weight of each burst in the noise floor
+const float NOISE_MARGIN = 2.0;         // Noise floors a reflected rise must clear
+const int NOISE_PERIOD = 5000;          // ms between noise events
+float channelValue[CHANNELS];           // Filtered reading
+float channelNoise[CHANNELS];           // Noise floor, +/- analog steps
+bool channelPrimed = false;             // False until the first acquire() and after a reference change
+unsigned long noiseDue = 0;             // millis() of the next noise event
 
 //////////////////////////////////////////////////////////////////////////
 // Antenna switcher
-// Digital pin allocation
-const int rly1Pin = 22;
-const int rly2Pin = 23;
-const int rly3Pin = 24;
-const int rly4Pin = 25;
+// Digital pin allocation, relay n is relayPins[n-1] and bit n-1 of the relay mask
+const int MAX_RELAYS = 8;
+const int relayPins[MAX_RELAYS] = {22, 23, 24, 25, 26, 27, 28, 29};
+int relayState = 0;         // Mask of energised relays
 
 //////////////////////////////////////////////////////////////////////////
 // Called on startup
@@ -209,16 +432,16 @@ void setup() {
   pinMode(potPin, INPUT);
   pinMode(fwdPin, INPUT);
   pinMode(refPin, INPUT);
+  acquire();
+  
+  // The setpoint table from last time
+  loadTable();
   
   // Configure the relays for loop switching
-  pinMode(rly1Pin, OUTPUT);
-  digitalWrite(rly1Pin, LOW);
-  pinMode(rly2Pin, OUTPUT);
-  digitalWrite(rly2Pin, LOW);
-  pinMode(rly3Pin, OUTPUT);
-  digitalWrite(rly3Pin, LOW);
-  pinMode(rly4Pin, OUTPUT);
-  digitalWrite(rly4Pin, LOW); 
+  for (int i = 0; i < MAX_RELAYS; i++) {
+    pinMode(relayPins[i], OUTPUT);
+    digitalWrite(relayPins[i], LOW);
+  }
 
   // Start Ethernet and UDP:
   Ethernet.begin(mac, ip);
@@ -229,64 +452,144 @@ void setup() {
 // Called repeatedly to execute main code
 void loop() {
   
+  char *command;
+  
+  // Read the pot and bridge for this iteration
+  acquire();
+  
   // Check and accept messages from UDP
+  // This is every iteration, also while a task is running
   int packetSize = queryPacket();
   // If there's data available...
-  // Note this is synchronous from Arduino point of view
   if (packetSize) {
     // Read the packet
     doRead(packetSize);   
-    // Execute the command
-    execute(packetBuffer);
-    // Send response which is sent to the requesting ip and port
-    sendResponse();
-  } else {
-    // Wait MAIN_LOOP_SLEEP ms to avoid spinning too fast
-    delay(MAIN_LOOP_SLEEP);
+    // Remember the requester, a task replies to the command which started it
+    replyIP = Udp.remoteIP();
+    replyPort = Udp.remotePort();
+    // Execute the command or batch of commands, less any correlation tag
+    command = parseTag(packetBuffer, &commandTag);
+    isBatch = (strchr(command, BATCH_SEPARATOR) != NULL);
+    deferReply = false;
+    noReply = false;
+    if (isBatch)
+      executeBatch(command);
+    else
+      execute(command);
+    if (deferReply) {
+      // Started a task, the response is sent when it finishes
+      taskIP = replyIP;
+      taskPort = replyPort;
+      taskTag = commandTag;
+      taskReplies = true;
+    } else if (!noReply) {
+      // Send response which is sent to the requesting ip and port
+      sendResponse();
+    }
   }
   
+  // Advance the running task by one control tick
+  if (task != TASK_NONE)
+    stepTask();
+  
   if (isRunning) {
-    // Check for time to send event data
-    if (mainLoopCounter-- <= 0) {
-      mainLoopCounter = MAIN_LOOP_COUNT;
-      // Send an SWR event if transmitting
-      if (analogRead(fwdPin) > 0) {
-        // Must be transmitting
-        sendTX(true);
-        sendVSWR(analogRead(fwdPin), analogRead(refPin));
-      } else {
-        sendTX(false);
-      }
-      
-      // Send the % extension
-      sendPotEvent();
+    // Send the telemetry channels which are due
+    sendTelemetry();
+    if ((long)(millis() - noiseDue) >= 0) {
+      noiseDue = millis() + NOISE_PERIOD;
+      sendNoise();
     }
    
-    // Check for auto-tune
-    float vswr;
-    float fwd;
-    float ref;
+    // Auto-tune, when nothing else is running
     if (autoTune) {
-      fwd = analogRead(fwdPin);
-      ref = analogRead(refPin);
-      if (fwd > 0) {
+      autotuneAccount();
+      if (task == TASK_NONE && isTX()) {
         // Transmitting
-        if (getVSWR() > 1.7) {
-          // See if we can do better than 1.7:1
-          if (!doTune()) {
-            // If we fail to find a good SWR we would keep trying ad-infinitum
-            if (autotuneFailCount++ >= MAX_AUTOTUNE_TRIES) {
-              sendAlarm("autotune failure");
-              autoTune = false;
-              autotuneFailCount = MAX_AUTOTUNE_TRIES;
-            }
+        if (ditherLost) {
+          // Search, usually only a little off so look close by first
+          ditherLost = false;
+          ditherTrend = 0.0;
+          autotuneSearches++;
+          if (doWarmTune(constrain((int)getExtension(), MIN_EXTENSION_VALUE, MAX_EXTENSION_VALUE), AUTOTUNE_WINDOW)) {
+            // No one to reply to, the result is counted by finishTask()
+            taskReplies = false;
           } else {
-            autotuneFailCount = MAX_AUTOTUNE_TRIES;
+            autotuneResult(false);
           }
+        } else if ((long)(millis() - ditherDue) >= 0) {
+          ditherStart();
         }
       }
     }
-  } 
+  }
+  
+  if (task != TASK_NONE) {
+    // Run the task at the control tick
+    delay(EX_LOOP_SLEEP);
+  } else if (!packetSize) {
+    // Wait MAIN_LOOP_SLEEP ms to avoid spinning too fast
+    delay(MAIN_LOOP_SLEEP);
+  }
+}
+
+////////////////////////////////////////
+void autotuneAccount() {
+  
+  /*
+  * Add the time since the last call to the autotune metrics and send them every AUTOTUNE_REPORT
+  */
+  
+  unsigned long now = millis();
+  float ratio;
+  
+  if (isTX()) {
+    autotuneTxMs += now - autotuneTick;
+    ratio = getVSWR();
+    if (ratio == 0.0 || ratio > AUTOTUNE_VSWR)
+      autotuneAboveMs += now - autotuneTick;
+  }
+  autotuneTick = now;
+  if ((long)(now - autotuneReportDue) >= 0) {
+    autotuneReportDue = now + AUTOTUNE_REPORT;
+    sendAutotune();
+  }
+}
+
+////////////////////////////////////////
+void autotuneOn(bool on) {
+  
+  /*
+  * Autotune on from lock with fresh metrics, or off
+  */
+  
+  if (task == TASK_DITHER)
+    ditherAbort();
+  autoTune = on;
+  ditherLost = false;
+  ditherMisses = 0;
+  ditherTrend = 0.0;
+  ditherDue = millis();
+  autotuneTxMs = 0;
+  autotuneAboveMs = 0;
+  autotuneSearches = 0;
+  autotuneTick = millis();
+  autotuneReportDue = millis() + AUTOTUNE_REPORT;
+}
+
+////////////////////////////////////////
+void autotuneResult(bool success) {
+  
+  /*
+  * Count autotune failures, if we fail to find a good SWR we would keep trying ad-infinitum
+  */
+  
+  if (success) {
+    autotuneFailCount = MAX_AUTOTUNE_TRIES;
+  } else if (autotuneFailCount++ >= MAX_AUTOTUNE_TRIES) {
+    sendAlarm("autotune failure", ALARM_AUTOTUNE);
+    autoTune = false;
+    autotuneFailCount = MAX_AUTOTUNE_TRIES;
+  }
 }
 
 //////////////////////////////////////////////////////////////////////////
@@ -303,8 +606,10 @@ int queryPacket() {
 ////////////////////////////////////////
 int doRead(int packetSize) {
   
-  // Read the packet into packetBufffer
-  Udp.read(packetBuffer, UDP_TX_PACKET_MAX_SIZE);
+  // Read the packet into packetBufffer, anything which does not fit is discarded
+  if (packetSize > PACKET_BUFFER_SIZE - 1)
+    packetSize = PACKET_BUFFER_SIZE - 1;
+  Udp.read(packetBuffer, packetSize);
   // Terminate buffer
   packetBuffer[packetSize] = '\0'; 
 }
@@ -312,19 +617,201 @@ int doRead(int packetSize) {
 ////////////////////////////////////////
 int sendResponse() {
 
-  // Send a reply to the IP address and port that sent us the packet we received
-  Udp.beginPacket(Udp.remoteIP(), Udp.remotePort());
-  Udp.write(replyBuffer);
+  // Send a reply to the IP address and port that sent us the command
+  Udp.beginPacket(replyIP, replyPort);
+  writeTag(commandTag);
+  if (isBatch)
+    Udp.write(batchBuffer);
+  else
+    Udp.write(replyBuffer);
   Udp.endPacket();   
 }
 
+////////////////////////////////////////
+int sendTaskResponse() {
+
+  // Send the reply of a finished task to the IP address and port that sent us the command which started it
+  Udp.beginPacket(taskIP, taskPort);
+  writeTag(taskTag);
+  Udp.write(taskBuffer);
+  Udp.endPacket();
+}
+
+////////////////////////////////////////
+void writeTag(int tag) {
+
+  // Echo the tag so the client can match the reply to its command
+  if (tag >= 0) {
+    strcpy(tagBuffer, "#");
+    itoa(tag, tagBuffer + strlen(tagBuffer), 10);
+    strcpy(tagBuffer + strlen(tagBuffer), ":");
+    Udp.write(tagBuffer);
+  }
+}
+
+////////////////////////////////////////
+char *parseTag(char *packet, int *tag) {
+
+  // Strip an optional correlation tag "#[n]:" from the front of a command.
+  // Returns the command and sets tag to n, or -1 if there is no tag.
+  char *p;
+  int value = 0;
+  
+  *tag = -1;
+  if (*packet != '#')
+    return packet;
+  for(p=packet+1; *p >= '0' && *p <= '9'; p++) {
+    value = value*10 + *p - '0';
+  }
+  if (*p != ':' || p == packet+1)
+    return packet;
+  *tag = value;
+  return p+1;
+}
+
 //////////////////////////////////////////////////////////////////////////
 // UDP events
+void setFraming(int version) {
+  
+  /*
+  * Send events as frames of the requested version, or the latest this sketch knows if that
+  * is older, to the client asking. Version 0 goes back to text events to the event port.
+  * Responds "framing:[n]" with the version in use.
+  */
+  
+  if (version <= FRAMING_ASCII)
+    eventFraming = FRAMING_ASCII;
+  else if (version > FRAME_VERSION)
+    eventFraming = FRAME_VERSION;
+  else
+    eventFraming = version;
+  frameIP = replyIP;
+  framePort = replyPort;
+  strcpy(replyBuffer, "framing:");
+  itoa(eventFraming, replyBuffer + strlen(replyBuffer), 10);
+}
+
+////////////////////////////////////////
+void beginFrame(byte event) {
+  
+  // Start a frame for an event
+  frameBuffer[0] = FRAME_MAGIC;
+  frameBuffer[1] = eventFraming;
+  frameBuffer[2] = event;
+  frameLength = FRAME_HEADER;
+}
+
+////////////////////////////////////////
+void putFrame(const void *value, int size) {
+  
+  // Append a value to the frame as it is held in memory
+  memcpy(frameBuffer + frameLength, value, size);
+  frameLength += size;
+}
+
+////////////////////////////////////////
+void sendFrame() {
+  
+  // Send the frame to the client which asked for frames
+  Udp.beginPacket(frameIP, framePort);
+  Udp.write(frameBuffer, frameLength);
+  Udp.endPacket();
+}
+
+////////////////////////////////////////
+void sendTelemetry() {
+  
+  /*
+  * Send the telemetry channels which are due.
+  * A frame carries all of them with a sequence number, so the host can drop one which
+  * arrives out of order, and the millis() at which they were read.
+  */
+  
+  unsigned long now = millis();
+  unsigned int period;
+  byte due = 0;
+  bool tx;
+  
+  for (int ch = 0; ch < TELEMETRY_CHANNELS; ch++) {
+    period = (task == TASK_NONE) ? telemetryIdle[ch] : telemetryBusy[ch];
+    if (period == 0)
+      continue;
+    // After a change to a shorter period do not wait out the longer one
+    if ((long)(telemetryDue[ch] - now) > (long)period)
+      telemetryDue[ch] = now;
+    if ((long)(now - telemetryDue[ch]) >= 0) {
+      telemetryDue[ch] = now + period;
+      due |= 1 << ch;
+    }
+  }
+  if (due == 0)
+    return;
+  tx = isTX();
+  if (!tx)
+    due &= ~(1 << TM_VSWR);
+  
+  if (eventFraming >= FRAME_TELEMETRY) {
+    uint32_t stamp = now;
+    beginFrame(EVENT_TELEMETRY);
+    putFrame(&telemetrySeq, sizeof(telemetrySeq));
+    putFrame(&stamp, sizeof(stamp));
+    putFrame(&due, sizeof(due));
+    if (due & (1 << TM_TX)) {
+      byte on = tx ? 1 : 0;
+      putFrame(&on, sizeof(on));
+    }
+    if (due & (1 << TM_VSWR)) {
+      float values[2] = {getForward(), getReflected()};
+      putFrame(values, sizeof(values));
+    }
+    if (due & (1 << TM_POT)) {
+      int16_t raw = getPotValue();
+      float extension = getExtension();
+      putFrame(&raw, sizeof(raw));
+      putFrame(&extension, sizeof(extension));
+    }
+    sendFrame();
+    telemetrySeq++;
+    return;
+  }
+  if (due & (1 << TM_TX))
+    sendTX(tx);
+  if (due & (1 << TM_VSWR))
+    sendVSWR(getForward(), getReflected());
+  if (due & (1 << TM_POT))
+    sendPotEvent();
+}
+
+////////////////////////////////////////
+void setTelemetryPeriod(int channel, long period, bool busy) {
+  
+  /*
+  * Set the period of a telemetry channel in ms while idle or while a task runs, 0 for off
+  */
+  
+  if (channel < 0 || channel >= TELEMETRY_CHANNELS || period < 0 || period > 60000L || (period > 0 && period < MIN_TELEMETRY_PERIOD)) {
+    strcpy(replyBuffer, "failure:Invalid period");
+    return;
+  }
+  if (busy)
+    telemetryBusy[channel] = period;
+  else
+    telemetryIdle[channel] = period;
+}
+
+////////////////////////////////////////
 int sendProgress(int percentToMove, int percentRemaining) {
 
   // Send a progress report to the remote IP and event port
   if(percentRemaining%10 == 0) {
     int percentComplete = int(((double)percentRemaining/(double)percentToMove)*100.0);
+    if (eventFraming != FRAMING_ASCII) {
+      int16_t complete = percentComplete;
+      beginFrame(EVENT_PROGRESS);
+      putFrame(&complete, sizeof(complete));
+      sendFrame();
+      return;
+    }
     strcpy(progressBuffer, "progress:");
     itoa(percentComplete,progressBuffer + strlen(progressBuffer),10);
     Udp.beginPacket(Udp.remoteIP(), eventPort);    
@@ -339,6 +826,13 @@ int sendVSWR(double forward, double reflected) {
   // Send a VSWR report to the remote IP and event port
   char fwdbuff[8];
   char revbuff[8];
+  if (eventFraming != FRAMING_ASCII) {
+    float values[2] = {(float)forward, (float)reflected};
+    beginFrame(EVENT_VSWR);
+    putFrame(values, sizeof(values));
+    sendFrame();
+    return;
+  }
   strcpy(vswrBuffer, "vswr:");
   // Note the standard lib sprintf does not support float
   dtostrf(forward,5,2,fwdbuff);
@@ -356,6 +850,14 @@ int sendPot(int rawValue, float percentExtension) {
   
   // Send a Potentiometer report to the remote IP and event port
   char extbuff[8];
+  if (eventFraming != FRAMING_ASCII) {
+    int16_t raw = rawValue;
+    beginFrame(EVENT_POT);
+    putFrame(&raw, sizeof(raw));
+    putFrame(&percentExtension, sizeof(percentExtension));
+    sendFrame();
+    return;
+  }
   dtostrf(percentExtension,5,1,extbuff);
   //int extension = (int)round(percentExtension);
   strcpy(potBuffer, "pot:");
@@ -371,6 +873,13 @@ int sendPot(int rawValue, float percentExtension) {
 int sendTX(bool is_tx) {
 
   // Send a TX status
+  if (eventFraming != FRAMING_ASCII) {
+    byte on = is_tx ? 1 : 0;
+    beginFrame(EVENT_TX);
+    putFrame(&on, sizeof(on));
+    sendFrame();
+    return;
+  }
   if (is_tx)
      strcpy(txBuffer, "tx:on");
    else
@@ -380,9 +889,63 @@ int sendTX(bool is_tx) {
   Udp.endPacket();  
 }
 
-int sendAlarm(char *msg) {
+////////////////////////////////////////
+int sendNoise() {
+
+  // Send the noise floors "noise:[pot]:[fwd]:[ref]" in analog steps to the remote IP and event port
+  char buff[8];
+  if (eventFraming != FRAMING_ASCII) {
+    beginFrame(EVENT_NOISE);
+    putFrame(channelNoise, CHANNELS*sizeof(float));
+    sendFrame();
+    return;
+  }
+  strcpy(noiseBuffer, "noise");
+  for (int i = 0; i < CHANNELS; i++) {
+    dtostrf(channelNoise[i],1,1,buff);
+    strcpy(noiseBuffer + strlen(noiseBuffer), ":");
+    strcpy(noiseBuffer + strlen(noiseBuffer), buff);
+  }
+  Udp.beginPacket(Udp.remoteIP(), eventPort);    
+  Udp.write(noiseBuffer);
+  Udp.endPacket();  
+}
+
+////////////////////////////////////////
+int sendAutotune() {
+
+  // Send the autotune metrics "autotune:[ms TX]:[ms TX above AUTOTUNE_VSWR]:[searches]" to the remote IP and event port
+  if (eventFraming != FRAMING_ASCII) {
+    uint32_t txMs = autotuneTxMs;
+    uint32_t aboveMs = autotuneAboveMs;
+    int16_t searches = autotuneSearches;
+    beginFrame(EVENT_AUTOTUNE);
+    putFrame(&txMs, sizeof(txMs));
+    putFrame(&aboveMs, sizeof(aboveMs));
+    putFrame(&searches, sizeof(searches));
+    sendFrame();
+    return;
+  }
+  strcpy(autoBuffer, "autotune:");
+  ultoa(autotuneTxMs, autoBuffer + strlen(autoBuffer), 10);
+  strcpy(autoBuffer + strlen(autoBuffer), ":");
+  ultoa(autotuneAboveMs, autoBuffer + strlen(autoBuffer), 10);
+  strcpy(autoBuffer + strlen(autoBuffer), ":");
+  itoa(autotuneSearches, autoBuffer + strlen(autoBuffer), 10);
+  Udp.beginPacket(Udp.remoteIP(), eventPort);    
+  Udp.write(autoBuffer);
+  Udp.endPacket();  
+}
+
+int sendAlarm(char *msg, byte alarm) {
 
   // Send an alarm to the remote IP and event port
+  if (eventFraming != FRAMING_ASCII) {
+    beginFrame(EVENT_ALARM);
+    putFrame(&alarm, sizeof(alarm));
+    sendFrame();
+    return;
+  }
   strcpy(almBuffer, "alarm:");
   strcpy(almBuffer + strlen(almBuffer), msg);
   Udp.beginPacket(Udp.remoteIP(), eventPort);    
@@ -396,14 +959,23 @@ void execute(char *command) {
   
   /*
   * The command set is as follows. Commands are terminated strings.
+  * Any command may be prefixed by a correlation tag "#[n]:" which is echoed in front of the response.
+  * Several commands may be sent in one datagram separated by ';', see executeBatch().
+  * Moves, nudges and tunes are tasks which run on from loop(), see stepTask(). They reply when
+  * they finish, other commands are executed and reply at once even while a task runs. A second
+  * task while one is running is refused with "failure:Busy" and a task in a batch with
+  * "failure:Not in a batch".
   * Ping                   - "ping"              -  connectivity test
   * Set analog ref def     - "refdefault"        -  set analog reference to default (vdd)
   * Set analog ref ext     - "refexternal"       -  set analog reference to external, via AREF pin
   * Is TX                  - "istx"              -  TX state
   * Set speed              - "[n][nn]s"          -  set the nominal motor speed, although some commands will set their own speed
-  * Stop                   - "stop"              -  stop motor
+  * Stop                   - "stop"              -  stop motor, while a task runs this stops the task which replies
+  *                                                 as it finishes and the stop gets no response
   * Move to %              - "[n][nn]m"          -  move to the given % setting
   * Move to value          - "[n][nn]n"          -  move to the given analog value
+  *                                                 both respond "success:[ms]:[error]", the move time and the final
+  *                                                 position less the target in analog steps
   * Nudge forwards         - "[n][nn]f"          -  nudge forwards by analog value
   * Nudge reverse          - "[n][nn]r"          -  nudge reverse by analog value
   * Set freq low           - "[n][nn]l"          -  % absolute for low frequency setpoint for this loop
@@ -411,14 +983,35 @@ void execute(char *command) {
   * Set cap max            - "[n][nn]x"          -  analog value of pot setting for maximum capacity
   * Set cap min            - "[n][nn]y"          -  analog value of pot setting for minimum capacity
   * Tune                   - "tune"              -  tune for minimum SWR
-  * Auto-tune on           - "autotuneon"        -  autotune on, tune for minimum SWR as necessary when TX
+  * Warm tune              - "[n][nn],[n]w"      -  tune for minimum SWR within n +/- n % extension, then over the full span,
+  *                                                 responds "success:warm" or "success:full"
+  * Auto-tune on           - "autotuneon"        -  autotune on, track minimum SWR with dither moves when TX and search
+  *                                                 when lock is lost, sends "autotune:[ms TX]:[ms above]:[searches]" events
   * Auto-tune off          - "autotuneoff"       -  turn autotune off
   * Relay energise         - "[n]e"              -  energise relay n 1-8
   * Relay de-energise      - "[n]d"              -  de_energise relay n 1-8
+  * Relay mask             - "[n][nn]k"          -  set all relays, bit 0-7 of n energises relay 1-8, responds "relays:[mask]"
+  * Relay state            - "relays"            -  responds "relays:[mask]"
+  * Retarget               - "[n][nn]g"          -  while moving to a % setting change the target to n without stopping,
+  *                                                 responds "retarget:[n]" or "failure:Not moving"
+  * Framing                - "[n]b"              -  send events as binary frames of version n, 0 for text events,
+  *                                                 responds "framing:[n]" with the version in use
+  * Telemetry idle         - "[n],[n]p"          -  send telemetry channel n every n ms while idle, 0 for off
+  *                                                 channels are 0 TX, 1 VSWR, 2 pot
+  * Telemetry busy         - "[n],[n]a"          -  as p but while a move or tune is running
+  * Table clear            - "tableclear"        -  start uploading a setpoint table
+  * Table point            - "[n],[n]t"          -  add a point, n Hz at n hundredths of a % extension
+  * Table save             - "tablesave"         -  use the uploaded points and save them to EEPROM, responds
+  *                                                 "table:[points]:[checksum]"
+  * Table state            - "table"             -  responds "table:[points]:[checksum]" for the table in use
+  * Track frequency        - "[n]q"              -  move to the table extension for n Hz, responds as a move
+  * Retarget frequency     - "[n]u"              -  while moving change the target to the table extension for n Hz,
+  *                                                 responds "retarget:[n]" or "failure:Not moving"
   */ 
   
   char *p;
-  int value = 0;
+  long value = 0;
+  long first = -1;
   bool forward = true;
    
   // Assume success
@@ -428,13 +1021,16 @@ void execute(char *command) {
     ;
   } else if (strcmp(command, "refdefault") == 0) {
     analogReference(DEFAULT);
+    // The readings so far are on the old scale
+    channelPrimed = false;
     isRunning = true;
   } else if (strcmp(command, "refexternal") == 0) {
     analogReference(EXTERNAL);
+    channelPrimed = false;
     isRunning = true;
   } else if (strcmp(command, "istx") == 0) {
     if (isRunning) {
-      if (analogRead(fwdPin) > 0.0) {
+      if (isTX()) {
         strcpy(replyBuffer, "tx:on");
       } else {
         strcpy(replyBuffer, "tx:off");
@@ -443,13 +1039,30 @@ void execute(char *command) {
       strcpy(replyBuffer, "tx:off");
     }
   } else if (strcmp(command, "stop") == 0) {
-    doStop();
+    if (task == TASK_DITHER)
+      ditherAbort();
+    if (task != TASK_NONE) {
+      // The task replies as it finishes
+      stopTask();
+      noReply = !isBatch;
+    } else {
+      doStop();
+    }
+  } else if (strcmp(command, "relays") == 0) {
+    sendRelayState();
   } else if  (strcmp(command, "tune") == 0) {
-    doTune();
+    if (canStartTask())
+      doTune();
   } else if  (strcmp(command, "autotuneon") == 0) {
-    autoTune = true;
+    autotuneOn(true);
   } else if  (strcmp(command, "autotuneoff") == 0) {
-    autoTune = false;
+    autotuneOn(false);
+  } else if (strcmp(command, "tableclear") == 0) {
+    uploadCount = 0;
+  } else if (strcmp(command, "tablesave") == 0) {
+    saveTable();
+  } else if (strcmp(command, "table") == 0) {
+    setTableReply();
   } else {
     // A speed/ move/ relay/ low,high setpoint command?
     for(p=command; *p; p++) {
@@ -462,6 +1075,17 @@ void execute(char *command) {
       } else if(*p >= '0' && *p <= '9') {
         // Numeric entered, so accumulate numeric value
         value = value*10 + *p - '0';
+      } else if(*p == ',') {
+        // First of two values
+        first = value;
+        value = 0;
+      } else if(*p == 'w') {
+        // Instructed to tune within a window, checked first so a bad one never stops a dither
+        if (first < 0 || !validWindow(first, value))
+          strcpy(replyBuffer, "failure:Invalid window");
+        else if (canStartTask())
+          doWarmTune(first, value);
+        break;
       } else if(*p == 's') {
         // Instructed to change speed
         if(value > 0 && value <= MAX_SPEED_VALUE)
@@ -469,13 +1093,13 @@ void execute(char *command) {
         break;
       } else if(*p == 'm') {
         // Instructed to move to n extension
-        if(value >= 0 && value <= MAX_EXTENSION_VALUE) {
+        if(value >= 0 && value <= MAX_EXTENSION_VALUE && canStartTask()) {
           doMove(value, speedSetting, true);
         }
         break;
       } else if(*p == 'n') {
         // Instructed to move to n analog value
-        if(value >= 0 && value <= MAX_ANALOG_VALUE) {
+        if(value >= 0 && value <= MAX_ANALOG_VALUE && canStartTask()) {
           doMove(value, speedSetting, false);
         }
         break;
@@ -491,12 +1115,12 @@ void execute(char *command) {
         break;
       } else if(*p == 'f') {
         // Instructed to nudge forwards
-        if(value > 0 && value < 50)
+        if(value > 0 && value < 50 && canStartTask())
           doNudge(true, value);
         break;
       } else if(*p == 'r') {
         // Instructed to nudge reverse
-        if(value > 0 && value < 50)
+        if(value > 0 && value < 50 && canStartTask())
           doNudge(false, value);
         break;
       } else if(*p == 'x') {
@@ -517,6 +1141,55 @@ void execute(char *command) {
         if(value >= 0)
           doRelay(value, false);
         break;
+      } else if(*p == 'g') {
+        // Retarget is only valid while a move to a % setting is in progress
+        if (task == TASK_MOVE && moveRetarget && value <= MAX_EXTENSION_VALUE) {
+          moveRetargetTo(value);
+          strcpy(replyBuffer, "retarget:");
+          itoa(value, replyBuffer + strlen(replyBuffer), 10);
+        } else {
+          strcpy(replyBuffer, "failure:Not moving");
+        }
+        break;
+      } else if(*p == 'b') {
+        // Instructed to frame events as version n
+        setFraming(value);
+        break;
+      } else if(*p == 'p' || *p == 'a') {
+        // Instructed to set the period of a telemetry channel
+        setTelemetryPeriod(first, value, *p == 'a');
+        break;
+      } else if(*p == 't') {
+        // A point of the table being uploaded
+        if (first <= 0 || value > 100L*MAX_EXTENSION_VALUE)
+          strcpy(replyBuffer, "failure:Invalid point");
+        else
+          addTablePoint(first, value);
+        break;
+      } else if(*p == 'q') {
+        // Instructed to track to n Hz
+        if (tableCount == 0)
+          strcpy(replyBuffer, "failure:No setpoint table");
+        else if (canStartTask())
+          doTrack(value);
+        break;
+      } else if(*p == 'u') {
+        // As 'g' but to the extension for n Hz
+        if (task == TASK_MOVE && moveRetarget && tableCount > 0) {
+          moveRetargetTo(tableExtension(value));
+          strcpy(replyBuffer, "retarget:");
+          ltoa(value, replyBuffer + strlen(replyBuffer), 10);
+        } else {
+          strcpy(replyBuffer, "failure:Not moving");
+        }
+        break;
+      } else if(*p == 'k') {
+        // Instructed to set all relays from mask n
+        if(value >= 0 && value < (1 << MAX_RELAYS))
+          doRelayMask(value);
+        else
+          strcpy(replyBuffer, "failure:Invalid relay mask");
+        break;
       } else {
          // Invalid command
          strcpy(replyBuffer, "failure:Invalid command");
@@ -526,6 +1199,43 @@ void execute(char *command) {
   }
 }
 
+////////////////////////////////////////
+void executeBatch(char *commands) {
+
+  /*
+  * A batch is a set of commands separated by ';' in one datagram, "40l;60h;1e;2d".
+  * The commands are executed in order and the response holds the response to each
+  * command in the same order, "batch:success;success;success;success".
+  * A batch is rejected as a whole before anything is executed if it is too long.
+  */
+  
+  char *p;
+  char *next;
+  int count = 1;
+  
+  for(p=commands; *p; p++) {
+    if (*p == BATCH_SEPARATOR) count++;
+  }
+  if (count > MAX_BATCH_COMMANDS) {
+    strcpy(batchBuffer, "failure:Batch too long");
+    return;
+  }
+  
+  strcpy(batchBuffer, "batch:");
+  for(p=commands; p != NULL; p=next) {
+    // Terminate this command and find the next
+    next = strchr(p, BATCH_SEPARATOR);
+    if (next != NULL) *next++ = '\0';
+    execute(p);
+    // Room for the response, separator and terminator
+    if (strlen(batchBuffer) + strlen(replyBuffer) + 2 > BATCH_BUFFER_SIZE)
+      strcpy(replyBuffer, "failure");
+    strcpy(batchBuffer + strlen(batchBuffer), replyBuffer);
+    if (next != NULL)
+      strcpy(batchBuffer + strlen(batchBuffer), ";");
+  }
+}
+
 ////////////////////////////////////////
 void setSpeed(int value) {
   
@@ -539,10 +1249,17 @@ void setSpeed(int value) {
   } else {
     motorSpeed = -value;
   }
+}
+
+////////////////////////////////////////
+int timeoutFor(int nspeed) {
+  
+  /*
+  * Control ticks allowed for a move at a speed, timeouts must allow a full extension or retraction
+  */
   
-  // Recalculate the command timeout value
-  msFullExtensionOrRetraction = (((double)MAX_EXTENSION/(double)MAX_MM_SEC) * ((double)MAX_SPEED_VALUE)/abs((double)speedSetting))*1000.0;
-  COMMAND_TIMEOUT = (int)((msFullExtensionOrRetraction*2.0 )/(double)EX_LOOP_SLEEP);  // speed dependent imeout
+  double msFullExtensionOrRetraction = (((double)MAX_EXTENSION/(double)MAX_MM_SEC) * ((double)MAX_SPEED_VALUE)/abs((double)nspeed))*1000.0;
+  return (int)((msFullExtensionOrRetraction*2.0 )/(double)EX_LOOP_SLEEP);
 }
     
 ////////////////////////////////////////
@@ -557,260 +1274,308 @@ void doStop() {
 }
 
 ////////////////////////////////////////
-void doMove(int extensionOrRaw, int nspeed, bool extension) {
+bool canStartTask() {
   
   /*
-  * Move to the given virtual % extension using the pot feedback
-  *
-  *  extensionOrRaw = normalised extension % ot raw analog value of pot
-  *  speed = suggested speed
-  *  extension = true if extension else raw
+  * Check a task can start, sets the failure reply if not.
+  * Only one runs at a time and not from a batch as the batch response cannot wait for it.
+  * An autotune dither gives way.
   */
-
-  if (extension) {
-    return doMoveExtension(extensionOrRaw, nspeed);
-  } else {
-    return doMoveRaw(extensionOrRaw, nspeed);
-  }
-}
-
-////////////////////////////////////////
-void doMoveExtension(int extension, int nspeed) {
   
-  bool lforward = true;
-  int timeout = COMMAND_TIMEOUT;
- 
-  // Get the current extension
-  // The host works in integer % values
-  // For positioning we work in float as 1% is 8 in analog value (assuming a range 100-900).
-  // We want to hit the exact same spot every time and not be up to analog 8 different in position.
-  // For even better accuracy the host may need to work in float as well.
-  
-  float reqdExtension = (float)extension;
-  float currentExtension = getExtension();
-  float percentToMove = abs(currentExtension - (float)extension);
-  if (reqdExtension >= (currentExtension - 1.0) && extension <= (currentExtension + 1.0))
-    // Close to target +- 1%
-    return;
-  else if (reqdExtension > currentExtension - 1.0) {
-    // Need to extend further
-    // This equates to a move forward
-    // Pot increases analog voltage in extend (forward) direction
-    md.setM1Speed(nspeed);
-    stopIfFault();
-    lforward = true;
-  } else {
-    // Need to contract
-    // This equates to a move reverse
-    // Pot decreases analog voltage in a contract (reverse) direction
-    md.setM1Speed(-nspeed);
-    stopIfFault();
-    lforward = false;
-  }
-  while (true) {
-    delay(EX_LOOP_SLEEP);
-    currentExtension = getExtension();
-    // Every 100ms: 
-    //  Send the current heading
-    //  Send a progress report
-    //  Check for a new command, we might get a stop if still tuning
-    if ((timeout%100) == 0) { 
-      sendPotEvent();
-      sendProgress(percentToMove, abs((int)currentExtension - extension));
-      if (checkForStop()) break;
-    }
-    if (timeout-- <= 0) {
-      strcpy(replyBuffer, "failure:Timeout when executing doMove");
-      break;
-    }
-      
-    if (currentExtension >= (reqdExtension - 1.0) && currentExtension <= (reqdExtension + 1.0)) {
-      // Close to target +- 1%
-       break;
-    }
+  if (isBatch) {
+    strcpy(replyBuffer, "failure:Not in a batch");
+    return false;
   }
-  // Arrived close to or broken so stop motor
-  doStop();
-  
-  // See if we need a final tweak
-  float diff;
-  int tries = 5;
-  while (true) {
-    currentExtension = getExtension();
-    diff = currentExtension - reqdExtension;
-    if ((diff >= -0.5) && (diff <= 0.5)) {
-      // Probably can't do much better
-      break;
-    } else if (diff > 0.0) {
-      // Need to move backwards a tad
-      doNudge(false, 2);
-    } else {
-      // Need to move forwards a tad
-      doNudge(true, 2);
-    }
-    if (--tries < 0) {
-       // Have to give up and hope its close enough 
-       break;
-    }
-    delay(MOTOR_DELAY);
+  if (task == TASK_DITHER)
+    ditherAbort();
+  if (task != TASK_NONE) {
+    strcpy(replyBuffer, "failure:Busy");
+    return false;
   }
-  sendPotEvent(); 
+  return true;
 }
 
 ////////////////////////////////////////
-void doMoveRaw(int raw, int nspeed) {
+void beginTask(int newTask) {
   
-  bool lforward = true;
-  int timeout = COMMAND_TIMEOUT;
- 
-  // Get the current extension
-  // The host works in integer % values
-  // However, for better accuracy when operting without a user we can use the raw value
-  
-  int currentRaw = getPotValue();
-  int rawToMove = abs(currentRaw - raw);
-  if (raw >= (currentRaw - 8) && raw <= (currentRaw + 8))
-    // Close to target +-8 == +-1%
-    return;
-  else if (raw > currentRaw - 8) {
-    // Need to extend further
-    // This equates to a move forward
-    // Pot increases analog voltage in extend (forward) direction
-    md.setM1Speed(nspeed);
-    stopIfFault();
-    lforward = true;
-  } else {
-    // Need to contract
-    // This equates to a move reverse
-    // Pot decreases analog voltage in a contract (reverse) direction
-    md.setM1Speed(-nspeed);
-    stopIfFault();
-    lforward = false;
-  }
-  while (true) {
-    delay(EX_LOOP_SLEEP);
-    currentRaw = getPotValue();
-    // Every 100ms: 
-    //  Send the current heading
-    //  Send a progress report
-    //  Check for a new command, we might get a stop if still tuning
-    if ((timeout%100) == 0) { 
-      sendPotEvent();
-      sendProgress(rawToMove, abs((int)currentRaw - raw));
-      if (checkForStop()) break;
-    }
-    if (timeout-- <= 0) {
-      strcpy(replyBuffer, "failure:Timeout when executing doMove");
-      break;
-    }
-      
-    if (currentRaw >= (raw - 8) && currentRaw <= (raw + 8)) {
-      // Close to target +-8 == +-1%
-       break;
-    }
-  }
-  // Arrived close to or broken so stop motor
-  doStop();
+  /*
+  * Start a task, the response to the current command waits for it to finish
+  */
   
-  // See if we need a final tweak
-  float diff;
-  int tries = 5;
-  while (true) {
-    currentRaw = getPotValue();
-    diff = currentRaw - raw;
-    if ((diff >= -2) && (diff <= 2)) {
-      // Probably can't do much better
-      break;
-    } else if (diff > 0) {
-      // Need to move backwards a tad
-      doNudge(false, 2);
-    } else {
-      // Need to move forwards a tad
-      doNudge(true, 2);
-    }
-    if (--tries < 0) {
-       // Have to give up and hope its close enough 
-       break;
-    }
-    delay(MOTOR_DELAY);
-  }
-  sendPotEvent(); 
+  task = newTask;
+  strcpy(taskBuffer, "success");
+  deferReply = true;
 }
 
 ////////////////////////////////////////
-void doNudge(bool forwards, int value) {
+void stepTask() {
   
   /*
-  * Nudge forward/reverse by the given analog value
+  * Advance the running task by one control tick
   */
-  float currentRaw = getPotValue();
-  float requiredRaw;
-  if (forwards) {
-    // Need to move forwards a tad
-    md.setM1Speed(MINIMUM_SPEED_VALUE);
-    stopIfFault();
-    requiredRaw = currentRaw + value;
-  } else {
-    // Need to move backwards a tad
-    md.setM1Speed(-MINIMUM_SPEED_VALUE);
-    stopIfFault();
-    requiredRaw = currentRaw - value;
-  }
   
-  int count = 5; 
-  while (true) {
-    // Give motor 100ms run time
-    delay(100);
-    doStop();
-    // Allow to settle
-    delay(100);
-    if (count-- <= 0) {
-      break;
-    }
-    if ((getPotValue() >= requiredRaw - 1) && (getPotValue() <= requiredRaw + 1)) {
-      // Close enough
-      break;
-    } else if (getPotValue() < requiredRaw) {
-      // Go forward a bit more
-      md.setM1Speed(MINIMUM_SPEED_VALUE);
-      stopIfFault();
-    } else {
-      // Go reverse a bit more
-      md.setM1Speed(-MINIMUM_SPEED_VALUE);
-      stopIfFault();
-    }   
+  int result;
+  
+  if (task == TASK_DITHER) {
+    // Nothing to reply to or count
+    if (ditherStep() != STEP_BUSY)
+      task = TASK_NONE;
+    return;
   }
-  sendPotEvent();
+  if (task == TASK_MOVE) {
+    result = moveStep();
+    if (result == STEP_DONE)
+      setMoveReply();
+  } else {
+    result = tuneStep();
+  }
+  if (result != STEP_BUSY)
+    finishTask(result == STEP_DONE);
 }
- 
+
 ////////////////////////////////////////
-void setLowSetpoint(int extension) {
+void stopTask() {
   
   /*
-  Absolute extension for the low frequency for the current loop
+  * Stop the running task on a stop command
   */
   
-  lowSetpoint = extension;
+  if (task == TASK_MOVE) {
+    // A stopped move succeeds where it got to
+    moveFinish();
+    setMoveReply();
+    finishTask(true);
+  } else {
+    finishTask(sweepEnd(TUNE_ABORTED) == STEP_DONE);
+  }
 }
 
 ////////////////////////////////////////
-void setHighSetpoint(int extension) {
+void finishTask(bool success) {
   
   /*
-  Absolute extension for the high frequency for the current loop
+  * The task has finished, reply to the command which started it
   */
   
-  highSetpoint = extension;
+  task = TASK_NONE;
+  if (taskReplies)
+    sendTaskResponse();
+  else
+    autotuneResult(success);
 }
 
 ////////////////////////////////////////
-void setMaxCapSetpoint(int extension) {
+void doMove(int extensionOrRaw, int nspeed, bool extension) {
   
   /*
-  Analog value of pot setting for the maximum capacitance
-  */
-  
-  maxCapSetpoint = extension;
+  * Start a move to the given virtual % extension using the pot feedback
+  *
+  *  extensionOrRaw = normalised extension % ot raw analog value of pot
+  *  speed = suggested speed
+  *  extension = true if extension else raw
+  *
+  * The host works in integer % values but the move is made to the analog value so we
+  * hit the exact same spot every time rather than anywhere in the 8 analog steps of 1%.
+  * For better accuracy when operating without a user the host can give the analog value.
+  * A move to a % extension may be retargeted while moving.
+  */
+
+  beginTask(TASK_MOVE);
+  if (extension) {
+    moveStart(normalisePotValue(extensionOrRaw, VIRTUAL_TO_REAL), nspeed, POSITION_TOLERANCE, true);
+  } else {
+    moveStart((float)extensionOrRaw, nspeed, POSITION_TOLERANCE, false);
+  }
+}
+
+////////////////////////////////////////
+void doNudge(bool forwards, int value) {
+  
+  /*
+  * Start a nudge forward/reverse by the given analog value.
+  * This is a move at the minimum speed which stops on the exact step if it can.
+  */
+  
+  beginTask(TASK_MOVE);
+  if (forwards) {
+    moveStart((float)(getPotValue() + value), MINIMUM_SPEED_VALUE, 0, false);
+  } else {
+    moveStart((float)(getPotValue() - value), MINIMUM_SPEED_VALUE, 0, false);
+  }
+}
+
+////////////////////////////////////////
+void moveStart(float target, int nspeed, int tolerance, bool allowRetarget) {
+  
+  /*
+  * Start a closed loop move to an analog value with a trapezoidal speed profile, see moveStep()
+  */
+  
+  moveState = MOVE_RUNNING;
+  moveTarget = target;
+  moveSpeed = nspeed;
+  moveTolerance = tolerance;
+  moveRetarget = allowRetarget;
+  moveDir = 0;
+  moveNow = 0;
+  moveStarts = 0;
+  moveTimeout = timeoutFor(nspeed);
+  moveToMove = abs((int)(target - (float)getPotValue()));
+  moveStarted = millis();
+}
+
+////////////////////////////////////////
+void moveRetargetTo(float extension) {
+  
+  /*
+  * Carry on from here to a new % extension, a reversal is handled as an overrun
+  */
+  
+  moveTarget = normalisePotValue(extension, VIRTUAL_TO_REAL);
+  moveToMove = abs((int)(moveTarget - (float)getPotValue()));
+  moveTimeout = timeoutFor(moveSpeed);
+  moveStarts = (moveDir == 0) ? 0 : 1;
+}
+
+////////////////////////////////////////
+int moveStep() {
+  
+  /*
+  * One control tick of a move.
+  * The speed ramps up by PROFILE_ACCEL each tick to at most the move speed and down in
+  * proportion to the distance left, so the final approach is at MINIMUM_SPEED_VALUE and
+  * the motor stops within the tolerance without nudging. If it settles outside the
+  * tolerance the same profile brings it back, at most MAX_CORRECTIONS times.
+  * Returns STEP_BUSY, STEP_DONE or STEP_FAILED on a timeout or fault.
+  */
+  
+  float error;
+  int wanted;
+  int limit;
+  
+  if (moveState == MOVE_SETTLING) {
+    if ((long)(millis() - moveSettled) < 0)
+      return STEP_BUSY;
+    moveState = MOVE_RUNNING;
+  }
+  error = moveTarget - (float)getPotValue();
+  if (abs(error) <= moveTolerance) {
+    if (moveDir == 0) {
+      // Arrived and settled
+      moveFinish();
+      return STEP_DONE;
+    }
+    // Stop and let it settle, it may run on past the tolerance
+    moveSettle();
+    return STEP_BUSY;
+  }
+  // Pot increases analog voltage in extend (forward) direction
+  wanted = (error > 0.0) ? 1 : -1;
+  if (wanted != moveDir) {
+    if (moveDir != 0) {
+      // Overran, let the motor stop before reversing
+      moveSettle();
+      return STEP_BUSY;
+    }
+    if (moveStarts++ > MAX_CORRECTIONS) {
+      // Have to give up and hope its close enough
+      moveFinish();
+      return STEP_DONE;
+    }
+    moveDir = wanted;
+  }
+  // Ramp up, then down as the target gets close, but never so slow the motor stalls
+  limit = MINIMUM_SPEED_VALUE + (int)(PROFILE_GAIN*(abs(error) - moveTolerance));
+  moveNow = max(MINIMUM_SPEED_VALUE, min(moveNow + PROFILE_ACCEL, min(moveSpeed, limit)));
+  md.setM1Speed(moveDir*moveNow);
+  if (!stopIfFault()) {
+    moveFinish();
+    return STEP_FAILED;
+  }
+  // Every 500ms send a progress report
+  if ((moveTimeout%100) == 0)
+    sendProgress(moveToMove, abs((int)error));
+  if (moveTimeout-- <= 0) {
+    strcpy(taskBuffer, "failure:Timeout when executing doMove");
+    moveFinish();
+    return STEP_FAILED;
+  }
+  return STEP_BUSY;
+}
+
+////////////////////////////////////////
+void moveSettle() {
+  
+  /*
+  * Stop and wait MOTOR_DELAY for the motor to settle
+  */
+  
+  doStop();
+  moveDir = 0;
+  moveNow = 0;
+  moveSettled = millis() + MOTOR_DELAY;
+  moveState = MOVE_SETTLING;
+}
+
+////////////////////////////////////////
+void moveFinish() {
+  
+  /*
+  * Stop and set moveMillis and moveError for the reply
+  */
+  
+  float error;
+  
+  doStop();
+  moveState = MOVE_IDLE;
+  moveDir = 0;
+  moveMillis = millis() - moveStarted;
+  error = (float)getPotValue() - moveTarget;
+  moveError = (int)(error + ((error < 0.0) ? -0.5 : 0.5));
+  sendPotEvent();
+}
+
+////////////////////////////////////////
+void setMoveReply() {
+  
+  /*
+  * Reply "success:[ms]:[error]" with the time and final error in analog steps of the last move
+  */
+  
+  strcpy(taskBuffer, "success:");
+  ultoa(moveMillis, taskBuffer + strlen(taskBuffer), 10);
+  strcpy(taskBuffer + strlen(taskBuffer), ":");
+  itoa(moveError, taskBuffer + strlen(taskBuffer), 10);
+}
+ 
+////////////////////////////////////////
+void setLowSetpoint(int extension) {
+  
+  /*
+  Absolute extension for the low frequency for the current loop
+  */
+  
+  lowSetpoint = extension;
+}
+
+////////////////////////////////////////
+void setHighSetpoint(int extension) {
+  
+  /*
+  Absolute extension for the high frequency for the current loop
+  */
+  
+  highSetpoint = extension;
+}
+
+////////////////////////////////////////
+void setMaxCapSetpoint(int extension) {
+  
+  /*
+  Analog value of pot setting for the maximum capacitance
+  */
+  
+  maxCapSetpoint = extension;
 }
 
 ////////////////////////////////////////
@@ -823,35 +1588,221 @@ void setMinCapSetpoint(int extension) {
   minCapSetpoint = extension;
 }
 
+////////////////////////////////////////
+void loadTable() {
+  
+  /*
+  * Load the setpoint table saved in EEPROM, none if it was never saved or is damaged
+  */
+  
+  unsigned int magic;
+  int address = TABLE_ADDRESS;
+  
+  tableCount = 0;
+  EEPROM.get(address, magic);
+  address += sizeof(magic);
+  EEPROM.get(address, tableCount);
+  address += sizeof(tableCount);
+  EEPROM.get(address, tableSum);
+  address += sizeof(tableSum);
+  if (magic != TABLE_MAGIC || tableCount <= 0 || tableCount > MAX_TABLE_POINTS) {
+    tableCount = 0;
+    tableSum = 0;
+    return;
+  }
+  for (int i = 0; i < tableCount; i++) {
+    EEPROM.get(address, table[i]);
+    address += sizeof(TablePoint);
+  }
+  if (tableChecksum(table, tableCount) != tableSum) {
+    tableCount = 0;
+    tableSum = 0;
+  }
+}
+
+////////////////////////////////////////
+void addTablePoint(long hz, int extension) {
+  
+  /*
+  * Add a point to the table being uploaded, kept in ascending frequency.
+  * A second point at the same frequency replaces the first.
+  */
+  
+  int i;
+  
+  for (i = 0; i < uploadCount && upload[i].hz < hz; i++)
+    ;
+  if (i < uploadCount && upload[i].hz == hz) {
+    upload[i].extension = extension;
+    return;
+  }
+  if (uploadCount >= MAX_TABLE_POINTS) {
+    strcpy(replyBuffer, "failure:Table full");
+    return;
+  }
+  for (int j = uploadCount; j > i; j--)
+    upload[j] = upload[j-1];
+  upload[i].hz = hz;
+  upload[i].extension = extension;
+  uploadCount++;
+}
+
+////////////////////////////////////////
+void saveTable() {
+  
+  /*
+  * Use the uploaded table and save it to EEPROM.
+  * EEPROM.put() only writes the bytes which change so saving the same table again costs nothing.
+  */
+  
+  int address = TABLE_ADDRESS;
+  
+  if (uploadCount == 0) {
+    strcpy(replyBuffer, "failure:Table empty");
+    return;
+  }
+  for (int i = 0; i < uploadCount; i++) {
+    table[i] = upload[i];
+    EEPROM.put(address + sizeof(TABLE_MAGIC) + sizeof(tableCount) + sizeof(tableSum) + i*sizeof(TablePoint), table[i]);
+  }
+  tableCount = uploadCount;
+  tableSum = tableChecksum(table, tableCount);
+  EEPROM.put(address, TABLE_MAGIC);
+  address += sizeof(TABLE_MAGIC);
+  EEPROM.put(address, tableCount);
+  address += sizeof(tableCount);
+  EEPROM.put(address, tableSum);
+  setTableReply();
+}
+
+////////////////////////////////////////
+unsigned int tableChecksum(TablePoint *points, int count) {
+  
+  /*
+  * Checksum over the points in order, the host works out the same to see if an upload is needed
+  */
+  
+  unsigned int sum = 0;
+  
+  for (int i = 0; i < count; i++)
+    sum = (31UL*sum + (unsigned long)points[i].hz + (unsigned long)points[i].extension) & 0xFFFF;
+  return sum;
+}
+
+////////////////////////////////////////
+void setTableReply() {
+  
+  // Reply "table:[points]:[checksum]" for the table in use
+  strcpy(replyBuffer, "table:");
+  itoa(tableCount, replyBuffer + strlen(replyBuffer), 10);
+  strcpy(replyBuffer + strlen(replyBuffer), ":");
+  utoa(tableSum, replyBuffer + strlen(replyBuffer), 10);
+}
+
+////////////////////////////////////////
+float tableExtension(long hz) {
+  
+  /*
+  * The % extension for a frequency from the setpoint table
+  */
+  
+  int i;
+  
+  if (hz <= table[0].hz)
+    return table[0].extension/100.0;
+  for (i = 1; i < tableCount && table[i].hz < hz; i++)
+    ;
+  if (i == tableCount)
+    return table[tableCount-1].extension/100.0;
+  return (table[i-1].extension + (float)(hz - table[i-1].hz)/(float)(table[i].hz - table[i-1].hz)*(table[i].extension - table[i-1].extension))/100.0;
+}
+
+////////////////////////////////////////
+void doTrack(long hz) {
+  
+  /*
+  * Start a move to the extension for a frequency, as a move to a % extension it may be
+  * retargeted while moving. The extension is not rounded to a whole % as the host's is.
+  */
+  
+  beginTask(TASK_MOVE);
+  moveStart(normalisePotValue(tableExtension(hz), VIRTUAL_TO_REAL), speedSetting, POSITION_TOLERANCE, true);
+}
+
 ////////////////////////////////////////
 bool doTune() {
   
   /*
-  * Tune for lowest SWR
-  * We know the low and high setpoints for this loop:
-  *  1. Move to low setpoint at a reasonable speed.
-  *  2. Move from the low setpoint checking SWR.
-  *  3. If SWR reaches a good minimum value stop.
-  *  4. If SWR does not come down then stop at high setpoint.
-  *
-  * Note: lowSetpoint and highSetpoint are virtual percent extension
+  * Start a tune for lowest SWR over the whole span between the low and high setpoints
+  */
+  
+  if (!tuneReady()) {
+    return false;
+  }
+  beginTask(TASK_TUNE);
+  tuneMode = TUNE_FULL;
+  sweepBegin(lowSetpoint, highSetpoint);
+  return true;
+}
+
+////////////////////////////////////////
+bool doWarmTune(int predicted, int window) {
+  
+  /*
+  * Start a tune for lowest SWR searching only predicted +/- window % extension.
+  * The host predicts the extension from its setpoints or recent tunes, which is usually
+  * close enough that a short window finds the match in a fraction of the full sweep.
+  * If there is no match in the window fall back to the full sweep, see tuneResult().
+  * The reply is "success:warm" or "success:full" to show which sweep found the match.
+  */
+  
+  int lowExtension;
+  int highExtension;
+  
+  if (!validWindow(predicted, window)) {
+    strcpy(replyBuffer, "failure:Invalid window");
+    return false;
+  }
+  if (!tuneReady()) {
+    return false;
+  }
+  beginTask(TASK_TUNE);
+  // Search no further than the setpoints allow
+  lowExtension = min(lowSetpoint, predicted + window);
+  highExtension = max(highSetpoint, predicted - window);
+  if (highExtension < lowExtension) {
+    tuneMode = TUNE_WINDOW;
+    sweepBegin(lowExtension, highExtension);
+  } else {
+    // Nothing in the window so search the lot
+    tuneMode = TUNE_FALLBACK;
+    sweepBegin(lowSetpoint, highSetpoint);
+  }
+  return true;
+}
+
+////////////////////////////////////////
+bool validWindow(int predicted, int window) {
+  
+  /*
+  * Check a warm tune window, the host probes for warm tune with an empty one
   */
   
-  const int MOVE_FORWARDS = 0;
-  const int MOVE_REVERSE = 1;
-  float ref, refMin = -1.0;
-  float vswr;
-  bool moveDirection;
-  int target;
-  float extension = 0.0;
-  bool success = false;
-  int timeout;
+  return predicted >= MIN_EXTENSION_VALUE && predicted <= MAX_EXTENSION_VALUE && window > 0;
+}
+
+////////////////////////////////////////
+bool tuneReady() {
+  
+  /*
+  * Check we can tune, sets the failure reply if not
+  */
   
   // Check TX
-  if (analogRead(fwdPin) == 0.0) {
+  if (!isTX()) {
     // Need some RF!
     strcpy(replyBuffer, "failure:No RF detected!");
-    return success;
+    return false;
   }
   
   // Check setpoints
@@ -860,168 +1811,492 @@ bool doTune() {
   if (highSetpoint >= lowSetpoint) {
     // Wrong way around
     strcpy(replyBuffer, "failure:Setpoints are reversed!");
-    return success;
-  }
-  
-  // Move to the closest setpoint as a start point for tuning
-  // Recalculate the command timeout value
-  msFullExtensionOrRetraction = (((double)MAX_EXTENSION/(double)MAX_MM_SEC) * ((double)MAX_SPEED_VALUE)/abs((double)FAST_TUNE_SPEED_VALUE))*1000.0;
-  COMMAND_TIMEOUT = (int)((msFullExtensionOrRetraction*2.0 )/(double)EX_LOOP_SLEEP);  // speed dependent imeout
-  if (getExtension() > lowSetpoint) {
-    // Move to the low setpoint
-    doMove(lowSetpoint, FAST_TUNE_SPEED_VALUE, true);
-    // Move reverse from here
-    moveDirection = MOVE_REVERSE;
-  } else {
-    doMove(highSetpoint, FAST_TUNE_SPEED_VALUE, true);
-    // Move forward from here
-    moveDirection = MOVE_FORWARDS;
-  }
-  
-  // Now move from the current setpoint to the far setpoint giving fwd and ref feedback
-  // We check the reflected value and stop when we reach a good value
-  // Recalculate the command timeout value
-  msFullExtensionOrRetraction = (((double)MAX_EXTENSION/(double)MAX_MM_SEC) * ((double)MAX_SPEED_VALUE)/abs((double)SLOW_TUNE_SPEED_VALUE))*1000.0;
-  timeout = (int)((msFullExtensionOrRetraction*2.0 )/(double)EX_LOOP_SLEEP);  // speed dependent imeout
-  if (moveDirection == MOVE_FORWARDS) {
-    md.setM1Speed(SLOW_TUNE_SPEED_VALUE);
-  } else {
-    md.setM1Speed(-SLOW_TUNE_SPEED_VALUE);
-  }  
-  stopIfFault();
+    return false;
+  }
+  return true;
+}
+
+////////////////////////////////////////
+int tuneResult(int result) {
   
-  // Compare virtual extensions
-  while(true) {
-    
-    if (((moveDirection == MOVE_FORWARDS) && (getExtension() > lowSetpoint)) || ((moveDirection == MOVE_REVERSE) && (getExtension() < highSetpoint))) {
-      // Reached other end of freq zone without a good match so leave it at that
-      break;
-    }
-    
-    // Get the current reflected value
-    ref = analogRead(refPin);
-    
-    if (ref == 0.0) {
-      // We have 1:1
-      // Get new real extension
-      success = true;
-      extension = getExtension();
-      break;
-    }
-      
-    if (refMin == -1.0) {
-      // First time through
-      refMin = ref;
-      vswr = getVSWR();
-    } else {    
-      if (ref < refMin) {
-        // Going in right direction
-        // Remember new minimum
-        refMin = ref;
-        vswr = getVSWR();
-        if (vswr < 1.7) {
-          // Good enough, so do tail end processing
-          success = true;
-          break;
-        }
-        // Get new VSWR minimum real extension
-        extension = getExtension();
-      } else if (ref > refMin+20) {
-        success = true;
-        // Going up so do tail end processing
-        break;
-      }
-    }
-    // Every 100ms: 
-    //  Send the pot readings
-    //  Send the current VSWR
-    //  Send a progress report
-    //  Check for a new command, in particular we might get a stop
-    if ((timeout%100) == 0) {
-      sendPotEvent();
-      sendVSWR(analogRead(fwdPin), analogRead(refPin));     
-      sendProgress(lowSetpoint - highSetpoint , normalisePotValue(getExtension(), REAL_TO_VIRTUAL) - highSetpoint);      
-      if (checkForStop()) {
-        break;
-      }
+  /*
+  * A sweep has finished with TUNE_MATCHED, TUNE_NO_MATCH or TUNE_ABORTED.
+  * Returns STEP_BUSY if a warm tune goes on to the full sweep, otherwise STEP_DONE or STEP_FAILED.
+  */
+  
+  if (tuneMode == TUNE_WINDOW) {
+    if (result == TUNE_MATCHED) {
+      strcpy(taskBuffer, "success:warm");
+      return STEP_DONE;
     }
-    // See if we exceeded a reasonable time for a revolution so we don't get stuck 
-    // if for example the motor is not moving.
-    if (timeout-- <= 0) {
-      strcpy(replyBuffer, "failure:Timeout when executing tune");
-      break;
+    if (result == TUNE_NO_MATCH) {
+      // Not in the window so search the lot
+      strcpy(taskBuffer, "success");
+      tuneMode = TUNE_FALLBACK;
+      sweepBegin(lowSetpoint, highSetpoint);
+      return STEP_BUSY;
     }
-    // Wait LOOP_SLEEP ms so we don't spin too fast. Also timeout takes account of this delay.
-    delay(EX_LOOP_SLEEP);
+    return STEP_FAILED;
   }
- 
-  // Stop the motor
-  doStop();
+  if (result == TUNE_MATCHED) {
+    if (tuneMode == TUNE_FALLBACK)
+      strcpy(taskBuffer, "success:full");
+    return STEP_DONE;
+  }
+  return STEP_FAILED;
+}
+
+////////////////////////////////////////
+int tuneStep() {
   
-  // Tail end processing
-  if (success) {
-    int ref1, ref2;
-    // We went through a minimum, so at least it is tuning
-    // See if we can improve the VSWR
-    if (getVSWR() > 1.7) {
-      // Room for improvement
-      while (true) {
-        ref1 = analogRead(refPin);
-        // Try moving forward a tad
-        doNudge(true, 2);
-        ref2 = analogRead(refPin);
-        if (ref2 < ref1) {
-          // Improved a bit
-          break;
-        } else {
-          ref1 = analogRead(refPin);
-          // Try moving backwards a tad
-          doNudge(false, 2);
-          ref2 = analogRead(refPin);
-          if (ref2 < ref1) {
-            // Improved a bit
-            break;
-          }
-        }
-        delay(MOTOR_DELAY);
-      }
+  /*
+  * One control tick of a tune.
+  * Search for lowest SWR between two extensions
+  *  1. Move to the nearer end at a reasonable speed.
+  *  2. Sweep towards the other end at the coarse speed until the reflected power has come
+  *     down and then risen again by REF_RISE, which brackets the minimum, see sweepStep().
+  *  3. Refine the bracket with a golden-section search, see refineNext().
+  *  4. If the reflected power does not come down then stop at the other end.
+  * Returns STEP_BUSY, STEP_DONE or STEP_FAILED.
+  */
+  
+  int result;
+  float ref;
+  
+  if (tuneState == TUNE_TO_END) {
+    result = moveStep();
+    if (result == STEP_FAILED)
+      return sweepEnd(TUNE_ABORTED);
+    if (result == STEP_DONE)
+      sweepStart();
+    return STEP_BUSY;
+  } else if (tuneState == TUNE_SWEEP) {
+    return sweepStep();
+  } else if (tuneState == TUNE_PROBE) {
+    result = moveStep();
+    if (result == STEP_FAILED)
+      return sweepEnd(TUNE_ABORTED);
+    if (result == STEP_DONE) {
+      // Let it settle before reading
+      probeSettled = millis() + MOTOR_DELAY;
+      tuneState = TUNE_SETTLE;
     }
+    return STEP_BUSY;
+  } else if (tuneState == TUNE_STOPPING) {
+    if ((long)(millis() - probeSettled) < 0)
+      return STEP_BUSY;
+    // The bracket is from the lowest reading to where the sweep came to rest
+    refineStart(rawMin, getPotValue());
+    return STEP_BUSY;
+  }
+  // Settling at a probe
+  if ((long)(millis() - probeSettled) < 0)
+    return STEP_BUSY;
+  ref = getReflected();
+  sendPotEvent();
+  sendVSWR(getForward(), ref);
+  if (refineNext(ref))
+    return STEP_BUSY;
+  return sweepEnd(TUNE_MATCHED);
+}
+
+////////////////////////////////////////
+void sweepBegin(int lowExtension, int highExtension) {
+  
+  /*
+  * Start a sweep by moving to the closest end.
+  * Note: lowExtension is the low frequency end so the higher virtual percent extension
+  */
+  
+  float extension = getExtension();
+  
+  tuneLow = lowExtension;
+  tuneHigh = highExtension;
+  if (extension - highExtension > lowExtension - extension) {
+    // Move to the low frequency end and move reverse from there
+    moveStart(normalisePotValue(lowExtension, VIRTUAL_TO_REAL), FAST_TUNE_SPEED_VALUE, POSITION_TOLERANCE, false);
+    sweepDir = -1;
   } else {
-    strcpy(replyBuffer, "failure:Reached end of search or aborted!");
+    // Move forward from the high frequency end
+    moveStart(normalisePotValue(highExtension, VIRTUAL_TO_REAL), FAST_TUNE_SPEED_VALUE, POSITION_TOLERANCE, false);
+    sweepDir = 1;
+  }
+  tuneState = TUNE_TO_END;
+}
+
+////////////////////////////////////////
+void sweepStart() {
+  
+  /*
+  * At the end, sweep towards the far end giving fwd and ref feedback.
+  * The samples are close together even at the coarse speed, we only need to know where the minimum is.
+  */
+  
+  sweepTimeout = timeoutFor(COARSE_TUNE_SPEED_VALUE);
+  refMin = -1.0;
+  rawMin = 0;
+  descended = false;
+  md.setM1Speed(sweepDir*COARSE_TUNE_SPEED_VALUE);
+  stopIfFault();
+  tuneState = TUNE_SWEEP;
+}
+
+////////////////////////////////////////
+int sweepStep() {
+  
+  /*
+  * One control tick of the coarse sweep, compares virtual extensions
+  */
+  
+  float ref;
+  
+  if (((sweepDir > 0) && (getExtension() > tuneLow)) || ((sweepDir < 0) && (getExtension() < tuneHigh))) {
+    // Reached other end of freq zone without a good match so leave it at that
+    return sweepEnd(TUNE_NO_MATCH);
+  }
+  
+  // Get the current reflected value
+  ref = getReflected();
+  
+  if (ref < matchFloor()) {
+    // We have 1:1 as near as we can tell, nothing to refine
+    return sweepEnd(TUNE_MATCHED);
+  }
+    
+  if (refMin == -1.0) {
+    // First time through
+    refMin = ref;
+    rawMin = getPotValue();
+  } else if (ref < refMin) {
+    // Going in right direction
+    // Remember new minimum
+    refMin = ref;
+    rawMin = getPotValue();
+    descended = true;
+  } else if (ref > refMin + REF_RISE + NOISE_MARGIN*channelNoise[CH_REF]) {
+    // Going up so the minimum is behind us if we came through it,
+    // otherwise the match is outside the span
+    doStop();
+    if (!descended)
+      return sweepEnd(TUNE_NO_MATCH);
+    // Let the motor come to rest before homing in on the minimum, it runs on past it
+    probeSettled = millis() + MOTOR_DELAY;
+    tuneState = TUNE_STOPPING;
+    return STEP_BUSY;
+  }
+  // Every 500ms send a progress report
+  if ((sweepTimeout%100) == 0) {
+    sendProgress(tuneLow - tuneHigh, getExtension() - tuneHigh);      
+  }
+  // See if we exceeded a reasonable time for a revolution so we don't get stuck 
+  // if for example the motor is not moving.
+  if (sweepTimeout-- <= 0) {
+    return sweepEnd(TUNE_ABORTED);
+  }
+  return STEP_BUSY;
+}
+
+////////////////////////////////////////
+int sweepEnd(int result) {
+  
+  /*
+  * Stop the sweep with TUNE_MATCHED, TUNE_NO_MATCH or TUNE_ABORTED and send the final results.
+  * Returns as tuneResult().
+  */
+  
+  // Stop the motor, it may be part way through a move
+  if (moveState != MOVE_IDLE)
+    moveFinish();
+  doStop();
+  if (result != TUNE_MATCHED) {
+    strcpy(taskBuffer, "failure:Reached end of search or aborted!");
   }
   
   // Then send the final results
   sendPotEvent();
-  sendVSWR(analogRead(fwdPin), analogRead(refPin));     
-  sendProgress(lowSetpoint - highSetpoint, 0);
+  sendVSWR(getForward(), getReflected());     
+  sendProgress(tuneLow - tuneHigh, 0);
+  return tuneResult(result);
+}
+
+////////////////////////////////////////
+void refineStart(int rawMin, int rawEnd) {
   
-  // Reset the command timeout value
-  msFullExtensionOrRetraction = (((double)MAX_EXTENSION/(double)MAX_MM_SEC) * ((double)MAX_SPEED_VALUE)/abs((double)speedSetting))*1000.0;
-  COMMAND_TIMEOUT = (int)((msFullExtensionOrRetraction*2.0 )/(double)EX_LOOP_SLEEP);  // speed dependent imeout
+  /*
+  * Golden-section search for the lowest reflected power.
+  * The coarse sweep saw its lowest reading at rawMin and stopped at rawEnd so the minimum
+  * is within rawMin +/- (rawEnd - rawMin). Each probe is a move to an analog value, the
+  * bracket shrinks by the golden ratio for each, and the search ends after REFINE_MOVES
+  * probes or when the bracket is under REFINE_RESOLUTION analog steps.
+  * Leaves the actuator at the lowest reading found.
+  */
+  
+  int span = abs(rawEnd - rawMin);
+  
+  goldA = max(rawMin - span, minCapSetpoint);
+  goldB = min(rawMin + span, maxCapSetpoint);
+  goldC = goldB - GOLDEN_RATIO*(goldB - goldA);
+  goldD = goldA + GOLDEN_RATIO*(goldB - goldA);
+  refinePhase = REFINE_FIRST;
+  probeStart(goldC);
+}
+
+////////////////////////////////////////
+bool refineNext(float ref) {
+  
+  /*
+  * Take the reflected reading at the last probe, returns true if another probe is started
+  */
+  
+  if (refinePhase == REFINE_FIRST) {
+    goldFC = ref;
+    refinePhase = REFINE_SECOND;
+    probeStart(goldD);
+    return true;
+  } else if (refinePhase == REFINE_SECOND) {
+    goldFD = ref;
+    goldAtC = false;
+    goldMoves = 2;
+  } else if (refinePhase == REFINE_SHRINK) {
+    if (goldAtC)
+      goldFC = ref;
+    else
+      goldFD = ref;
+    goldMoves++;
+  } else {
+    // At the final position
+    return false;
+  }
+  if (goldMoves < REFINE_MOVES && (goldB - goldA) > REFINE_RESOLUTION && goldFC >= matchFloor() && goldFD >= matchFloor()) {
+    refinePhase = REFINE_SHRINK;
+    if (goldFC < goldFD) {
+      // Minimum is in a..d
+      goldB = goldD;
+      goldD = goldC;
+      goldFD = goldFC;
+      goldC = goldB - GOLDEN_RATIO*(goldB - goldA);
+      goldAtC = true;
+      probeStart(goldC);
+    } else {
+      // Minimum is in c..b
+      goldA = goldC;
+      goldC = goldD;
+      goldFC = goldFD;
+      goldD = goldA + GOLDEN_RATIO*(goldB - goldA);
+      goldAtC = false;
+      probeStart(goldD);
+    }
+    return true;
+  }
+  // Finish on the better of the last two probes
+  refinePhase = REFINE_FINAL;
+  if (goldFC < goldFD && !goldAtC) {
+    probeStart(goldC);
+    return true;
+  } else if (goldFD < goldFC && goldAtC) {
+    probeStart(goldD);
+    return true;
+  }
+  return false;
+}
+
+////////////////////////////////////////
+void probeStart(float raw) {
+  
+  /*
+  * Start a move to an analog value at the slow tune speed, the reading is taken once it settles
+  */
   
-  return success; 
+  moveStart((float)(int)(raw + 0.5), SLOW_TUNE_SPEED_VALUE, POSITION_TOLERANCE, false);
+  tuneState = TUNE_PROBE;
+}
+
+////////////////////////////////////////
+void ditherStart() {
+  
+  /*
+  * Start a dither, probe either side of where we are and step to the lower VSWR
+  */
+  
+  float ratio = getVSWR();
+  
+  if (ratio == 0.0 || ratio > DITHER_LOST_VSWR) {
+    // Too far off to follow
+    ditherLost = true;
+    return;
+  }
+  task = TASK_DITHER;
+  ditherCentre = getPotValue();
+  ditherRatio0 = ratio;
+  ditherPhase = DITHER_PLUS;
+  ditherProbe(ditherCentre + DITHER_STEP);
+}
+
+////////////////////////////////////////
+void ditherProbe(float raw) {
+  
+  /*
+  * Start a move for the dither, small so at the minimum speed
+  */
+  
+  moveStart(raw, MINIMUM_SPEED_VALUE, DITHER_TOLERANCE, false);
+  ditherSettling = false;
+}
+
+////////////////////////////////////////
+int ditherStep() {
+  
+  /*
+  * One control tick of a dither, returns STEP_BUSY, STEP_DONE or STEP_FAILED
+  */
+  
+  int result;
+  float ratio;
+  float shift;
+  
+  if (!isTX()) {
+    // TX has ended so the readings mean nothing
+    ditherAbort();
+    return STEP_FAILED;
+  }
+  if (!ditherSettling) {
+    result = moveStep();
+    if (result != STEP_DONE)
+      return result;
+    if (ditherPhase == DITHER_CENTRE)
+      return ditherDone();
+    // Let it settle before reading
+    ditherSettling = true;
+    ditherSettled = millis() + MOTOR_DELAY;
+    return STEP_BUSY;
+  }
+  if ((long)(millis() - ditherSettled) < 0)
+    return STEP_BUSY;
+  // The probe need not stop exactly on the step, the reading is taken where it did stop
+  ratio = getVSWR();
+  if (ratio == 0.0) {
+    ditherAbort();
+    return STEP_FAILED;
+  }
+  if (ditherPhase == DITHER_PLUS) {
+    ditherPlus = getPotValue();
+    ditherRatioPlus = ratio;
+    ditherPhase = DITHER_MINUS;
+    ditherProbe(ditherCentre - DITHER_STEP);
+    return STEP_BUSY;
+  }
+  // Both sides read, step towards the minimum. A loop that is drifting leaves us a step
+  // behind each time so that step is learnt as the trend and made as well.
+  shift = ditherShift(getPotValue(), ratio, ditherPlus, ditherRatioPlus);
+  ditherTrend = constrain(ditherTrend + DITHER_TREND_GAIN*shift, -DITHER_MAX_MOVE, DITHER_MAX_MOVE);
+  ditherPhase = DITHER_CENTRE;
+  ditherProbe(ditherCentre + constrain(shift + ditherTrend, -DITHER_MAX_MOVE, DITHER_MAX_MOVE));
+  return STEP_BUSY;
+}
+
+////////////////////////////////////////
+float ditherShift(float minus, float ratioMinus, float plus, float ratioPlus) {
+  
+  /*
+  * Analog steps from the centre to the minimum of the parabola through the VSWR at the probes
+  * either side and at the centre, at most DITHER_MAX_MOVE. Near resonance the VSWR rather than
+  * the reflected reading, which flattens off, follows a parabola. If the readings do not curve
+  * up either side the minimum is further away so go the full DITHER_MAX_MOVE downhill.
+  */
+  
+  float slopeMinus;
+  float slopePlus;
+  float shift;
+  
+  if (plus <= ditherCentre || minus >= ditherCentre || ratioPlus == ratioMinus)
+    // A probe did not move or no slope to follow
+    return 0.0;
+  slopeMinus = (ditherRatio0 - ratioMinus)/(ditherCentre - minus);
+  slopePlus = (ratioPlus - ditherRatio0)/(plus - ditherCentre);
+  if (slopePlus <= slopeMinus) {
+    shift = (ratioPlus < ratioMinus) ? DITHER_MAX_MOVE : -DITHER_MAX_MOVE;
+  } else {
+    // The vertex is where the slope, which changes linearly, is zero
+    shift = ((minus + ditherCentre)/2.0 - ditherCentre) - slopeMinus*(plus - minus)/2.0/(slopePlus - slopeMinus);
+  }
+  return constrain(shift, -DITHER_MAX_MOVE, DITHER_MAX_MOVE);
+}
+
+////////////////////////////////////////
+int ditherDone() {
+  
+  /*
+  * At the new centre, lock is lost if well off or not getting any better
+  */
+  
+  float ratio = getVSWR();
+  
+  if (ratio == 0.0 || ratio > DITHER_LOST_VSWR) {
+    ditherLost = true;
+  } else if (ratio > AUTOTUNE_VSWR) {
+    if (++ditherMisses >= DITHER_LOST_COUNT)
+      ditherLost = true;
+  } else {
+    ditherMisses = 0;
+  }
+  if (ditherLost)
+    ditherMisses = 0;
+  // Dither again at once if still off
+  if (ratio > 0.0 && ratio <= AUTOTUNE_VSWR)
+    ditherDue = millis() + DITHER_PERIOD;
+  else
+    ditherDue = millis();
+  return STEP_DONE;
+}
+
+////////////////////////////////////////
+void ditherAbort() {
+  
+  /*
+  * Give way to a command, the motor stops where it is
+  */
+  
+  if (moveState != MOVE_IDLE)
+    moveFinish();
+  task = TASK_NONE;
+  ditherDue = millis() + DITHER_PERIOD;
 }
 
 ////////////////////////////////////////
 void doRelay(int value, boolean energise) {
   // (De)energise relay
   
-  int mode;
+  if (value < 1 || value > MAX_RELAYS) {
+    strcpy(replyBuffer, "failure:Invalid relay");
+    return;
+  }
   if (energise)
-    mode = HIGH;
+    doRelayMask(relayState | (1 << (value-1)));
   else
-    mode = LOW;
-    
-  switch (value) {
-    case 1:
-      digitalWrite(rly1Pin, mode);
-    case 2:
-      digitalWrite(rly2Pin, mode);
-    case 3:
-      digitalWrite(rly3Pin, mode);
-    case 4:
-      digitalWrite(rly4Pin, mode);
+    doRelayMask(relayState & ~(1 << (value-1)));
+  strcpy(replyBuffer, "success");
+}
+
+////////////////////////////////////////
+void doRelayMask(int mask) {
+  // Set every relay at once, bit n-1 of the mask energises relay n
+  
+  for (int i = 0; i < MAX_RELAYS; i++) {
+    if (mask & (1 << i))
+      digitalWrite(relayPins[i], HIGH);
+    else
+      digitalWrite(relayPins[i], LOW);
   }
+  relayState = mask & ((1 << MAX_RELAYS) - 1);
+  sendRelayState();
+}
+
+////////////////////////////////////////
+void sendRelayState() {
+  // Response with the resulting relay state
+  
+  strcpy(replyBuffer, "relays:");
+  itoa(relayState, replyBuffer + strlen(replyBuffer), 10);
 }
 
 //////////////////////////////////////////////////////////////////////////
@@ -1030,27 +2305,14 @@ void doRelay(int value, boolean energise) {
 bool stopIfFault() {
   if (md.getFault())
   {
-    strcpy(replyBuffer, "failure:Motor fault");
+    // Report against the task if one is running
+    strcpy((task != TASK_NONE) ? taskBuffer : replyBuffer, "failure:Motor fault");
     doStop();
     return false;
   }
   return true;
 }
 
-////////////////////////////////////////
-// Interim command check for a stop command
-boolean checkForStop() {
-  int packetSize = queryPacket();
-  // If there's data available, read and execute
-  if (packetSize) {
-    // Read
-    doRead(packetSize); 
-    if (strcmp(packetBuffer, "stop") == 0)
-      return true;
-  }  
-  return false;
-}
-
 ////////////////////////////////////////
 // Set motor running at given speed
 void startMotor(int value) {
@@ -1072,8 +2334,8 @@ void startMotor(int value) {
 // Get VSWR
 float getVSWR() {
   
-  float fwd = analogRead(fwdPin);
-  float ref = analogRead(refPin);
+  float fwd = getForward();
+  float ref = getReflected();
   if ((fwd - ref) > 0.0) {
     return ((fwd + ref)/(fwd - ref));
   } else {
@@ -1090,30 +2352,81 @@ int getPotValue() {
   * Get the current potentiometer reading
   */
   
-  // Averaging causes more issues than not
-  return analogRead(potPin);
+  return (int)(channelValue[CH_POT] + 0.5);
+}
+
+////////////////////////////////////////
+// Get the forward and reflected readings
+float getForward() {
+  
+  return channelValue[CH_FWD];
+}
+
+float getReflected() {
+  
+  return channelValue[CH_REF];
+}
+
+////////////////////////////////////////
+// Check for RF
+bool isTX() {
+  
+  return channelValue[CH_FWD] > RF_DETECT;
+}
+
+////////////////////////////////////////
+// Reflected reading we cannot tell from a match
+float matchFloor() {
+  
+  /*
+  * A reading this low is 1:1 as far as the bridge and the noise on it can tell
+  */
+  
+  return RF_DETECT + channelNoise[CH_REF];
+}
+
+////////////////////////////////////////
+// Read the analog channels
+void acquire() {
   
   /*
-  int i;
-  int arraySum = 0;
-  
-  if (potFirstRun) {
-    potFirstRun = false;
-    // Do 10 readings to fill up the array
-    for(i=0;i<10;i++) {
-     potArray[i] = analogRead(potPin);
-    }    
-   } else {
-    potArray[potIndex++] = analogRead(potPin);
-    if (potIndex > 9)
-      potIndex = 0;
-   } 
-
-  for(i=0;i<10;i++) {
-    arraySum = arraySum + potArray[i];    
-  }
-  return arraySum/10;
+  * Take a reading of each channel, see Analog acquisition.
+  * Each conversion is around 0.1ms so this adds around 1.5ms to the control tick.
   */
+  
+  int burst[OVERSAMPLE];
+  int i, j, sample;
+  float reading;
+  float spread;
+  
+  for (int ch = 0; ch < CHANNELS; ch++) {
+    // Take the burst, sorted as it comes in
+    for (i = 0; i < OVERSAMPLE; i++) {
+      sample = analogRead(channelPins[ch]);
+      for (j = i; j > 0 && burst[j-1] > sample; j--)
+        burst[j] = burst[j-1];
+      burst[j] = sample;
+    }
+    // Decimate
+    if (channelFilter[ch] == FILTER_MEDIAN) {
+      reading = burst[OVERSAMPLE/2];
+    } else {
+      reading = 0.0;
+      for (i = 0; i < OVERSAMPLE; i++)
+        reading += burst[i];
+      reading /= OVERSAMPLE;
+    }
+    spread = (burst[OVERSAMPLE-1] - burst[0])/2.0;
+    // Smooth
+    if (!channelPrimed) {
+      channelValue[ch] = reading;
+      channelNoise[ch] = spread;
+    } else {
+      channelValue[ch] += channelSmoothing[ch]*(reading - channelValue[ch]);
+      channelNoise[ch] += NOISE_SMOOTHING*(spread - channelNoise[ch]);
+    }
+  }
+  channelPrimed = true;
 }
 
 ////////////////////////////////////////
@@ -1138,7 +2451,7 @@ float getExtension() {
 
 ////////////////////////////////////////
 // Normalise pot value to an extension %
-float normalisePotValue(int value, bool real_to_virtual) {
+float normalisePotValue(float value, bool real_to_virtual) {
  
  // The host deals in 0 - 100 % extension which is fully unmeshed to fully meshed
  // i.e min to max capacitance. This muat be mapped to the actual values for min 
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# bandwidth.py
+#
+# Loop bandwidth measurement for the Mag Loop application
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import threading
+
+# Application imports
+from common.defs import *
+from common import vswr
+
+"""
+A loop has a high Q so its 2:1 VSWR bandwidth is narrow and varies a great deal across
+its range. The bandwidth is measured from the pot and VSWR events sent during a tune
+sweep. The sweep gives the 2:1 width in % extension, which the slope of the setpoint
+curve turns into kHz. The widths are kept per loop as {'MHz string': kHz} at
+I_BANDWIDTH in LOOP_SETTINGS and set the tracking dead-band, see deadband().
+"""
+class BandwidthSweep:
+
+    def __init__(self):
+        """ Constructor """
+
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Start a new sweep """
+
+        with self.__lock:
+            self.__samples = []         # [(% extension, vswr), ...] in arrival order
+            self.__extension = None     # Last reported extension
+
+    def pot(self, extension):
+        """
+        Pot event
+
+        Arguments:
+            extension   --  % extension
+
+        """
+
+        self.__extension = float(extension)
+
+    def vswr(self, forward, reflected):
+        """
+        VSWR event, paired with the last pot event
+
+        Arguments:
+            forward     --  relative forward power
+            reflected   --  relative reflected power
+
+        """
+
+        v = vswr.getVSWR(forward, reflected)
+        with self.__lock:
+            if v != None and self.__extension != None:
+                self.__samples.append((self.__extension, v))
+
+    def width(self, threshold = BANDWIDTH_VSWR):
+        """
+        Return the width in % extension over which VSWR is below threshold or None.
+        If the sweep crossed the threshold on one side only the loop is taken as symmetric.
+
+        Arguments:
+            threshold   --  VSWR defining the band edges
+
+        """
+
+        with self.__lock:
+            samples = self.__byExtension(self.__samples)
+        if len(samples) < 2:
+            return None
+        best = min(range(len(samples)), key=lambda i: samples[i][1])
+        if samples[best][1] >= threshold:
+            # Never matched
+            return None
+        centre = samples[best][0]
+        lower = self.__crossing(samples, best, -1, threshold)
+        upper = self.__crossing(samples, best, 1, threshold)
+        if lower != None and upper != None:
+            return abs(upper - lower)
+        if lower != None:
+            return 2.0*abs(centre - lower)
+        if upper != None:
+            return 2.0*abs(upper - centre)
+        return None
+
+    def __byExtension(self, samples):
+        """
+        Return the samples in extension order. A search probes out of order and may come
+        back to an extension so the readings at each extension are averaged.
+
+        Arguments:
+            samples --  [(% extension, vswr), ...] in arrival order
+
+        """
+
+        readings = {}
+        for extension, v in samples:
+            readings.setdefault(extension, []).append(v)
+        return [(extension, sum(vs)/len(vs)) for extension, vs in sorted(readings.items())]
+
+    def __crossing(self, samples, best, step, threshold):
+        """ Extension where VSWR crosses threshold walking from the minimum in the given direction """
+
+        i = best
+        while 0 <= i + step < len(samples):
+            e0, v0 = samples[i]
+            e1, v1 = samples[i + step]
+            if v1 >= threshold:
+                # Interpolate between the samples either side of the threshold
+                if v1 == v0:
+                    return e1
+                return e0 + (e1 - e0)*(threshold - v0)/(v1 - v0)
+            i += step
+        return None
+
+def toKHz(width, curve, freqKHz):
+    """
+    Convert a width in % extension to kHz at a frequency or None
+
+    Arguments:
+        width   --  width in % extension
+        curve   --  SetpointCurve for the loop
+        freqKHz --  frequency of the measurement in kHz
+
+    """
+
+    if width == None or len(curve) < 2:
+        return None
+    # Slope of the setpoint curve in % extension per kHz
+    slope = (curve.extension(freqKHz + 1.0) - curve.extension(freqKHz - 1.0))/2.0
+    if slope == 0.0:
+        return None
+    return width/abs(slope)
+
+def deadband(bandwidthKHz):
+    """
+    Return the retune dead-band in Hz for a 2:1 bandwidth in kHz, None gives the default
+
+    Arguments:
+        bandwidthKHz    --  2:1 VSWR bandwidth in kHz or None
+
+    """
+
+    if bandwidthKHz == None:
+        return DEADBAND_DEFAULT
+    return min(max(bandwidthKHz*1000.0*DEADBAND_FRACTION, DEADBAND_MIN), DEADBAND_MAX)
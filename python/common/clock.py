@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# clock.py
+#
+# Real and virtual clocks for the Mag Loop application
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import time
+import heapq
+
+"""
+Time for components which can be run against a replayed trace. They read the time and
+wait through a clock rather than calling monotonic() and sleep() directly. The real clock
+is the default, the virtual clock jumps forward instead of waiting so a trace replays as
+fast as the code can run and always gives the same result. Anything which would happen
+on another thread in real time, such as an unsolicited CAT frame, is scheduled on the
+virtual clock with call_at() and runs from within wait().
+"""
+class RealClock:
+
+    def monotonic(self):
+        """ Seconds from an arbitrary start """
+
+        return time.monotonic()
+
+    def wait(self, event, timeout):
+        """
+        Wait for the event or the timeout, returns True if the event was set
+
+        Arguments:
+            event   --  threading.Event which cuts short the wait
+            timeout --  seconds to wait
+
+        """
+
+        return event.wait(timeout)
+
+class VirtualClock:
+
+    def __init__(self, start = 0.0):
+        """
+        Constructor
+
+        Arguments:
+            start   --  initial time in seconds
+
+        """
+
+        self.__now = start
+        self.__timers = []          # Heap of (time, sequence, function)
+        self.__sequence = 0
+
+    def monotonic(self):
+        """ Seconds of virtual time """
+
+        return self.__now
+
+    def advance(self, seconds):
+        """
+        Move time forward
+
+        Arguments:
+            seconds --  seconds to advance
+
+        """
+
+        self.__now += seconds
+
+    def call_at(self, t, fn):
+        """
+        Call a function when the clock reaches a time
+
+        Arguments:
+            t   --  time in seconds
+            fn  --  function to call, no arguments
+
+        """
+
+        heapq.heappush(self.__timers, (t, self.__sequence, fn))
+        self.__sequence += 1
+
+    def wait(self, event, timeout):
+        """
+        Return at once if the event is set, otherwise advance by the timeout running
+        any functions due in that time, stopping early if one of them sets the event
+
+        Arguments:
+            event   --  threading.Event which cuts short the wait
+            timeout --  seconds to wait
+
+        """
+
+        end = self.__now + timeout
+        while not event.is_set() and len(self.__timers) > 0 and self.__timers[0][0] <= end:
+            t, _, fn = heapq.heappop(self.__timers)
+            self.__now = max(self.__now, t)
+            fn()
+        if event.is_set():
+            return True
+        self.__now = end
+        return False
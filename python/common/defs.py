@@ -35,6 +35,8 @@ import os,sys
 FT_817ND = 'FT-817ND'
 IC7100 = 'IC7100'
 CAT_VARIANTS = [FT_817ND, IC7100]
+# Variants which report frequency changes unsolicited (CI-V transceive)
+CAT_TRANSCEIVE = [IC7100]
 YAESU = 'YAESU'
 ICOM = 'ICOM'
 
@@ -106,6 +108,8 @@ CAT_MODE_GET = 'catmodeget'
 # Paths to state and configuration files
 SETTINGS_PATH = os.path.join('..', '..', 'settings', 'magcontrol.cfg')
 STATE_PATH = os.path.join('..', '..', 'settings', 'state.cfg')
+# CAT frequency traces are recorded while tracking if this directory exists
+TRACE_DIR = os.path.join('..', '..', 'traces')
 
 # Constants for settings
 ARDUINO_SETTINGS = 'arduinosettings'
@@ -121,6 +125,10 @@ VARIANT = 'variant'
 CAT_UDP = 'catudp'
 CAT_SERIAL = 'catserial'
 SELECTED_LOOP = 'selectedloop'
+STATIONS = 'stations'
+STATION_LOOP = 'stationloop'
+TRACK_MODE = 'trackmode'
+LEARN = 'learn'
 LOOP_PARAMS = 'loopparams'
 LOCATION = 'location'
 LIMITS = 'limits'
@@ -128,6 +136,10 @@ WINDOW = 'window'
 X_POS = 'xpos'
 Y_POS = 'ypos'
 
+# Tracking modes
+TRACK_FOLLOW = 'follow'     # Move to the current frequency
+TRACK_CHASE = 'chase'       # Move to where the frequency will be when the move completes
+
 # Index into settings list
 I_POT = 0
 I_MINCAP = 0
@@ -149,6 +161,8 @@ I_OFFSETS = 5
 I_LOW_FREQ = 0
 I_HIGH_FREQ = 1
 
+I_BANDWIDTH = 6
+
 # Index into comms parameters
 IP = 0
 PORT = 1
@@ -173,13 +187,66 @@ MOTOR_TUNE_SLOW = 25
 
 # Nudge forward or reverse 5 degrees
 MOTOR_NUDGE = 5
+# Actuator travel in % extension per second at MAX_SPEED (100mm at 10mm/s)
+MAX_SPEED = 400
+ACTUATOR_RATE = 10.0
+# Seconds added to every move for the command, stop and final nudges
+ACTUATOR_OVERHEAD = 0.5
 # Buffer size
 RECEIVE_BUFFER = 512
 # Timeout for responses and events
 CONTROLLER_TIMEOUT = 1
+# Timeout for a tune reply, a full sweep at the slow tune speed takes tens of seconds
+TUNE_TIMEOUT = 90
+# Timeout for a move reply, a full travel at the slowest speed
+MOVE_TIMEOUT = 60
+# Telemetry periods in ms of the TX state, VSWR and pot position, 0 for off
+# While idle, the VSWR is only sent when transmitting
+TELEMETRY_IDLE = (1000, 200, 1000)
+# While a move or tune is running, 50 Hz to follow a tune sweep
+TELEMETRY_BUSY = (200, 20, 20)
 
 # Arduino event port on which we listen
 EVENT_PORT = 8889
+# Maximum commands in flight on a pipelined link
+PIPELINE_WINDOW = 4
+
+# ======================================================================================
+# DISPATCHER
+
+# Command priority classes, lower is more urgent
+PRIORITY_STOP = 0           # Emergency stop, preempts everything
+PRIORITY_INTERACTIVE = 1    # User actions and configuration
+PRIORITY_TRACKING = 2       # RX tracking moves
+PRIORITY_BACKGROUND = 3     # Periodic queries
+
+# Maximum queued commands
+COMMAND_QUEUE_SIZE = 20
+
+# Default seconds a command may wait in the queue before it is discarded (None = forever)
+COMMAND_DEADLINES = {
+    PRIORITY_STOP: None,
+    PRIORITY_INTERACTIVE: None,
+    PRIORITY_TRACKING: 2.0,
+    PRIORITY_BACKGROUND: 10.0,
+}
+
+# What to do with a command when the queue is full
+OVERFLOW_REJECT = 'reject'          # Refuse the new command
+OVERFLOW_DROP_OLDEST = 'dropoldest' # Evict the oldest queued command of the same or lower priority
+OVERFLOW_COALESCE = 'coalesce'      # Replace the newest queued command of the same priority
+OVERFLOW_BLOCK = 'block'            # Wait for space up to a timeout, then refuse
+
+# Default overflow policy for each priority class
+# Commands which cannot be preempted (configuration) always use OVERFLOW_DROP_OLDEST
+OVERFLOW_POLICIES = {
+    PRIORITY_INTERACTIVE: OVERFLOW_REJECT,
+    PRIORITY_TRACKING: OVERFLOW_COALESCE,
+    PRIORITY_BACKGROUND: OVERFLOW_DROP_OLDEST,
+}
+
+# Seconds to wait for space with OVERFLOW_BLOCK
+OVERFLOW_BLOCK_TIMEOUT = 0.5
 
 # ======================================================================================
 # DEFAULT STRUCTURES
@@ -209,6 +276,8 @@ DEFAULT_SETTINGS = {
     #           -- Loop range --
     #           -- Min freq extension %, max freq extension %
     #           [min cap extension %, max cap extension %]
+    #           -- Measured 2:1 VSWR bandwidth in kHz (optional) --
+    #           {1.9 : 8.5, 2.0 : 9.2, ...},
     #          ],
     #   name: [...],
     #    
@@ -225,12 +294,24 @@ DEFAULT_SETTINGS = {
             '', '9600'
         ],
         SELECT: CAT_SERIAL #CAT_UDP | CAT_SERIAL
-    }        
+    },
+    
+    STATIONS: [
+    # Further radios tracked headless, each feeding a loop from LOOP_SETTINGS (optional)
+    #   {
+    #       STATION_LOOP: loop name,
+    #       NETWORK: [controller ip, controller port],
+    #       CAT_SETTINGS: {as CAT_SETTINGS above},
+    #   },
+    #   {...},
+    ],
 }
 
 DEFAULT_STATE  = {
     WINDOW: {X_POS: 100, Y_POS: 100},
     SELECTED_LOOP: None,
+    TRACK_MODE: TRACK_FOLLOW,
+    LEARN: False,
 }
 
 # ======================================================================================
@@ -280,9 +361,42 @@ MOTOR_DEG_FROM_HOME = 2
 
 # Tracking message types
 TRACKING_TO_DEGS = 'trackingtodegs'
+TRACKING_TO_FREQ = 'trackingtofreq'
 TRACKING_ERROR = 'trackingerror'
 TRACKING_UPDATE = 'trackingupdate'
 
+# Setpoint interpolation
+INTERP_LINEAR = 'linear'
+INTERP_PCHIP = 'pchip'
+TRACKING_INTERPOLATION = INTERP_LINEAR
+
+# Velocity estimate from the last n CAT samples no older than n seconds
+CHASE_SAMPLES = 5
+CHASE_AGE = 1.0
+# Below this VFO rate in Hz/s chase behaves as follow
+CHASE_MIN_VELOCITY = 500.0
+# Upper bounds of the lag histogram buckets in % extension
+LAG_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50)
+
+# Retune dead-band
+BANDWIDTH_VSWR = 2.0        # VSWR at the band edges of a measured bandwidth
+DEADBAND_FRACTION = 0.25    # Retune when the frequency moves this fraction of the bandwidth
+DEADBAND_MIN = 500          # Hz
+DEADBAND_MAX = 50000        # Hz
+DEADBAND_DEFAULT = 10000    # Hz when the bandwidth has not been measured
+
+# Setpoint learning from tune results
+LEARN_RATE = 0.5            # Fraction of the way a perfect result moves a setpoint
+LEARN_VSWR_MAX = 2.0        # Results at or above this VSWR are ignored
+LEARN_ADD_QUALITY = 0.6     # Quality needed to add a setpoint, see learning.quality()
+LEARN_MERGE_FRACTION = 0.001    # Results within this fraction of the frequency update a setpoint
+
+# Warm start tuning, search +/- % extension around the predicted extension
+WARM_WINDOW = 8             # Predicted from the setpoints
+WARM_WINDOW_CACHED = 3      # Predicted from a recent tune close to the frequency
+TUNE_CACHE_SIZE = 20        # Recent tune results kept
+TUNE_CACHE_AGE = 1800       # Seconds a tune result is trusted
+
 # ======================================================================================
 # AUTO-CONFIGURE
 
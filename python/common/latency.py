@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# latency.py
+#
+# Latency histograms for the Mag Loop application
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import threading
+
+"""
+Fixed bucket histograms. These are cheap enough to update on every command and
+can be read at any time from any thread. Values are held in the units given by
+the caller, for latencies this is milliseconds.
+"""
+
+# Upper bounds of the latency buckets in ms, anything above the last goes in the overflow bucket
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+class Histogram:
+
+    def __init__(self, bounds = LATENCY_BUCKETS):
+        """
+        Constructor
+
+        Arguments:
+            bounds  --  ascending upper bounds of each bucket
+
+        """
+
+        self.__bounds = tuple(bounds)
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Clear all recorded values """
+
+        with self.__lock:
+            # One extra bucket for values above the last bound
+            self.__counts = [0] * (len(self.__bounds) + 1)
+            self.__count = 0
+            self.__sum = 0.0
+            self.__min = None
+            self.__max = None
+
+    def record(self, value):
+        """
+        Record a value
+
+        Arguments:
+            value   --  value to record in the histogram units
+
+        """
+
+        with self.__lock:
+            index = len(self.__bounds)
+            for i, bound in enumerate(self.__bounds):
+                if value <= bound:
+                    index = i
+                    break
+            self.__counts[index] += 1
+            self.__count += 1
+            self.__sum += value
+            if self.__min == None or value < self.__min: self.__min = value
+            if self.__max == None or value > self.__max: self.__max = value
+
+    def count(self):
+        """ Number of recorded values """
+
+        return self.__count
+
+    def percentile(self, pc):
+        """
+        Approximate percentile, returned as the upper bound of the bucket
+        containing the percentile. The overflow bucket returns the maximum.
+
+        Arguments:
+            pc  --  percentile 0-100
+
+        """
+
+        with self.__lock:
+            return self.__percentile(pc)
+
+    def snapshot(self):
+        """ Return a consistent copy of the histogram as a dictionary """
+
+        with self.__lock:
+            return {
+                'count': self.__count,
+                'min': self.__min,
+                'max': self.__max,
+                'mean': (self.__sum / self.__count) if self.__count > 0 else None,
+                'p50': self.__percentile(50),
+                'p90': self.__percentile(90),
+                'p99': self.__percentile(99),
+                'buckets': list(zip(self.__bounds + (None,), self.__counts)),
+            }
+
+    def __percentile(self, pc):
+        """ Percentile, caller holds the lock """
+
+        if self.__count == 0:
+            return None
+        target = self.__count * pc / 100.0
+        running = 0
+        for i, n in enumerate(self.__counts):
+            running += n
+            if running >= target and n > 0:
+                if i < len(self.__bounds):
+                    return min(self.__bounds[i], self.__max)
+                return self.__max
+        return self.__max
+
+def summary(snapshot, units = 'ms', places = 0):
+    """
+    Return a one line description of a histogram snapshot
+
+    Arguments:
+        snapshot    --  as returned by Histogram.snapshot()
+        units       --  units of the values
+        places      --  decimal places shown
+
+    """
+
+    if snapshot['count'] == 0:
+        return 'none'
+    values = ['%.*f' % (places, snapshot[key]) for key in ('p50', 'p90', 'p99', 'max')]
+    return '%d, p50 %s p90 %s p99 %s max %s %s' % tuple([snapshot['count']] + values + [units])
+
+class CommandLatency:
+
+    def __init__(self):
+        """
+        Constructor
+
+        Holds a pair of histograms for each command name:
+            wait    --  enqueue to start of execution
+            run     --  start to completion of execution
+
+        """
+
+        self.__lock = threading.Lock()
+        self.__commands = {}
+
+    def record(self, name, waitMs, runMs):
+        """
+        Record the latencies for one command execution
+
+        Arguments:
+            name    --  command name
+            waitMs  --  ms from enqueue to start
+            runMs   --  ms from start to completion
+
+        """
+
+        with self.__lock:
+            if name not in self.__commands:
+                self.__commands[name] = (Histogram(), Histogram())
+            wait, run = self.__commands[name]
+        wait.record(waitMs)
+        run.record(runMs)
+
+    def reset(self):
+        """ Clear all commands """
+
+        with self.__lock:
+            self.__commands = {}
+
+    def snapshot(self):
+        """ Return {name: {'wait': snapshot, 'run': snapshot}, ...} """
+
+        with self.__lock:
+            commands = dict(self.__commands)
+        return {name: {'wait': wait.snapshot(), 'run': run.snapshot()} for name, (wait, run) in commands.items()}
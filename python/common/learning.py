@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# learning.py
+#
+# Setpoint refinement from tune results for the Mag Loop application
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+from time import monotonic
+from collections import deque
+
+# Application imports
+from common.defs import *
+
+"""
+A successful tune ends at the best extension for the frequency. When learning is on the
+result is folded into the loop's setpoints so the next tracking move lands on resonance.
+
+A result close to an existing setpoint moves that setpoint part of the way towards it.
+The fraction is LEARN_RATE scaled by how good a match the tune found, so a poor match
+barely counts, and as each result moves the setpoint a fraction of the way the older
+results count for less and less. A good result away from any setpoint adds a new one.
+
+Recent results also give a warm start for the next tune. The search is narrowed to a
+window around the extension predicted from a recent tune close to the frequency, or
+failing that from the setpoints, see warmStart().
+"""
+
+def quality(ratio):
+    """
+    Return 1.0 for a perfect match falling to 0.0 at LEARN_VSWR_MAX
+
+    Arguments:
+        ratio   --  VSWR at the end of the tune, None if not measured
+
+    """
+
+    if ratio == None:
+        return 0.0
+    return min(1.0, max(0.0, (LEARN_VSWR_MAX - ratio)/(LEARN_VSWR_MAX - 1.0)))
+
+def learn(setpoints, freqMHz, extension, ratio):
+    """
+    Fold a tune result into the setpoints, returns (key, new extension) or None if ignored
+
+    Arguments:
+        setpoints   --  {MHz string: extension %, ...} updated in place
+        freqMHz     --  frequency tuned
+        extension   --  % extension the tune finished at
+        ratio       --  VSWR at the end of the tune
+
+    """
+
+    q = quality(ratio)
+    if q == 0.0:
+        return None
+    # The nearest setpoint close enough to stand for this frequency
+    nearest = None
+    for key in setpoints.keys():
+        distance = abs(float(key) - freqMHz)
+        if distance <= freqMHz*LEARN_MERGE_FRACTION and (nearest == None or distance < abs(float(nearest) - freqMHz)):
+            nearest = key
+    if nearest != None:
+        current = float(setpoints[nearest])
+        setpoints[nearest] = int(round(current + LEARN_RATE*q*(float(extension) - current)))
+        return nearest, setpoints[nearest]
+    if q < LEARN_ADD_QUALITY:
+        # Not good enough to stand alone
+        return None
+    key = str(round(freqMHz, 3))
+    setpoints[key] = int(round(float(extension)))
+    return key, setpoints[key]
+
+def warmStart(curve, cache, freq, deadband):
+    """
+    Return (predicted % extension, window % extension) for a tune or None for a full sweep
+
+    Arguments:
+        curve       --  setpoints.SetpointCurve for the loop
+        cache       --  TuneCache of recent results for the loop
+        freq        --  frequency in Hz
+        deadband    --  Hz either side within which a recent result stands for freq
+
+    """
+
+    extension = cache.nearest(freq, deadband)
+    if extension != None:
+        return int(round(extension)), WARM_WINDOW_CACHED
+    if len(curve) == 0:
+        return None
+    return int(round(curve.extension(freq/1000.0))), WARM_WINDOW
+
+class TuneCache:
+
+    def __init__(self, size = TUNE_CACHE_SIZE, age = TUNE_CACHE_AGE):
+        """
+        Constructor
+
+        Arguments:
+            size    --  results kept
+            age     --  seconds a result is trusted
+
+        """
+
+        self.__results = deque(maxlen=size)
+        self.__age = age
+
+    def reset(self):
+        """ Forget all results, the loop has changed """
+
+        self.__results.clear()
+
+    def add(self, freq, extension):
+        """
+        Add a tune result
+
+        Arguments:
+            freq        --  frequency in Hz
+            extension   --  % extension the tune finished at
+
+        """
+
+        self.__results.append((monotonic(), freq, float(extension)))
+
+    def nearest(self, freq, within):
+        """
+        Return the extension of the most recent result within Hz of freq or None
+
+        Arguments:
+            freq    --  frequency in Hz
+            within  --  Hz either side
+
+        """
+
+        now = monotonic()
+        for t, f, extension in reversed(self.__results):
+            if now - t <= self.__age and abs(f - freq) <= within:
+                return extension
+        return None
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# motion.py
+#
+# VFO and actuator motion models for the Mag Loop application
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+from collections import deque
+
+# Application imports
+from common.defs import *
+
+"""
+Models used by predictive tracking.
+
+The VelocityEstimator fits a straight line through the most recent CAT frequency samples
+to give the rate at which the operator is tuning. The ActuatorModel estimates where the
+actuator is from the moves commanded, so tracking can tell how long a move will take and
+how far the antenna lags the frequency.
+"""
+class VelocityEstimator:
+
+    def __init__(self, samples = CHASE_SAMPLES, age = CHASE_AGE):
+        """
+        Constructor
+
+        Arguments:
+            samples --  maximum samples in the fit
+            age     --  seconds after which a sample is ignored
+
+        """
+
+        self.__samples = deque(maxlen=samples)
+        self.__age = age
+
+    def reset(self):
+        """ Forget all samples """
+
+        self.__samples.clear()
+
+    def add(self, t, freq):
+        """
+        Add a sample
+
+        Arguments:
+            t       --  time in seconds
+            freq    --  frequency in Hz
+
+        """
+
+        self.__samples.append((t, freq))
+
+    def velocity(self, now):
+        """
+        Return the frequency velocity in Hz/s or 0.0 if there are too few recent samples
+
+        Arguments:
+            now --  time in seconds
+
+        """
+
+        samples = [(t, freq) for t, freq in self.__samples if now - t <= self.__age]
+        n = len(samples)
+        if n < 2:
+            return 0.0
+        # Least squares slope, relative to the first sample to keep the sums small
+        t0, f0 = samples[0]
+        mt = sum(t - t0 for t, _ in samples)/n
+        mf = sum(freq - f0 for _, freq in samples)/n
+        stt = sum((t - t0 - mt)**2 for t, _ in samples)
+        if stt == 0.0:
+            return 0.0
+        stf = sum((t - t0 - mt)*(freq - f0 - mf) for t, freq in samples)
+        return stf/stt
+
+class ActuatorModel:
+
+    def __init__(self, rate = ACTUATOR_RATE, overhead = ACTUATOR_OVERHEAD):
+        """
+        Constructor
+
+        Arguments:
+            rate        --  travel in % extension per second
+            overhead    --  seconds added to every move for command, stop and settle
+
+        """
+
+        self.__rate = rate
+        self.__overhead = overhead
+        self.reset()
+
+    def reset(self):
+        """ Position unknown """
+
+        self.__start = None         # Position when the current move was commanded
+        self.__target = None        # Target of the current move
+        self.__t = None             # Time the current move was commanded
+
+    def set_rate(self, rate):
+        """
+        Change the rate of travel
+
+        Arguments:
+            rate    --  travel in % extension per second
+
+        """
+
+        self.__rate = rate
+
+    def move_time(self, frm, to):
+        """
+        Seconds for a move, frm None is an unknown position and assumes no travel
+
+        Arguments:
+            frm --  start % extension
+            to  --  target % extension
+
+        """
+
+        if frm == None or self.__rate <= 0:
+            return self.__overhead
+        return self.__overhead + abs(to - frm)/self.__rate
+
+    def command(self, t, target):
+        """
+        A move has been commanded
+
+        Arguments:
+            t       --  time in seconds
+            target  --  target % extension
+
+        """
+
+        self.__start = self.position(t)
+        self.__target = target
+        self.__t = t
+
+    def retarget_saving(self, t, target):
+        """
+        Seconds saved by changing the target of the current move rather than
+        letting it complete and then moving to the new target
+
+        Arguments:
+            t       --  time in seconds
+            target  --  new target % extension
+
+        """
+
+        position = self.position(t)
+        if position == None or self.__rate <= 0:
+            return 0.0
+        old = self.__target
+        complete = abs(old - position)/self.__rate
+        restart = self.__overhead + abs(target - old)/self.__rate
+        direct = abs(target - position)/self.__rate
+        return max(0.0, complete + restart - direct)
+
+    def target(self):
+        """ Target of the last move or None """
+
+        return self.__target
+
+    def position(self, t):
+        """
+        Estimated % extension or None if unknown
+
+        Arguments:
+            t   --  time in seconds
+
+        """
+
+        if self.__target == None:
+            return None
+        if self.__start == None:
+            # First move, we only know where it ends
+            return self.__target
+        # Travel starts after the overhead, taken as all up front
+        travelled = max(0.0, t - self.__t - self.__overhead)*self.__rate
+        if travelled >= abs(self.__target - self.__start):
+            return self.__target
+        if self.__target > self.__start:
+            return self.__start + travelled
+        return self.__start - travelled
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# setpoints.py
+#
+# Setpoint interpolation for the Mag Loop application
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+from bisect import bisect_right
+
+# Application imports
+from common.defs import *
+
+"""
+The setpoints for a loop are held in the configuration as {'MHz string': extension, ...}.
+A SetpointCurve compiles these once into sorted arrays so the extension for a frequency
+is found by bisection rather than by scanning and converting every setpoint.
+
+Between setpoints the extension is interpolated either linearly or with a monotone
+piecewise cubic (PCHIP) which follows the curve of a loop more closely but never
+overshoots the setpoints either side. Outside the setpoints the nearest setpoint is used.
+"""
+class SetpointCurve:
+
+    def __init__(self, setpoints, mode = INTERP_LINEAR):
+        """
+        Constructor
+
+        Arguments:
+            setpoints   --  {'MHz string': extension, ...} as I_SETPOINTS in LOOP_SETTINGS
+            mode        --  INTERP_LINEAR | INTERP_PCHIP
+
+        """
+
+        if mode not in (INTERP_LINEAR, INTERP_PCHIP):
+            raise ValueError('Unknown interpolation mode %s' % mode)
+        self.__mode = mode
+
+        # Setpoints as ascending kHz with the extension at each
+        points = sorted({float(freq)*1000.0: float(extension) for freq, extension in setpoints.items()}.items())
+        self.__freqs = [freq for freq, _ in points]
+        self.__extensions = [extension for _, extension in points]
+        self.__slopes = None
+        if mode == INTERP_PCHIP and len(points) > 2:
+            self.__slopes = self.__pchipSlopes()
+
+    def __len__(self):
+        """ Number of setpoints """
+
+        return len(self.__freqs)
+
+    def mode(self):
+        """ Interpolation mode """
+
+        return self.__mode
+
+    def extension(self, freqKHz):
+        """
+        Return the extension for a frequency or None if there are no setpoints
+
+        Arguments:
+            freqKHz --  frequency in kHz
+
+        """
+
+        freqs = self.__freqs
+        n = len(freqs)
+        if n == 0:
+            return None
+        # Index of the first setpoint above the frequency
+        i = bisect_right(freqs, freqKHz)
+        if i == 0:
+            # Below the lowest setpoint
+            return self.__extensions[0]
+        if i == n:
+            # At or above the highest setpoint
+            return self.__extensions[n-1]
+        lower = i - 1
+        h = freqs[i] - freqs[lower]
+        t = (freqKHz - freqs[lower])/h
+        y0 = self.__extensions[lower]
+        y1 = self.__extensions[i]
+        if self.__slopes == None:
+            return y0 + t*(y1 - y0)
+        # Cubic Hermite between the two setpoints
+        t2 = t*t
+        t3 = t2*t
+        return (2*t3 - 3*t2 + 1)*y0 + (t3 - 2*t2 + t)*h*self.__slopes[lower] + (-2*t3 + 3*t2)*y1 + (t3 - t2)*h*self.__slopes[i]
+
+    def table(self, limit):
+        """
+        Return [(Hz, extension), ...] ascending which interpolated linearly follows the
+        curve, for a controller which interpolates itself, or None if it needs more points.
+        A PCHIP curve is divided into equal steps between setpoints as far as the limit allows.
+
+        Arguments:
+            limit   --  most points
+
+        """
+
+        n = len(self.__freqs)
+        if n > limit:
+            return None
+        steps = 1
+        if self.__slopes != None:
+            steps = max(1, (limit - 1)//(n - 1))
+        points = []
+        for k in range(n):
+            points.append((int(round(self.__freqs[k]*1000.0)), self.__extensions[k]))
+            if k == n - 1:
+                break
+            h = self.__freqs[k+1] - self.__freqs[k]
+            for step in range(1, steps):
+                freq = self.__freqs[k] + h*step/steps
+                points.append((int(round(freq*1000.0)), self.extension(freq)))
+        return points
+
+    def __pchipSlopes(self):
+        """ Fritsch-Carlson slopes which keep each interval monotone """
+
+        freqs = self.__freqs
+        extensions = self.__extensions
+        n = len(freqs)
+        h = [freqs[k+1] - freqs[k] for k in range(n-1)]
+        delta = [(extensions[k+1] - extensions[k])/h[k] for k in range(n-1)]
+        slopes = [0.0]*n
+        for k in range(1, n-1):
+            if delta[k-1]*delta[k] > 0:
+                # Weighted harmonic mean of the secants either side
+                w1 = 2*h[k] + h[k-1]
+                w2 = h[k] + 2*h[k-1]
+                slopes[k] = (w1 + w2)/(w1/delta[k-1] + w2/delta[k])
+        slopes[0] = self.__endSlope(h[0], h[1], delta[0], delta[1])
+        slopes[n-1] = self.__endSlope(h[n-2], h[n-3], delta[n-2], delta[n-3])
+        return slopes
+
+    def __endSlope(self, h0, h1, d0, d1):
+        """ One sided three point slope at an end, limited to stay monotone """
+
+        slope = ((2*h0 + h1)*d0 - h0*d1)/(h0 + h1)
+        if slope*d0 <= 0:
+            return 0.0
+        if d0*d1 <= 0 and abs(slope) > abs(3*d0):
+            return 3*d0
+        return slope
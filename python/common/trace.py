@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# trace.py
+#
+# CAT frequency traces for the Mag Loop application
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import threading
+
+"""
+A trace is the sequence of frequencies read from CAT during an operating session.
+It is a text file, one sample per line as "seconds,Hz" with seconds from the first
+sample. Lines starting with '#' are comments, the first holds the loop name.
+"""
+class TraceWriter:
+
+    def __init__(self, path, loopname):
+        """
+        Constructor
+
+        Arguments:
+            path        --  file to write
+            loopname    --  loop in use when recorded
+
+        """
+
+        self.__lock = threading.Lock()
+        self.__file = open(path, 'w')
+        self.__file.write('# loop,%s\n' % loopname)
+        self.__start = None
+        self.__count = 0
+
+    def write(self, t, freq):
+        """
+        Record a sample
+
+        Arguments:
+            t       --  time in seconds
+            freq    --  frequency in Hz
+
+        """
+
+        with self.__lock:
+            if self.__file == None:
+                return
+            if self.__start == None:
+                self.__start = t
+            self.__file.write('%.3f,%d\n' % (t - self.__start, int(freq)))
+            self.__count += 1
+
+    def count(self):
+        """ Samples written """
+
+        return self.__count
+
+    def close(self):
+        """ Finish the trace """
+
+        with self.__lock:
+            if self.__file != None:
+                self.__file.close()
+                self.__file = None
+
+def readTrace(path):
+    """
+    Return (loopname or None, [(seconds, Hz), ...]) from a trace file
+
+    Arguments:
+        path    --  file to read
+
+    """
+
+    loopname = None
+    samples = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if line.startswith('#'):
+                key, _, value = line[1:].strip().partition(',')
+                if key == 'loop':
+                    loopname = value
+                continue
+            t, freq = line.split(',')
+            samples.append((float(t), int(freq)))
+    return loopname, samples
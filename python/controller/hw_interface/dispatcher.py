@@ -23,10 +23,12 @@
 #     bob@bobcowdery.plus.com
 #
 
+
 # System imports
 import os,sys
-from time import sleep
-import queue
+from time import monotonic
+import heapq
+import itertools
 import threading
 import traceback
 
@@ -34,34 +36,118 @@ sys.path.append('..')
 
 # Application imports
 from common.defs import *
+from common import latency
+
+# Scheduled command ===================================================================
+# A command waiting in the scheduler.
 
-# Command execute thread ===================================================================    
+class ScheduledCommand:
+    
+    def __init__(self, callable, name, args, priority, deadline, preemptible, coalesce, retarget = None):
+        """
+        Constructor
+        
+        Arguments:
+            callable    --  API method to call
+            name        --  command name
+            args        --  arguments to the API method
+            priority    --  PRIORITY_STOP .. PRIORITY_BACKGROUND
+            deadline    --  absolute monotonic time after which the command is discarded or None
+            preemptible --  True if a stop may cancel this command while queued
+            coalesce    --  key of the setting this command writes or None
+            retarget    --  callable(args) to change the target while executing or None
+        
+        """
+        
+        self.callable = callable
+        self.name = name
+        self.args = args
+        self.priority = priority
+        self.deadline = deadline
+        self.preemptible = preemptible
+        self.coalesce = coalesce
+        self.retarget = retarget
+        self.enqueued = monotonic()
+        self.cancelled = False
+
+# Command scheduler ===================================================================    
 # Dispatches commands from the main thread such that it remains responsive to events.
+# Commands are held in one queue and executed in priority class order, first in first
+# out within a class. A stop is never queued behind other work. If a command is executing
+# the stop is sent immediately as a one way command to interrupt it, otherwise it goes to
+# the head of the queue. In both cases queued preemptible work is cancelled.
+# Commands which write a setting, e.g. a move target or relay state, can be given a
+# coalesce key. A newer command with the same key supersedes a queued one of the same or
+# lower priority, last writer wins, so only the latest value is sent to the controller.
+# Keys are scoped by source, e.g. 'move' for a user goto and 'track-move' for tracking, so
+# tracking never replaces what the user asked for, and by the form of the value, e.g.
+# 'track-freq' for tracking by frequency, as a retarget is given the new command's args.
+# If the command with the key is already executing and can be retargeted, e.g. a move,
+# and the new command is of the same or lower priority the new value is given to it
+# instead so the controller changes target without a stop and start. The retarget is sent by a thread of the scheduler as
+# the executing command holds the scheduler thread, so the submitter never waits for the
+# controller. If the retarget fails the new command is queued after the executing one.
+# Submitting never blocks the caller unless asked to. When the queue is full the
+# overflow policy for the command decides whether it is refused, evicts other work or
+# waits a bounded time for space.
 
-class CommandExecutionThrd(threading.Thread):
+class CommandScheduler(threading.Thread):
     
-    def __init__(self, q, callback):
+    def __init__(self, callback, maxsize = COMMAND_QUEUE_SIZE, latencies = None):
         """
         Constructor
         
         Arguments:
-            q           --  queue to accept commands on
             callback    --  on status or error
+            maxsize     --  maximum queued commands
+            latencies   --  latency.CommandLatency to record into, shared by several schedulers, default its own
         
         """
         
-        super(CommandExecutionThrd, self).__init__()
+        super(CommandScheduler, self).__init__()
         
-        self.__q = q
         self.__callback = callback
         self.__originalCallback = callback
+        self.__maxsize = maxsize
+        
+        # Heap of [priority, sequence, command], cancelled commands are removed lazily
+        self.__heap = []
+        self.__sequence = itertools.count()
+        self.__depth = 0
+        # Queued command for each coalesce key
+        self.__pending = {}
+        # (executing, new command, overflow, timeout) waiting to retarget for each coalesce key
+        self.__retargeting = {}
+        self.__retargeter = threading.Thread(target = self.__retargetLoop)
+        self.__retargeter.daemon = True
+        self.__cond = threading.Condition()
+        # The command being executed
+        self.__executing = None
+        # Time an interrupting stop was sent while a command was executing
+        self.__stopSent = None
+        
+        # Per command enqueue-to-start and start-to-complete latencies
+        self.__latency = latencies if latencies != None else latency.CommandLatency()
+        # Stop submitted to the controller idle
+        self.__stopLatency = latency.Histogram()
+        self.__cancelled = 0
+        self.__expired = 0
+        # Superseded commands by coalesce key
+        self.__coalesced = {}
+        # Executing commands given a new target by coalesce key
+        self.__retargeted = {}
+        # Queue full events by policy and deepest queue seen
+        self.__overflows = {}
+        self.__maxDepth = 0
         
         self.__terminate = False
     
     def terminate(self):
         """ Thread terminating """
         
-        self.__terminate = True
+        with self.__cond:
+            self.__terminate = True
+            self.__cond.notify_all()
     
     def stealCallback( self, callback) :
         """ Steal the dispatcher callback """
@@ -71,74 +157,330 @@ class CommandExecutionThrd(threading.Thread):
     def restoreCallback( self) :
         """ Restore the dispatcher callback """
         
-        self.__callback = self.__originalCallback    
+        self.__callback = self.__originalCallback
+    
+    def submit(self, callable, name, args, priority = PRIORITY_INTERACTIVE, deadline = -1, preemptible = True, coalesce = None, overflow = None, timeout = OVERFLOW_BLOCK_TIMEOUT, retarget = None):
+        """
+        Schedule a command. Returns True if queued or False if refused because the queue is full.
+        
+        Arguments:
+            callable    --  API method to call
+            name        --  command name
+            args        --  arguments to the API method
+            priority    --  PRIORITY_STOP .. PRIORITY_BACKGROUND
+            deadline    --  seconds the command may wait, None for ever, -1 for the class default
+            preemptible --  False if a stop must not cancel this command e.g. configuration
+            coalesce    --  key of the setting written, supersedes a queued command with the same key
+            overflow    --  OVERFLOW_REJECT etc, None for the default see OVERFLOW_POLICIES
+            timeout     --  seconds to wait for space with OVERFLOW_BLOCK
+            retarget    --  callable(args) returning True if it gave the executing command these args
+                            instead, used when a later command with the same coalesce key arrives,
+                            called on a thread of the scheduler
+        
+        """
+        
+        if deadline == -1:
+            deadline = COMMAND_DEADLINES[priority]
+        if deadline != None:
+            deadline = monotonic() + deadline
+        command = ScheduledCommand(callable, name, args, priority, deadline, preemptible, coalesce, retarget)
+        
+        if priority == PRIORITY_STOP:
+            self.__stop(command)
+            return True
+        
+        if overflow == None:
+            if preemptible:
+                overflow = OVERFLOW_POLICIES[priority]
+            else:
+                # Must not be lost so make room at the expense of other work
+                overflow = OVERFLOW_DROP_OLDEST
+        
+        if coalesce != None and self.__retarget(command, overflow, timeout):
+            return True
+        return self.__enqueue(command, overflow, timeout)
+    
+    def latencyStats(self):
+        """ Return the per command latency histograms, see latency.CommandLatency """
+        
+        return self.__latency.snapshot()
+    
+    def stats(self):
+        """ Return the scheduler counters """
+        
+        with self.__cond:
+            return {
+                'depth': self.__depth,
+                'maxdepth': self.__maxDepth,
+                'executing': self.__executing.name if self.__executing != None else None,
+                'cancelled': self.__cancelled,
+                'expired': self.__expired,
+                'coalesced': sum(self.__coalesced.values()),
+                'coalescedby': dict(self.__coalesced),
+                'retargeted': dict(self.__retargeted),
+                'overflows': dict(self.__overflows),
+                'stoplatency': self.__stopLatency.snapshot(),
+            }
         
     def run(self):
         """ Thread entry point """
         
+        self.__retargeter.start()
         while not self.__terminate:
             try:
-                if self.__q.qsize() > 0:
-                    self.__callback('beginbatch')
-                    while self.__q.qsize() > 0:
-                        __callable, name, args = self.__q.get()
-                        # By default this is synchronous so will wait for the response
-                        # Response goes to main code callback, we don't care here
-                        __callable(args)
-                        self.__q.task_done()
-                        self.__callback('executed:%s' % name)
-                    self.__callback('endbatch')
-                else:
-                    sleep(0.02)
+                # Block until there is work, a batch is everything queued from here
+                command = self.__next(True)
+                if command == None: break
+                self.__callback('beginbatch')
+                while command != None:
+                    self.__execute(command)
+                    command = self.__next(False)
+                self.__callback('endbatch')
             except Exception as e:
-                # Something went wrong
-                print(str(e))
+                # Something went wrong, the callback reports it
                 self.__callback('fatal: {0}'.format(e))
-                break 
- 
-# Command priority thread ===================================================================    
-# Dispatches priority commands from the main thread such that it remains responsive to events.
-# These are one way commands, usually to interrupt processing e.g. a stop command. We do not
-# expect a response to these commands.
-
-class CommandPriorityThrd(threading.Thread):
+                break
     
-    def __init__(self, q):
+    def __stop(self, command):
         """
-        Constructor
+        Issue a stop without waiting behind other work
         
         Arguments:
-            q           --  queue to accept commands on
+            command --  the stop command
         
         """
         
-        super(CommandPriorityThrd, self).__init__()
+        with self.__cond:
+            # Cancel queued work that the stop makes pointless
+            for _, _, queued in self.__heap:
+                if not queued.cancelled and queued.preemptible:
+                    self.__cancel(queued)
+                    self.__cancelled += 1
+            for key, waiting in list(self.__retargeting.items()):
+                if waiting[1].preemptible:
+                    del self.__retargeting[key]
+                    self.__cancelled += 1
+            if self.__executing == None:
+                # Idle, run it next so it gets a response
+                self.__push(command)
+                self.__cond.notify_all()
+                return
+            # A command is executing so the stop must interrupt it
+            if self.__stopSent == None:
+                self.__stopSent = command.enqueued
+            self.__cond.notify_all()
+        try:
+            # No response will be sent so call with async and no response
+            command.callable(command.args, False, False)
+        except Exception as e:
+            # Something went wrong, we just have to ignore it
+            pass
+    
+    def __retarget(self, command, overflow, timeout):
+        """
+        Hand the new command to the retarget thread if the executing command has the same
+        coalesce key, can be retargeted and is no less urgent. Returns True if handed over.
         
-        self.__q = q
+        Arguments:
+            command     --  the new command
+            overflow    --  overflow policy should the command be queued after all
+            timeout     --  seconds to wait for space with OVERFLOW_BLOCK
         
-        self.__terminate = False
+        """
+        
+        with self.__cond:
+            executing = self.__executing
+            if executing == None or executing.retarget == None or executing.coalesce != command.coalesce:
+                return False
+            if executing.priority < command.priority:
+                # Less urgent work must not change what a more urgent command is doing
+                return False
+            if command.coalesce in self.__pending:
+                # A queued command would run after and undo the retarget
+                return False
+            if command.coalesce in self.__retargeting:
+                # Last writer wins
+                self.__coalesced[command.coalesce] = self.__coalesced.get(command.coalesce, 0) + 1
+            self.__retargeting[command.coalesce] = (executing, command, overflow, timeout)
+            self.__cond.notify_all()
+        return True
     
-    def terminate(self):
-        """ Thread terminating """
+    def __retargetLoop(self):
+        """ Retarget thread entry point, gives executing commands their new args """
         
-        self.__terminate = True
+        while True:
+            with self.__cond:
+                while not self.__terminate and len(self.__retargeting) == 0:
+                    self.__cond.wait()
+                if self.__terminate:
+                    return
+                executing, command, overflow, timeout = self.__retargeting.pop(next(iter(self.__retargeting)))
+                current = self.__executing is executing
+            done = False
+            if current:
+                try:
+                    # Outside the lock as this talks to the controller
+                    done = executing.retarget(command.args)
+                except Exception as e:
+                    done = False
+            if done:
+                with self.__cond:
+                    executing.args = command.args
+                    self.__retargeted[command.coalesce] = self.__retargeted.get(command.coalesce, 0) + 1
+                self.__callback('retargeted:%s' % command.name)
+                continue
+            with self.__cond:
+                if command.coalesce in self.__pending:
+                    # Overtaken by a newer command while retargeting
+                    self.__coalesced[command.coalesce] = self.__coalesced.get(command.coalesce, 0) + 1
+                    continue
+            # Run it after the executing command instead
+            self.__enqueue(command, overflow, timeout)
+    
+    def __enqueue(self, command, overflow, timeout):
+        """
+        Queue a command, returns True if queued or False if refused because the queue is full
         
-    def run(self):
-        """ Thread entry point """
+        Arguments:
+            command     --  the command
+            overflow    --  OVERFLOW_REJECT etc
+            timeout     --  seconds to wait for space with OVERFLOW_BLOCK
         
-        while not self.__terminate:
-            try:
-                if self.__q.qsize() > 0:
-                    while self.__q.qsize() > 0:
-                        __callable, name, args = self.__q.get()
-                        # By default this is synchronous
-                        # No response will be send so we don't need any status to the main thread
-                        # Call with async and no response
-                        __callable(args, False, False)
-                        self.__q.task_done()
-                else:
-                    sleep(0.02)
-            except Exception as e:
-                # Something went wrong, we just have to ignore it
-                pass
- 
\ No newline at end of file
+        """
+        
+        with self.__cond:
+            # A superseded command is dropped first so it does not count against the queue size
+            self.__supersede(command)
+            if self.__depth >= self.__maxsize:
+                if not self.__overflow(command, overflow, timeout):
+                    return False
+            self.__push(command)
+            self.__maxDepth = max(self.__maxDepth, self.__depth)
+        return True
+    
+    def __push(self, command):
+        """ Add a command, caller holds the lock """
+        
+        heapq.heappush(self.__heap, [command.priority, next(self.__sequence), command])
+        self.__depth += 1
+        if command.coalesce != None:
+            self.__pending[command.coalesce] = command
+        self.__cond.notify_all()
+    
+    def __cancel(self, command):
+        """ Cancel a queued command, caller holds the lock """
+        
+        command.cancelled = True
+        self.__depth -= 1
+        if command.coalesce != None and self.__pending.get(command.coalesce) is command:
+            del self.__pending[command.coalesce]
+        self.__cond.notify_all()
+    
+    def __supersede(self, command):
+        """ Drop a queued command with the same coalesce key and no higher priority, caller holds the lock """
+        
+        if command.coalesce == None: return
+        waiting = self.__retargeting.get(command.coalesce)
+        if waiting != None and waiting[1].priority >= command.priority:
+            # Not yet given to the executing command and this will run after it
+            del self.__retargeting[command.coalesce]
+            self.__coalesced[command.coalesce] = self.__coalesced.get(command.coalesce, 0) + 1
+        queued = self.__pending.get(command.coalesce)
+        if queued != None and queued.priority >= command.priority:
+            self.__cancel(queued)
+            self.__coalesced[command.coalesce] = self.__coalesced.get(command.coalesce, 0) + 1
+    
+    def __overflow(self, command, policy, timeout):
+        """
+        Apply the overflow policy to a command arriving at a full queue, caller holds the lock.
+        Returns True if there is now room for the command.
+        
+        Arguments:
+            command --  the new command
+            policy  --  OVERFLOW_REJECT etc
+            timeout --  seconds to wait with OVERFLOW_BLOCK
+        
+        """
+        
+        self.__overflows[policy] = self.__overflows.get(policy, 0) + 1
+        victim = None
+        if policy == OVERFLOW_BLOCK:
+            until = monotonic() + timeout
+            while self.__depth >= self.__maxsize and not self.__terminate:
+                remaining = until - monotonic()
+                if remaining <= 0: break
+                self.__cond.wait(remaining)
+                self.__supersede(command)
+        elif policy == OVERFLOW_DROP_OLDEST:
+            # Oldest work that is no more urgent than this
+            for _, sequence, queued in self.__heap:
+                if not queued.cancelled and queued.preemptible and queued.priority >= command.priority:
+                    if victim == None or sequence < victim[0]:
+                        victim = (sequence, queued)
+        elif policy == OVERFLOW_COALESCE:
+            # The newest work of the same class is superseded by this
+            for _, sequence, queued in self.__heap:
+                if not queued.cancelled and queued.preemptible and queued.priority == command.priority:
+                    if victim == None or sequence > victim[0]:
+                        victim = (sequence, queued)
+        if victim != None:
+            self.__cancel(victim[1])
+            self.__callback('overflow:%s:%s:%s' % (command.name, policy, victim[1].name))
+        if self.__depth >= self.__maxsize:
+            self.__callback('overflow:%s:%s:rejected' % (command.name, policy))
+            return False
+        return True
+    
+    def __next(self, block):
+        """
+        Get the next command to execute or None
+        
+        Arguments:
+            block   --  wait for a command if none queued
+        
+        """
+        
+        with self.__cond:
+            while not self.__terminate:
+                while len(self.__heap) > 0:
+                    _, _, command = heapq.heappop(self.__heap)
+                    if command.cancelled: continue
+                    self.__depth -= 1
+                    if command.coalesce != None and self.__pending.get(command.coalesce) is command:
+                        del self.__pending[command.coalesce]
+                    self.__cond.notify_all()
+                    if command.deadline != None and monotonic() > command.deadline:
+                        # Waited too long, no longer relevant
+                        self.__expired += 1
+                        self.__callback('expired:%s' % command.name)
+                        continue
+                    self.__executing = command
+                    return command
+                if not block: break
+                self.__cond.wait()
+            return None
+    
+    def __execute(self, command):
+        """
+        Execute a command
+        
+        Arguments:
+            command --  command to execute
+        
+        """
+        
+        # By default this is synchronous so will wait for the response
+        # Response goes to main code callback, we don't care here
+        started = monotonic()
+        command.callable(command.args)
+        completed = monotonic()
+        self.__latency.record(command.name, (started - command.enqueued)*1000.0, (completed - started)*1000.0)
+        with self.__cond:
+            self.__executing = None
+            if command.priority == PRIORITY_STOP:
+                self.__stopLatency.record((completed - command.enqueued)*1000.0)
+            elif self.__stopSent != None:
+                # Interrupted by a stop, this is when the controller became idle
+                self.__stopLatency.record((completed - self.__stopSent)*1000.0)
+                self.__stopSent = None
+        self.__callback('executed:%s' % command.name)
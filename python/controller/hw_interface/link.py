@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+#
+# link.py
+#
+# Pipelined command link to the loop controller
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os,sys
+import socket
+import threading
+import itertools
+from time import monotonic
+from concurrent.futures import Future
+import traceback
+
+sys.path.append('..')
+
+# Application imports
+from common.defs import *
+from controller.hw_interface import protocol
+
+"""
+The ControllerAPI sends one command and waits for the reply before the next can be
+sent. The link tags each command with a correlation id so several commands can be in
+flight at once. Replies are matched to their command by the tag, each command has a
+Future which completes with the reply text. The sketch executes commands in the order
+received so a batch of configuration commands costs little more than one round trip.
+
+Where the sketch also accepts batches a set of commands is sent as one datagram by
+executeBatch(), so the set costs one round trip and cannot be half applied. A set too
+long for one datagram is refused rather than split, see protocol.batch().
+
+Given an events callback the link asks the sketch for binary event frames, which then
+come to the link rather than to the ControllerAPI event port, see setFraming().
+
+Firmware which does not understand tags is detected by negotiate() in which case the
+caller should fall back to the ControllerAPI.
+"""
+class ControllerLink(threading.Thread):
+
+    def __init__(self, network, callback, events = None, window = PIPELINE_WINDOW, timeout = CONTROLLER_TIMEOUT):
+        """
+        Constructor
+
+        Arguments:
+            network     --  [ip, port] of the controller
+            callback    --  callback here with each reply as for the ControllerAPI response callback
+            events      --  callback here with (event type, values) for each binary event frame,
+                            None to leave events as text to the event port
+            window      --  maximum commands in flight
+            timeout     --  seconds to wait for a reply
+
+        """
+
+        super(ControllerLink, self).__init__()
+
+        self.__address = (network[IP], int(network[PORT]))
+        self.__callback = callback
+        self.__events = events
+        self.__window = window
+        self.__timeout = timeout
+
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__sock.settimeout(timeout)
+
+        self.__lock = threading.Lock()
+        self.__tags = itertools.cycle(range(protocol.MAX_TAG))
+        # Commands waiting for a slot in the window [tag, command, future, timeout]
+        self.__backlog = []
+        # Commands sent and waiting for a reply {tag: [expiry time, future]}
+        self.__inflight = {}
+        self.__pipelined = False
+        self.__batched = False
+        self.__relayMask = False
+        self.__warmTune = False
+        self.__table = False
+        self.__framing = protocol.FRAMING_ASCII
+
+        self.__terminate = False
+
+    def terminate(self):
+        """ Thread terminating """
+
+        self.__terminate = True
+        try:
+            self.__sock.close()
+        except:
+            pass
+
+    def resetNetworkParams(self, ip, port):
+        """
+        New controller address
+
+        Arguments:
+            ip      --  controller ip address
+            port    --  controller port
+
+        """
+
+        self.__address = (ip, int(port))
+        self.__pipelined = False
+        self.__batched = False
+        self.__relayMask = False
+        self.__warmTune = False
+        self.__table = False
+        self.__framing = protocol.FRAMING_ASCII
+
+    def negotiate(self):
+        """
+        Returns True if the controller echoes tags and so supports pipelining. This takes
+        several round trips so run it on the dispatcher rather than the UI thread.
+
+        """
+
+        ping = protocol.encode('ping', ())
+        reply = self.send(ping).result()
+        self.__pipelined = (reply == 'success')
+        self.__batched = False
+        self.__relayMask = False
+        self.__warmTune = False
+        self.__table = False
+        if self.__pipelined:
+            # Older firmware rejects a batch as an invalid command
+            reply = self.send(protocol.BATCH_SEPARATOR.join((ping, ping))).result()
+            self.__batched = (protocol.unbatch(reply, 2) == ['success', 'success'])
+            # Older firmware rejects the relay state query
+            reply = self.send(protocol.encode('getRelays', ())).result()
+            self.__relayMask = (protocol.relayState(reply) != None)
+            # An empty window is refused without moving, older firmware rejects the command
+            # and a lost reply says nothing either way
+            reply = self.send(protocol.encode('warmTune', (0, 0))).result()
+            self.__warmTune = protocol.windowRefused(reply)
+            # Older firmware rejects the table state query
+            reply = self.send(protocol.encode('getTable', ())).result()
+            self.__table = (protocol.tableState(reply) != None)
+            if self.__events != None:
+                self.setFraming(protocol.FRAME_VERSION)
+        return self.__pipelined
+
+    def isPipelined(self):
+        """ True if negotiate() found a controller which supports pipelining """
+
+        return self.__pipelined
+
+    def isBatched(self):
+        """ True if negotiate() found a controller which supports batches """
+
+        return self.__batched
+
+    def hasRelayMask(self):
+        """ True if negotiate() found a controller which sets all relays in one command """
+
+        return self.__relayMask
+
+    def hasWarmTune(self):
+        """ True if negotiate() found a controller which tunes within a window """
+
+        return self.__warmTune
+
+    def hasTable(self):
+        """ True if negotiate() found a controller which holds a setpoint table and tracks by frequency """
+
+        return self.__table
+
+    def setFraming(self, version):
+        """
+        Ask for events as binary frames to this link, returns the framing version agreed.
+        Older firmware rejects the command and events stay as text.
+
+        Arguments:
+            version --  latest framing version understood, FRAMING_ASCII for text events
+
+        """
+
+        agreed = protocol.framing(self.send(protocol.encode('setFraming', version)).result())
+        if agreed == None or agreed > version:
+            agreed = protocol.FRAMING_ASCII
+        self.__framing = agreed
+        return agreed
+
+    def retarget(self, extension):
+        """
+        Give an executing move a new target, returns True if the controller took it.
+        Run it on the dispatcher as it waits for the reply.
+
+        Arguments:
+            extension   --  new target in % extension
+
+        """
+
+        if not self.__pipelined:
+            return False
+        return protocol.retargeted(self.send(protocol.encode('retarget', extension)).result())
+
+    def framing(self):
+        """ Framing version of events, FRAMING_ASCII for text events to the event port """
+
+        return self.__framing
+
+    def send(self, command, timeout = None):
+        """
+        Send a command, returns a Future which completes with the reply text
+
+        Arguments:
+            command --  encoded command see protocol.encode()
+            timeout --  seconds to wait for the reply, default the link timeout
+
+        """
+
+        future = Future()
+        if timeout == None:
+            timeout = self.__timeout
+        with self.__lock:
+            self.__backlog.append([next(self.__tags), command, future, timeout])
+            self.__pump()
+        return future
+
+    def execute(self, commands):
+        """
+        Send a list of commands pipelined and wait for all the replies.
+        The signature allows this to be scheduled on the dispatcher.
+
+        Arguments:
+            commands    --  list of encoded commands
+
+        """
+
+        futures = [self.send(command) for command in commands]
+        replies = [future.result() for future in futures]
+        for reply in replies:
+            self.__callback(reply)
+        return replies
+
+    def executeBatch(self, commands):
+        """
+        Send a list of commands as one batch datagram and wait for the replies. A set which
+        does not fit in one datagram is refused, nothing is sent and every reply is a failure.
+        The signature allows this to be scheduled on the dispatcher.
+
+        Arguments:
+            commands    --  list of encoded commands
+
+        """
+
+        if protocol.fitsBatch(commands):
+            replies = protocol.unbatch(self.send(protocol.batch(commands)).result(), len(commands))
+        else:
+            replies = ['failure:Batch too long'] * len(commands)
+        for reply in replies:
+            self.__callback(reply)
+        return replies
+
+    def run(self):
+        """ Thread entry point """
+
+        while not self.__terminate:
+            try:
+                data, address = self.__sock.recvfrom(RECEIVE_BUFFER)
+                if protocol.isFrame(data):
+                    # An event, decoded without going through text
+                    frame = protocol.decodeFrame(data)
+                    if frame != None and self.__events != None:
+                        self.__events(*frame)
+                    id = None
+                else:
+                    id, reply = protocol.untag(data.decode('ascii', 'replace'))
+                if id != None:
+                    with self.__lock:
+                        if id in self.__inflight:
+                            _, future = self.__inflight.pop(id)
+                            future.set_result(reply)
+            except socket.timeout:
+                pass
+            except OSError:
+                # Socket closed or unusable
+                if self.__terminate: break
+            except Exception as e:
+                print('Exception in link [%s][%s]' % (str(e), traceback.format_exc()))
+            with self.__lock:
+                self.__expire()
+                self.__pump()
+        # Release anyone still waiting
+        with self.__lock:
+            for _, future in self.__inflight.values():
+                future.set_result('failure:Link closed')
+            for _, _, future, _ in self.__backlog:
+                future.set_result('failure:Link closed')
+            self.__inflight = {}
+            self.__backlog = []
+
+    def __pump(self):
+        """ Send backlog commands while there is room in the window, caller holds the lock """
+
+        while len(self.__backlog) > 0 and len(self.__inflight) < self.__window:
+            id, command, future, timeout = self.__backlog.pop(0)
+            try:
+                self.__sock.sendto(protocol.tag(id, command).encode('ascii'), self.__address)
+                self.__inflight[id] = [monotonic() + timeout, future]
+            except Exception as e:
+                future.set_result('failure:%s' % str(e))
+
+    def __expire(self):
+        """ Fail commands which have waited too long for a reply, caller holds the lock """
+
+        now = monotonic()
+        for id in [id for id, (expires, _) in self.__inflight.items() if now > expires]:
+            _, future = self.__inflight.pop(id)
+            future.set_result('failure:Timeout')
+
+def configure(scheduler, link, api, name, commands, scope = ''):
+    """
+    Submit a set of configuration commands to go by the quickest route the controller supports
+
+    Arguments:
+        scheduler   --  dispatcher.CommandScheduler
+        link        --  ControllerLink to the controller
+        api         --  ControllerAPI to the controller, used if it does not pipeline
+        name        --  dispatcher name for the set, a newer set with the same name replaces a queued one
+        commands    --  list of (ControllerAPI method name, args)
+        scope       --  prefix to names and coalesce keys for a controller sharing the scheduler
+
+    """
+
+    if len(commands) == 0:
+        return
+    encoded = [protocol.encode(method, args) for method, args in commands]
+    if link.isBatched() and protocol.fitsBatch(encoded):
+        # The whole set in one datagram
+        scheduler.submit(link.executeBatch, scope + name, encoded, preemptible = False, coalesce = scope + name)
+    elif link.isPipelined():
+        # The whole set is in flight together on the link
+        scheduler.submit(link.execute, scope + name, encoded, preemptible = False, coalesce = scope + name)
+    else:
+        # One round trip at a time through the API
+        for method, args in commands:
+            key = protocol.coalesceKey(method, args)
+            scheduler.submit(getattr(api, method), scope + method, args, preemptible = False, coalesce = (scope + key) if key != None else None)
@@ -0,0 +1,561 @@
+#!/usr/bin/env python
+#
+# protocol.py
+#
+# Command encoding for the loop controller sketch
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os,sys
+import struct
+
+sys.path.append('..')
+
+# Application imports
+from common.defs import *
+
+"""
+Encodes commands in the ASCII form understood by execute() in the sketch.
+Commands are named as the ControllerAPI methods and take the same arguments
+so a command can go either through the API or directly over a ControllerLink.
+
+A command may be prefixed with a correlation tag "#[n]:" which the sketch echoes
+in front of the reply.
+
+Several commands may be sent as a batch in one datagram separated by ';'. The sketch
+executes them in order and replies "batch:[reply];[reply];..." so a set of commands
+is applied by one datagram or not at all.
+
+Events are text sent to the event port unless a client asks for binary frames with
+setFraming, when they come to the client as fixed layout frames, see decodeFrame().
+A frame starts with FRAME_MAGIC, which is not ASCII, then the framing version and the
+event type. The values follow as the sketch holds them, little endian and unpadded.
+
+The TX state, VSWR and pot position are telemetry channels, each sent at a period set
+with setTelemetryIdle and setTelemetryBusy. From FRAME_TELEMETRY the channels due are
+sent together in one EVENT_TELEMETRY frame rather than as separate events.
+"""
+
+# Tags wrap at this value, the sketch holds them in an int
+MAX_TAG = 10000
+
+# Batch limits, as the sketch MAX_BATCH_COMMANDS and PACKET_BUFFER_SIZE less room for a tag
+BATCH_SEPARATOR = ';'
+BATCH_PREFIX = 'batch:'
+MAX_BATCH_COMMANDS = 8
+MAX_BATCH_LENGTH = 120
+
+# Relays the sketch can switch, as MAX_RELAYS
+MAX_RELAYS = 8
+RELAYS_PREFIX = 'relays:'
+
+# Reply from firmware which does not know a command
+INVALID_COMMAND = 'failure:Invalid command'
+
+# Reply to a warm tune with an empty or out of range window, as sent by the negotiate probe
+INVALID_WINDOW = 'failure:Invalid window'
+
+# Replies to a warm tune saying which sweep found the match
+WARM_MATCH = 'success:warm'
+FULL_MATCH = 'success:full'
+
+# Reply to a move "success:[ms]:[error]", the time taken and the final error in analog steps
+MOVE_PREFIX = 'success:'
+
+# Event every few seconds "noise:[pot]:[fwd]:[ref]", the noise floor of each reading in +/- analog steps
+NOISE_PREFIX = 'noise:'
+
+# Event while autotune is on "autotune:[ms TX]:[ms mistuned]:[searches]", totals since autotune on
+AUTOTUNE_PREFIX = 'autotune:'
+
+# Setpoint table held by the sketch, as MAX_TABLE_POINTS, reply "table:[points]:[checksum]"
+MAX_TABLE_POINTS = 32
+TABLE_PREFIX = 'table:'
+
+# Event framing, as the sketch FRAME_VERSION, reply "framing:[version]"
+FRAMING_ASCII = 0
+FRAME_VERSION = 2
+FRAME_TELEMETRY = 2
+FRAME_MAGIC = 0xA5
+FRAMING_PREFIX = 'framing:'
+
+# Frame event types and the alarm codes of an alarm frame
+EVENT_PROGRESS = 1
+EVENT_VSWR = 2
+EVENT_POT = 3
+EVENT_TX = 4
+EVENT_NOISE = 5
+EVENT_AUTOTUNE = 6
+EVENT_ALARM = 7
+EVENT_TELEMETRY = 8
+ALARM_AUTOTUNE = 1
+
+# Telemetry channels, as the sketch TM_TX, TM_VSWR and TM_POT, and the event each stands for
+TELEMETRY_TX = 0
+TELEMETRY_VSWR = 1
+TELEMETRY_POT = 2
+TELEMETRY_EVENTS = {TELEMETRY_TX: EVENT_TX, TELEMETRY_VSWR: EVENT_VSWR, TELEMETRY_POT: EVENT_POT}
+
+# A telemetry frame this few behind the last is late, further behind the sketch has restarted
+TELEMETRY_REORDER = 16
+
+# Frame header and the layout of the values of each event for each framing version
+_FRAME_HEADER = struct.Struct('<BBB')
+_FRAME_LAYOUTS = {
+    1: {
+        EVENT_PROGRESS:     struct.Struct('<h'),        # % complete
+        EVENT_VSWR:         struct.Struct('<ff'),       # forward, reflected
+        EVENT_POT:          struct.Struct('<hf'),       # raw, % extension
+        EVENT_TX:           struct.Struct('<B'),        # 1 on, 0 off
+        EVENT_NOISE:        struct.Struct('<fff'),      # pot, forward, reflected
+        EVENT_AUTOTUNE:     struct.Struct('<IIh'),      # ms TX, ms mistuned, searches
+        EVENT_ALARM:        struct.Struct('<B'),        # alarm code
+    },
+}
+_FRAME_LAYOUTS[2] = dict(_FRAME_LAYOUTS[1])
+# Telemetry frames, sequence, millis() and the channel mask then the values of each channel in the mask
+_TELEMETRY_HEADER = struct.Struct('<HIB')
+_TELEMETRY_CHANNELS = (
+    (TELEMETRY_TX,      _FRAME_LAYOUTS[1][EVENT_TX]),
+    (TELEMETRY_VSWR,    _FRAME_LAYOUTS[1][EVENT_VSWR]),
+    (TELEMETRY_POT,     _FRAME_LAYOUTS[1][EVENT_POT]),
+)
+
+def _ref(args):
+    if args == EXTERNAL:
+        return 'refexternal'
+    return 'refdefault'
+
+def _move(args):
+    value, extension = args
+    if extension:
+        return '%dm' % int(value)
+    return '%dn' % int(value)
+
+def _relay(args):
+    relay, state = args
+    if state:
+        return '%de' % relay
+    return '%dd' % relay
+
+def _relays(args):
+    return '%dk' % relayMask(args)
+
+def _warmTune(args):
+    predicted, window = args
+    return '%d,%dw' % (int(predicted), int(window))
+
+def _tablePoint(args):
+    hz, extension = args
+    return '%d,%dt' % (int(hz), int(round(extension*100)))
+
+def _autoTune(args):
+    if args:
+        return 'autotuneon'
+    return 'autotuneoff'
+
+# Encoder and coalesce key for each command
+_COMMANDS = {
+    'ping':                 (lambda args: 'ping', None),
+    'setAnalogRef':         (_ref, lambda args: 'analogref'),
+    'speed':                (lambda args: '%ds' % int(args), lambda args: 'speed'),
+    'stop':                 (lambda args: 'stop', None),
+    'move':                 (_move, lambda args: 'move'),
+    'retarget':             (lambda args: '%dg' % int(args), None),
+    'setLowSetpoint':       (lambda args: '%dl' % int(args), lambda args: 'lowsetpoint'),
+    'setHighSetpoint':      (lambda args: '%dh' % int(args), lambda args: 'highsetpoint'),
+    'setCapMaxSetpoint':    (lambda args: '%dx' % int(args), lambda args: 'capmax'),
+    'setCapMinSetpoint':    (lambda args: '%dy' % int(args), lambda args: 'capmin'),
+    'tune':                 (lambda args: 'tune', None),
+    'warmTune':             (_warmTune, None),
+    'autoTune':             (_autoTune, lambda args: 'autotune'),
+    'setRelay':             (_relay, lambda args: 'relay%d' % args[0]),
+    'setRelays':            (_relays, lambda args: 'relays'),
+    'getRelays':            (lambda args: 'relays', None),
+    'setFraming':           (lambda args: '%db' % int(args), lambda args: 'framing'),
+    'setTelemetryIdle':     (lambda args: '%d,%dp' % (args[0], int(args[1])), lambda args: 'telemetryidle%d' % args[0]),
+    'setTelemetryBusy':     (lambda args: '%d,%da' % (args[0], int(args[1])), lambda args: 'telemetrybusy%d' % args[0]),
+    'clearTable':           (lambda args: 'tableclear', None),
+    'addTablePoint':        (_tablePoint, None),
+    'saveTable':            (lambda args: 'tablesave', None),
+    'getTable':             (lambda args: 'table', None),
+    'trackFreq':            (lambda args: '%dq' % int(args), lambda args: 'track-freq'),
+    'retargetFreq':         (lambda args: '%du' % int(args), None),
+}
+
+def encode(method, args):
+    """
+    Return the wire form of a command
+
+    Arguments:
+        method  --  ControllerAPI method name
+        args    --  arguments as given to the API method
+
+    """
+
+    return _COMMANDS[method][0](args)
+
+def coalesceKey(method, args):
+    """
+    Return the dispatcher coalesce key for a command or None
+
+    Arguments:
+        method  --  ControllerAPI method name
+        args    --  arguments as given to the API method
+
+    """
+
+    key = _COMMANDS[method][1]
+    if key == None:
+        return None
+    return key(args)
+
+def relayMask(states):
+    """
+    Return the relay mask for a list of relay states
+    
+    Arguments:
+        states  --  state of relay 1, 2 ... as True|False or 1|0
+        
+    """
+    
+    if len(states) > MAX_RELAYS:
+        raise ValueError('At most %d relays' % MAX_RELAYS)
+    mask = 0
+    for relay, state in enumerate(states):
+        if state:
+            mask |= 1 << relay
+    return mask
+
+def relayCommands(states, hasMask):
+    """
+    Return the commands to set the relays for a loop as [(ControllerAPI method name, args), ...],
+    none if the loop has no relays or more than the controller can switch
+    
+    Arguments:
+        states  --  state of relay 1, 2 ... as True|False or 1|0
+        hasMask --  True if the controller sets all relays in one command, see ControllerLink.hasRelayMask()
+        
+    """
+    
+    if len(states) == 0 or len(states) > MAX_RELAYS:
+        return []
+    if hasMask:
+        # All relays in one command
+        return [('setRelays', states)]
+    return [('setRelay', (relay+1, int(state))) for relay, state in enumerate(states)]
+
+def retargeted(reply):
+    """
+    Return True if a reply acknowledges a retarget
+    
+    Arguments:
+        reply   --  reply text
+        
+    """
+    
+    return reply.startswith('retarget:')
+
+def moveResult(reply):
+    """
+    Return (ms, error) from a move reply or None if the reply has no result
+    
+    Arguments:
+        reply   --  reply text
+        
+    """
+    
+    if reply.startswith(MOVE_PREFIX):
+        fields = reply[len(MOVE_PREFIX):].split(':')
+        if len(fields) == 2 and fields[0].isdigit() and fields[1].lstrip('-').isdigit():
+            return int(fields[0]), int(fields[1])
+    return None
+
+def autoTuneStats(event):
+    """
+    Return (ms TX, ms mistuned, searches) from an autotune event or None
+    
+    Arguments:
+        event   --  event text
+        
+    """
+    
+    if event.startswith(AUTOTUNE_PREFIX):
+        fields = event[len(AUTOTUNE_PREFIX):].split(':')
+        if len(fields) == 3 and all(field.isdigit() for field in fields):
+            return int(fields[0]), int(fields[1]), int(fields[2])
+    return None
+
+def noiseFloor(event):
+    """
+    Return (pot, fwd, ref) noise floors from a noise event or None
+    
+    Arguments:
+        event   --  event text
+        
+    """
+    
+    if event.startswith(NOISE_PREFIX):
+        try:
+            pot, fwd, ref = [float(field) for field in event[len(NOISE_PREFIX):].split(':')]
+            return pot, fwd, ref
+        except ValueError:
+            pass
+    return None
+
+def tableEntries(points):
+    """
+    Return the table points as the sketch holds them, [(Hz, hundredths of a %), ...] ascending
+    
+    Arguments:
+        points  --  [(Hz, % extension), ...]
+        
+    """
+    
+    entries = {}
+    for hz, extension in points:
+        entries[int(hz)] = int(round(extension*100))
+    return sorted(entries.items())
+
+def tableChecksum(points):
+    """
+    Return the checksum the sketch reports for a table, see tableChecksum() in the sketch
+    
+    Arguments:
+        points  --  [(Hz, % extension), ...]
+        
+    """
+    
+    checksum = 0
+    for hz, extension in tableEntries(points):
+        checksum = (31*checksum + hz + extension) & 0xFFFF
+    return checksum
+
+def tableState(reply):
+    """
+    Return (points, checksum) from a "table:[points]:[checksum]" reply or None
+    
+    Arguments:
+        reply   --  reply text
+        
+    """
+    
+    if reply.startswith(TABLE_PREFIX):
+        fields = reply[len(TABLE_PREFIX):].split(':')
+        if len(fields) == 2 and all(field.isdigit() for field in fields):
+            return int(fields[0]), int(fields[1])
+    return None
+
+def framing(reply):
+    """
+    Return the framing version from a "framing:[version]" reply or None
+    
+    Arguments:
+        reply   --  reply text
+        
+    """
+    
+    if reply.startswith(FRAMING_PREFIX) and reply[len(FRAMING_PREFIX):].isdigit():
+        return int(reply[len(FRAMING_PREFIX):])
+    return None
+
+def isFrame(data):
+    """
+    Return True if a datagram is a binary frame rather than text
+    
+    Arguments:
+        data    --  datagram bytes
+        
+    """
+    
+    return len(data) > 0 and data[0] == FRAME_MAGIC
+
+def decodeFrame(data):
+    """
+    Return (event type, (values, ...)) from a binary frame or None if it is not understood.
+    The values of a telemetry frame are (sequence, ms, {channel: (values, ...), ...}).
+    
+    Arguments:
+        data    --  datagram bytes
+        
+    """
+    
+    if len(data) < _FRAME_HEADER.size:
+        return None
+    magic, version, event = _FRAME_HEADER.unpack_from(data)
+    if magic == FRAME_MAGIC and version >= FRAME_TELEMETRY and event == EVENT_TELEMETRY:
+        return _decodeTelemetry(data)
+    layout = _FRAME_LAYOUTS.get(version, {}).get(event)
+    if magic != FRAME_MAGIC or layout == None or len(data) != _FRAME_HEADER.size + layout.size:
+        return None
+    return event, layout.unpack_from(data, _FRAME_HEADER.size)
+
+def _decodeTelemetry(data):
+    """ As decodeFrame() for a telemetry frame """
+    
+    offset = _FRAME_HEADER.size
+    if len(data) < offset + _TELEMETRY_HEADER.size:
+        return None
+    sequence, ms, mask = _TELEMETRY_HEADER.unpack_from(data, offset)
+    offset += _TELEMETRY_HEADER.size
+    channels = {}
+    for channel, layout in _TELEMETRY_CHANNELS:
+        if mask & (1 << channel):
+            if len(data) < offset + layout.size:
+                return None
+            channels[channel] = layout.unpack_from(data, offset)
+            offset += layout.size
+    if offset != len(data):
+        return None
+    return EVENT_TELEMETRY, (sequence, ms, channels)
+
+def isStale(sequence, last):
+    """
+    Return True if a telemetry frame repeats or was overtaken by the last frame used
+    
+    Arguments:
+        sequence    --  sequence number of the frame
+        last        --  sequence number of the last frame used or None
+        
+    """
+    
+    return last != None and ((last - sequence) & 0xFFFF) < TELEMETRY_REORDER
+
+def relayState(reply):
+    """
+    Return the relay mask from a "relays:[mask]" reply or None
+    
+    Arguments:
+        reply   --  reply text
+        
+    """
+    
+    if reply.startswith(RELAYS_PREFIX) and reply[len(RELAYS_PREFIX):].isdigit():
+        return int(reply[len(RELAYS_PREFIX):])
+    return None
+
+def windowRefused(reply):
+    """
+    Return True if a warm tune was refused for its window, so the firmware knows the command
+    
+    Arguments:
+        reply   --  reply text
+        
+    """
+    
+    return reply.startswith(INVALID_WINDOW)
+
+def tag(id, command):
+    """
+    Prefix a command with a correlation tag
+
+    Arguments:
+        id      --  tag 0 - MAX_TAG-1
+        command --  encoded command
+
+    """
+
+    return '#%d:%s' % (id, command)
+
+def untag(reply):
+    """
+    Split a reply into (tag, reply), tag is None if the reply was not tagged
+
+    Arguments:
+        reply   --  reply text
+
+    """
+
+    if reply.startswith('#'):
+        id, sep, rest = reply[1:].partition(':')
+        if sep and id.isdigit():
+            return int(id), rest
+    return None, reply
+
+def fitsBatch(commands):
+    """
+    Return True if a list of commands fits in one batch datagram
+    
+    Arguments:
+        commands    --  list of encoded commands
+        
+    """
+    
+    return 0 < len(commands) <= MAX_BATCH_COMMANDS and len(BATCH_SEPARATOR.join(commands)) <= MAX_BATCH_LENGTH
+
+def batch(commands):
+    """
+    Return the wire form of a batch, raises ValueError if the commands do not fit in one
+    datagram as a set split across datagrams could be half applied
+    
+    Arguments:
+        commands    --  list of encoded commands
+        
+    """
+    
+    if not fitsBatch(commands):
+        raise ValueError('%d commands do not fit in one batch' % len(commands))
+    # A batch of one is just the command
+    return BATCH_SEPARATOR.join(commands)
+
+def startupCommands(analogRef, loop, speed = None):
+    """
+    Return the commands which configure the controller for a loop at startup, as
+    [(ControllerAPI method name, args), ...], these always fit in one batch
+    
+    Arguments:
+        analogRef   --  INTERNAL | EXTERNAL
+        loop        --  settings of the loop, see DEFAULT_SETTINGS LOOP_SETTINGS
+        speed       --  motor speed or None to leave it
+        
+    """
+    
+    commands = [('setAnalogRef', analogRef)]
+    # Capacitor limits
+    if loop[I_POT][I_MAXCAP] != None and loop[I_POT][I_MINCAP] != None:
+        commands.append(('setCapMaxSetpoint', loop[I_POT][I_MAXCAP]))
+        commands.append(('setCapMinSetpoint', loop[I_POT][I_MINCAP]))
+    # Loop limits
+    if len(loop) > I_OFFSETS:
+        if loop[I_OFFSETS][I_LOW_FREQ] != None: commands.append(('setLowSetpoint', loop[I_OFFSETS][I_LOW_FREQ]))
+        if loop[I_OFFSETS][I_HIGH_FREQ] != None: commands.append(('setHighSetpoint', loop[I_OFFSETS][I_HIGH_FREQ]))
+    if speed != None:
+        commands.append(('speed', speed))
+    return commands
+
+def unbatch(reply, count):
+    """
+    Split a batch reply into a list of replies, one per command
+    
+    Arguments:
+        reply   --  reply text
+        count   --  number of commands in the batch
+        
+    """
+    
+    if count == 1:
+        return [reply]
+    if reply.startswith(BATCH_PREFIX):
+        replies = reply[len(BATCH_PREFIX):].split(BATCH_SEPARATOR)
+        if len(replies) == count:
+            return replies
+    # The batch failed as a whole
+    return [reply] * count
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+#
+# tunesim.py
+#
+# Reference model of the sketch tuning for the Mag Loop application
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os,sys
+import argparse
+import random
+
+sys.path.append(os.path.join('..', '..'))
+
+# Application imports
+from common.defs import *
+
+"""
+A model of the tuning task in the sketch, tuneStep() and doWarmTune(), against a simulated
+loop and actuator. It follows the firmware step for step at the EX_LOOP_SLEEP tick so changes
+to the search can be tried and timed here before they go on the controller.
+
+The search is a coarse sweep which brackets the minimum reflected power followed by a
+golden-section search of the bracket, see refineNext() in the sketch. The linear search
+it replaced, a slow sweep stopping below GOOD_VSWR then nudging either way until the
+reflected power improves, is kept as the legacy search for comparison. Its nudge loop has
+no limit in the firmware, the model gives up after NUDGE_LIMIT nudges.
+
+Run as a script it benchmarks the seconds of TX to a match for the legacy and current
+searches and for a warm start.
+
+Usage:
+    python tunesim.py [--trials n] [--seed n]
+"""
+
+# As the sketch
+MAX_SPEED_VALUE = 400
+FAST_TUNE_SPEED_VALUE = 300
+SLOW_TUNE_SPEED_VALUE = 100
+COARSE_TUNE_SPEED_VALUE = 200
+MAX_MM_SEC = 10                 # % extension per second at MAX_SPEED_VALUE, 100mm full travel
+EX_LOOP_SLEEP = 0.005           # Seconds per iteration of the sweep
+MOTOR_DELAY = 0.1               # Seconds to start and stop a move
+GOOD_VSWR = 1.7                 # Legacy search stops at a minimum below this
+REF_RISE = 20                   # Reflected rise past the minimum which ends a sweep
+REFINE_MOVES = 8                # Most probes of the golden-section search
+REFINE_RESOLUTION = 3.0         # Bracket in analog steps at which the search ends
+GOLDEN_RATIO = 0.618034
+NUDGE = 2                       # Legacy nudge in analog steps
+NUDGE_TIME = 0.4                # Seconds per nudge
+
+# Model
+RAW_PER_PERCENT = 10.0          # Analog steps per % extension for a pot range of about 1000
+RUN_ON = 0.05                   # Seconds the actuator runs on after a stop
+NUDGE_LIMIT = 50                # Nudges before the model gives up on the legacy loop
+
+# Result of a sweep
+TUNE_MATCHED = 0
+TUNE_NO_MATCH = 1
+TUNE_ABORTED = 2
+
+class Loop:
+
+    def __init__(self, resonance, width = 1.5, minimum = 1.0, noise = 0, rng = None, forward = 500.0):
+        """
+        Constructor
+
+        Arguments:
+            resonance   --  % extension at resonance
+            width       --  % extension either side of resonance to a VSWR one above the minimum
+            minimum     --  VSWR at resonance
+            noise       --  +/- analog steps of noise on the reflected reading
+            rng         --  random.Random for the noise
+            forward     --  forward reading, 0-1023
+
+        """
+
+        self.resonance = resonance
+        self.__width = width
+        self.__minimum = minimum
+        self.__noise = noise
+        self.__rng = rng if rng != None else random.Random(0)
+        self.__forward = forward
+
+    def vswr(self, extension):
+        """ VSWR at an extension """
+
+        return self.__minimum + ((extension - self.resonance)/self.__width)**2
+
+    def reflected(self, extension):
+        """ Reflected reading at an extension as analogRead() """
+
+        ratio = self.vswr(extension)
+        ref = int(self.__forward*(ratio - 1.0)/(ratio + 1.0))
+        if self.__noise > 0:
+            ref += self.__rng.randint(-self.__noise, self.__noise)
+        return max(0, ref)
+
+class Controller:
+
+    def __init__(self, loop, position, lowSetpoint = 80, highSetpoint = 20, legacy = False):
+        """
+        Constructor
+
+        Arguments:
+            loop            --  Loop to tune
+            position        --  starting % extension
+            lowSetpoint     --  % extension at the low frequency end
+            highSetpoint    --  % extension at the high frequency end
+            legacy          --  use the linear search with the nudge loop
+
+        """
+
+        self.__loop = loop
+        self.position = float(position)
+        self.elapsed = 0.0              # Seconds, all with the carrier on
+        self.probes = 0                 # Moves or nudges after the sweep
+        self.bounced = False            # Legacy nudge loop hit NUDGE_LIMIT
+        self.__low = lowSetpoint
+        self.__high = highSetpoint
+        self.__legacy = legacy
+
+    def vswr(self):
+        """ VSWR where the tune finished """
+
+        return self.__loop.vswr(self.position)
+
+    def tune(self):
+        """ As doTune(), returns True on a match """
+
+        return self.__sweep(self.__low, self.__high) == TUNE_MATCHED
+
+    def warmTune(self, predicted, window):
+        """ As doWarmTune(), returns (True on a match, True if the window found it) """
+
+        low = min(self.__low, predicted + window)
+        high = max(self.__high, predicted - window)
+        if high < low:
+            result = self.__sweep(low, high)
+            if result == TUNE_MATCHED:
+                return True, True
+            if result == TUNE_ABORTED:
+                return False, False
+        return self.__sweep(self.__low, self.__high) == TUNE_MATCHED, False
+
+    def __rate(self, speed):
+        """ % extension per second at a speed """
+
+        return MAX_MM_SEC*float(speed)/MAX_SPEED_VALUE
+
+    def __move(self, extension, speed):
+        """ As doMove() """
+
+        self.elapsed += MOTOR_DELAY + abs(extension - self.position)/self.__rate(speed)
+        self.position = float(extension)
+
+    def __sweep(self, low, high):
+        """ As sweepBegin() to sweepEnd() """
+
+        if self.position - high > low - self.position:
+            self.__move(low, FAST_TUNE_SPEED_VALUE)
+            direction = -1.0
+        else:
+            self.__move(high, FAST_TUNE_SPEED_VALUE)
+            direction = 1.0
+        speed = SLOW_TUNE_SPEED_VALUE if self.__legacy else COARSE_TUNE_SPEED_VALUE
+        step = direction*EX_LOOP_SLEEP*self.__rate(speed)
+        # As the firmware timeout, twice a full travel
+        ticks = int(2.0*100.0/self.__rate(speed)/EX_LOOP_SLEEP)
+        refMin = None
+        rawMin = None
+        descended = False
+        while True:
+            if (step > 0 and self.position > low) or (step < 0 and self.position < high):
+                return TUNE_NO_MATCH
+            ref = self.__loop.reflected(self.position)
+            if ref == 0:
+                return TUNE_MATCHED
+            if refMin == None:
+                refMin = ref
+                rawMin = self.position*RAW_PER_PERCENT
+            elif ref < refMin:
+                refMin = ref
+                rawMin = self.position*RAW_PER_PERCENT
+                descended = True
+                if self.__legacy and self.__loop.vswr(self.position) < GOOD_VSWR:
+                    return TUNE_MATCHED
+            elif ref > refMin + REF_RISE:
+                break
+            ticks -= 1
+            if ticks <= 0:
+                return TUNE_ABORTED
+            self.position += step
+            self.elapsed += EX_LOOP_SLEEP
+        # Stop, the actuator runs on a little
+        self.position += direction*RUN_ON*self.__rate(speed)
+        if not descended:
+            return TUNE_NO_MATCH
+        if self.__legacy:
+            self.__nudge()
+        else:
+            # Settle as TUNE_STOPPING before the first probe
+            self.elapsed += MOTOR_DELAY
+            self.__refine(rawMin, self.position*RAW_PER_PERCENT)
+        return TUNE_MATCHED
+
+    def __nudge(self):
+        """ The legacy tail, nudge either way until the reflected reading improves """
+
+        while self.__loop.vswr(self.position) > GOOD_VSWR:
+            if self.probes >= NUDGE_LIMIT:
+                self.bounced = True
+                return
+            for sign in (1.0, -1.0):
+                ref1 = self.__loop.reflected(self.position)
+                self.position += sign*NUDGE/RAW_PER_PERCENT
+                self.elapsed += NUDGE_TIME
+                self.probes += 1
+                if self.__loop.reflected(self.position) < ref1:
+                    return
+            self.elapsed += MOTOR_DELAY
+
+    def __probe(self, raw):
+        """ As probeStart() and the settle in tuneStep() """
+
+        self.__move(raw/RAW_PER_PERCENT, SLOW_TUNE_SPEED_VALUE)
+        self.elapsed += MOTOR_DELAY
+        self.probes += 1
+        return self.__loop.reflected(self.position)
+
+    def __refine(self, rawMin, rawEnd):
+        """ As refineStart() and refineNext() """
+
+        span = abs(rawEnd - rawMin)
+        a = rawMin - span
+        b = rawMin + span
+        c = b - GOLDEN_RATIO*(b - a)
+        d = a + GOLDEN_RATIO*(b - a)
+        fc = self.__probe(c)
+        fd = self.__probe(d)
+        atC = False
+        while self.probes < REFINE_MOVES and (b - a) > REFINE_RESOLUTION and fc > 0 and fd > 0:
+            if fc < fd:
+                b, d, fd = d, c, fc
+                c = b - GOLDEN_RATIO*(b - a)
+                fc = self.__probe(c)
+                atC = True
+            else:
+                a, c, fc = c, d, fd
+                d = a + GOLDEN_RATIO*(b - a)
+                fd = self.__probe(d)
+                atC = False
+        if fc < fd and not atC:
+            self.__probe(c)
+        elif fd < fc and atC:
+            self.__probe(d)
+
+def _summary(values):
+    values = sorted(values)
+    return sum(values)/len(values), values[int(0.9*(len(values) - 1))]
+
+def main():
+    """ Seconds of TX to a match for each search and for warm starts """
+
+    parser = argparse.ArgumentParser(description='Benchmark the tuning searches')
+    parser.add_argument('--trials', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # Prediction error (sd % extension) and window, from a recent tune and from the setpoints
+    warmCases = [(1.0, WARM_WINDOW_CACHED), (2.0, WARM_WINDOW_CACHED), (2.0, WARM_WINDOW), (4.0, WARM_WINDOW), (8.0, WARM_WINDOW)]
+    results = {}
+    def record(name, controller, found = None):
+        entry = results.setdefault(name, {'time': [], 'vswr': [], 'probes': [], 'bounced': 0, 'found': 0})
+        entry['time'].append(controller.elapsed)
+        entry['vswr'].append(controller.vswr())
+        entry['probes'].append(controller.probes)
+        entry['bounced'] += 1 if controller.bounced else 0
+        entry['found'] += 1 if found else 0
+    for _ in range(args.trials):
+        # Some loops will not match better than 1.5:1
+        loop = Loop(rng.uniform(25.0, 75.0), minimum = rng.uniform(1.0, 1.5), noise = 2, rng = rng)
+        # The actuator is left a little off by tracking or the last tune
+        start = loop.resonance + rng.gauss(0.0, 3.0)
+        for name, legacy in (('legacy linear sweep', True), ('bracket + golden section', False)):
+            controller = Controller(loop, start, legacy = legacy)
+            controller.tune()
+            record(name, controller)
+        for error, window in warmCases:
+            controller = Controller(loop, start)
+            _, found = controller.warmTune(int(round(loop.resonance + rng.gauss(0.0, error))), window)
+            record('warm +/-%d%%, error sd %.0f%%' % (window, error), controller, found)
+    print('%-32s %14s %14s %10s %8s %9s' % ('', 'TX s mean/p90', 'VSWR mean/p90', 'probes', 'bounced', 'in window'))
+    for name, entry in results.items():
+        time, time90 = _summary(entry['time'])
+        ratio, ratio90 = _summary(entry['vswr'])
+        probes = sum(entry['probes'])/float(len(entry['probes']))
+        print('%-32s %6.1f /%6.1f %6.2f /%6.2f %10.1f %7d%% %8d%%' % (name, time, time90, ratio, ratio90, probes,
+            100*entry['bounced']/args.trials, 100*entry['found']/args.trials))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
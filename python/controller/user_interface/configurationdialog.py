@@ -53,16 +53,14 @@ Configuration dialog
 """
 class ConfigurationDialog(QtGui.QDialog):
     
-    def __init__(self, cat_inst, dispatcher_inst, api_inst, main_q, priority_q, settings, current_loop, callback, parent = None):
+    def __init__(self, cat_inst, scheduler_inst, api_inst, settings, current_loop, callback, parent = None):
         """
         Constructor
         
         Arguments:
             cat_inst        --  CAT class instance
-            dispatcher_inst --  Dispatcher instance
+            scheduler_inst  --  Command scheduler instance
             api_inst        --  Controller API instance
-            main_q          --  Main dispatcher queue
-            priority_q      --  Priority dispatcher queue
             settings        --  see common.py DEFAULT_SETTINGS for structure
             current_loop    --  selected loop
             callback        --  callback here with status messages
@@ -85,10 +83,9 @@ class ConfigurationDialog(QtGui.QDialog):
         self.__api.stealEvntCallback(self.__evntCallback)
         # Forward some event messages
         self.__evntForwardCallback = self.__api.originalEvntCallback()
-        # Get the dispatcher queues and redirect the execution callback
-        self.__q = main_q
-        self.__p_q = priority_q
-        dispatcher_inst.stealCallback(self.__executionCallback)
+        # Get the command scheduler and redirect the execution callback
+        self.__scheduler = scheduler_inst
+        self.__scheduler.stealCallback(self.__executionCallback)
         
         # Create the UI interface elements
         self.__initUI()
@@ -856,15 +853,14 @@ Set the COM port and baud rate for serial communication.
     # A static method which is called to create and execute the dialog
     # A response constructor
     @staticmethod
-    def getConfig(cat_inst, dispatcher_inst, api_inst, main_q, settings, current_loop, callback, parent = None):
+    def getConfig(cat_inst, scheduler_inst, api_inst, settings, current_loop, callback, parent = None):
         """
         Start a new dialog session
         
         Arguments:
             cat_inst        --  CAT class instance
-            dispatcher_inst --  Dispatcher instance
-            main_q          --  Main dispatcher queue
-            priority_q      --  Priority dispatcher queue
+            scheduler_inst  --  Command scheduler instance
+            api_inst        --  Controller API instance
             settings        --  current settings list
             current-loop    --  selected loop
             callback        -- callback here with status messages
@@ -873,7 +869,7 @@ Set the COM port and baud rate for serial communication.
         """
         
         # Do dialog
-        dialog = ConfigurationDialog(cat_inst, dispatcher_inst, api_inst, main_q, settings, current_loop, callback, parent)
+        dialog = ConfigurationDialog(cat_inst, scheduler_inst, api_inst, settings, current_loop, callback, parent)
         result = dialog.exec_()
         response = dialog.response(result == QtGui.QDialog.Accepted)
         dialog.cleanup()    
@@ -957,7 +953,7 @@ Set the COM port and baud rate for serial communication.
         else:
             self.__settings[ARDUINO_SETTINGS][ANALOG_REF] = INTERNAL
         
-        self.__q.put((self.__api.setAnalogRef, 'analogref', (self.__settings[ARDUINO_SETTINGS][ANALOG_REF])))
+        self.__scheduler.submit(self.__api.setAnalogRef, 'analogref', (self.__settings[ARDUINO_SETTINGS][ANALOG_REF]), coalesce = 'analogref')
     
     # ========================================================================================
     # Loop event handlers
@@ -994,7 +990,10 @@ Set the COM port and baud rate for serial communication.
         """ Add new loop parameters to the configuration """
         
         if self.loopnametxt.text() not in self.__settings[LOOP_SETTINGS]:
-            self.__settings[LOOP_SETTINGS][self.loopnametxt.text()] = [[], [], [], [], {}, []]
+            self.__settings[LOOP_SETTINGS][self.loopnametxt.text()] = [[], [], [], [], {}, [], {}]
+        elif len(self.__settings[LOOP_SETTINGS][self.loopnametxt.text()]) <= I_BANDWIDTH:
+            # Configured before bandwidth was measured
+            self.__settings[LOOP_SETTINGS][self.loopnametxt.text()].append({})
         
         self.__settings[LOOP_SETTINGS][self.loopnametxt.text()][I_POT] =  [self.mincapsb.value(), self.maxcapsb.value()]
         self.__settings[LOOP_SETTINGS][self.loopnametxt.text()][I_FREQ] =  [self.freqlowertxt.text(), self.frequppertxt.text()]
@@ -1086,9 +1085,9 @@ Set the COM port and baud rate for serial communication.
                 self.__lfTuneInProgress = True
                 self.__spTuneInProgress = False
                 self.__hfTuneInProgress = False
-                self.__q.put((self.__api.setHighSetpoint, 'sethighsetpoint', (0)))
-                self.__q.put((self.__api.setLowSetpoint, 'setlowsetpoint', (100)))
-                self.__q.put((self.__api.tune, 'tune', ()))
+                self.__scheduler.submit(self.__api.setHighSetpoint, 'sethighsetpoint', (0), coalesce = 'highsetpoint')
+                self.__scheduler.submit(self.__api.setLowSetpoint, 'setlowsetpoint', (100), coalesce = 'lowsetpoint')
+                self.__scheduler.submit(self.__api.tune, 'tune', ())
             else:
                 # No forward power
                 QtGui.QMessageBox.information(self, 'Band Setpoints', 'No RF power detected, please try again.', QtGui.QMessageBox.Ok)
@@ -1096,7 +1095,7 @@ Set the COM port and baud rate for serial communication.
     def __lfAbortTune(self):
         """ Abort tuning """
         
-        self.__p_q.put((self.__api.stop, 'stop', ()))
+        self.__scheduler.submit(self.__api.stop, 'stop', (), PRIORITY_STOP)
         
     def __hfTune(self, ):
         """ Find the extension % for the upper band edge """
@@ -1112,9 +1111,9 @@ Set the COM port and baud rate for serial communication.
                 self.__hfTuneInProgress = True
                 self.__spTuneInProgress = False
                 self.__lfTuneInProgress = False
-                self.__q.put((self.__api.setHighSetpoint, 'sethighsetpoint', (0)))
-                self.__q.put((self.__api.setLowSetpoint, 'setlowsetpoint', (100)))
-                self.__q.put((self.__api.tune, 'tune', ()))
+                self.__scheduler.submit(self.__api.setHighSetpoint, 'sethighsetpoint', (0), coalesce = 'highsetpoint')
+                self.__scheduler.submit(self.__api.setLowSetpoint, 'setlowsetpoint', (100), coalesce = 'lowsetpoint')
+                self.__scheduler.submit(self.__api.tune, 'tune', ())
             else:
                 # No forward power
                 QtGui.QMessageBox.information(self, 'Band Setpoints', 'No RF power detected, please try again.', QtGui.QMessageBox.Ok)    
@@ -1122,7 +1121,7 @@ Set the COM port and baud rate for serial communication.
     def __hfAbortTune(self):
         """ Abort tuning """
         
-        self.__p_q.put((self.__api.stop, 'stop', ()))
+        self.__scheduler.submit(self.__api.stop, 'stop', (), PRIORITY_STOP)
 
     # ========================================================================================
     # Pot event handlers
@@ -1173,7 +1172,7 @@ Set the COM port and baud rate for serial communication.
         self.__lfTuneInProgress = False
         self.__hfTuneInProgress = False
         if self.__vswr[0] > 0:
-            self.__q.put((self.__api.tune, 'tune', ()))
+            self.__scheduler.submit(self.__api.tune, 'tune', ())
         else:
             # No forward power
             self.__statusCallback ('Please key TX!')
@@ -32,6 +32,7 @@ import queue
 import math
 import threading
 import traceback
+import time
 from PyQt4 import QtCore, QtGui
 
 sys.path.append(os.path.join('..', '..'))
@@ -40,10 +41,18 @@ sys.path.append(os.path.join('..','..','..','..','..','Common','trunk','python')
 # Application imports
 from common.defs import *
 import tracking
+import trackerpool
 import configurationdialog
 from controller.hw_interface import dispatcher
+from controller.hw_interface import link
+from controller.hw_interface import protocol
 from common import vswr
+from common import bandwidth
+from common import setpoints
+from common import trace
+from common import learning
 from common import persist
+from common import latency
 
 # Common files
 import cat
@@ -54,6 +63,9 @@ GUI UI for loop controller
 """
 class LoopUI(QtGui.QMainWindow):
     
+    # A tune succeeded (sweep measured, % extension, VSWR), emitted on the scheduler thread
+    tuned = QtCore.pyqtSignal(bool, float, object)
+    
     def __init__(self, qt_app):
         """
         Constructor
@@ -78,6 +90,9 @@ class LoopUI(QtGui.QMainWindow):
         self.__running = False              # True when commands executing
         self.__progress = 0                 # %complete
         self.__vswr = [0.0,0.0]             # Relative VSWR reading
+        self.__autoTuneStats = None         # (ms TX, ms mistuned, searches) from the sketch while autotune is on
+        self.__noiseFloor = None            # (pot, fwd, ref) noise floors from the sketch
+        self.__telemetrySeq = None          # Sequence number of the last telemetry frame used
         self.__realExtension = 0            # Pot real analog value (0 - 1023)
         self.__virtualExtension = 0         # Normalised analog value (0-100%)
         self.__statusMessage = ''           # Status bar message
@@ -96,6 +111,15 @@ class LoopUI(QtGui.QMainWindow):
         self.__relays_set = False           # True when initial relay state set
         self.__isTX = False                 # True if TX
         self.__autoTuneState = False        # Auto-tune off
+        self.__relayMask = None             # Relay mask last requested
+        self.__sweep = bandwidth.BandwidthSweep()   # Bandwidth measured during a tune
+        self.__sweeping = False             # True while a tune is running
+        self.__lastResponse = ''            # Last command response
+        self.__retargets = 0                # Tracking moves retargeted while in progress
+        self.__retargetSaved = 0.0          # Estimated actuator seconds saved by retargeting
+        self.__trace = None                 # Trace being recorded while tracking
+        self.__tuneCache = learning.TuneCache() # Recent tune results for a warm start
+        self.__tablePoints = None           # Setpoint table last given to the controller
        
         # Retrieve settings and state ( see common.py DEFAULTS for strcture)
         self.__settings = persist.getSavedCfg(SETTINGS_PATH)
@@ -106,16 +130,17 @@ class LoopUI(QtGui.QMainWindow):
         # Create the Loop API
         self.__api = loop_control_if.ControllerAPI(self.__settings[ARDUINO_SETTINGS][NETWORK], self.__respCallback, self.__evntCallback)
         
-        # Create the command execution thread
-        # A command queue with max 20 items
-        self.__q = queue.Queue(20)
-        # Create and start the thread
-        self.__executeThrd = dispatcher.CommandExecutionThrd(self.__q, self.__executeCallback)
-        self.__executeThrd.start()
-        # and the priority thread
-        self.__p_q = queue.Queue(20)
-        self.__priorityThrd = dispatcher.CommandPriorityThrd(self.__p_q)
-        self.__priorityThrd.start()
+        # Create the pipelined link, used for batches of commands and binary events when the controller supports them
+        self.__link = link.ControllerLink(self.__settings[ARDUINO_SETTINGS][NETWORK], self.__respCallback, self.__frameCallback)
+        self.__link.start()
+        
+        # Create and start the command scheduler
+        # Command latencies, shared with the schedulers of further stations
+        self.__latency = latency.CommandLatency()
+        self.__scheduler = dispatcher.CommandScheduler(self.__executeCallback, latencies = self.__latency)
+        self.__scheduler.start()
+        # Tune results change the settings so they are handled on this thread
+        self.tuned.connect(self.__tuned)
         
         # Create the CAT interface
         self.__cat_running = False
@@ -134,7 +159,19 @@ class LoopUI(QtGui.QMainWindow):
             
         # Create the Tracking instance
         self.__tracking = tracking.Tracking(self.__cat, self.__settings[CAT_SETTINGS][VARIANT], self.__settings, self.__loop, self.__track_callback)
-        self.__tracking.start()
+        self.__tracking.set_mode(self.__state.get(TRACK_MODE, TRACK_FOLLOW))
+        
+        # One thread polls this and any further stations' trackers
+        self.__pool = trackerpool.TrackerPool()
+        self.__pool.add('main', self.__tracking)
+        self.__pool.start()
+        self.__stations = []
+        for index, station in enumerate(self.__settings.get(STATIONS, [])):
+            if station[STATION_LOOP] not in self.__settings[LOOP_SETTINGS]:
+                print('Station %d loop %s is not configured!' % (index+1, station[STATION_LOOP]))
+                continue
+            self.__stations.append(trackerpool.Station('station%d' % (index+1), station, self.__settings, self.__pool, self.__latency, self.__stationCallback))
+            self.__stations[-1].start()
             
         # Initialise the GUI
         self.initUI()
@@ -171,52 +208,40 @@ class LoopUI(QtGui.QMainWindow):
                         break
             
             if self.__connected:
-                # Set the analog reference
-                self.__q.put((self.__api.setAnalogRef, 'analogref', (self.__settings[ARDUINO_SETTINGS][ANALOG_REF])))
-                
-                # Set the Capacitor limits
-                if self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MAXCAP] != None and self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MINCAP] != None:
-                    self.__q.put((self.__api.setCapMaxSetpoint, 'capmaxsetpoint', (self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MAXCAP])))
-                    self.__q.put((self.__api.setCapMinSetpoint, 'capminsetpoint', (self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MINCAP])))
-                    
-                # Set the loop limits
-                try:
-                    lowSetpoint = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_OFFSETS][I_LOW_FREQ]
-                    if lowSetpoint != None: self.__q.put((self.__api.setLowSetpoint, 'setlowsetpoint', (lowSetpoint)))
-                except:
-                    pass
-                try:
-                    highSetpoint = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_OFFSETS][I_HIGH_FREQ]
-                    if highSetpoint != None: self.__q.put((self.__api.setHighSetpoint, 'sethighsetpoint', (highSetpoint)))
-                except:
-                    pass
-                
                 # Set speed
+                speed = None
                 try:
                     if self.speedslow.isChecked():
                         speed = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_PARAMS][I_SLOW]
                     elif self.speedmed.isChecked():
-                        speed = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_PARAMS][I_MED]
+                        speed = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_PARAMS][I_MEDIUM]
                     elif self.speedfast.isChecked():
                         speed = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_PARAMS][I_FAST]
-                    self.__q.put((self.__api.speed, 'speed', (speed)))
+                    if speed != None: self.__tracking.set_speed(speed)
                 except:
-                    pass
+                    speed = None
+                
+                # Analog reference, capacitor and loop limits and speed as one set
+                commands = protocol.startupCommands(self.__settings[ARDUINO_SETTINGS][ANALOG_REF], self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()], speed)
+                # See what the controller supports before sending them
+                self.__scheduler.submit(self.__negotiate, 'negotiate', ([('startup', commands)], str(self.loopcombo.currentText())), preemptible = False)
                 
         # Returns when application exists
         r = self.__qt_app.exec_()
         
         # Terminate threads
         self.__cat.terminate()
-        self.__tracking.terminate()
-        self.__tracking.join()
+        for station in self.__stations:
+            station.terminate()
+        self.__pool.terminate()
+        self.__pool.join()
+        self.__stopTrace()
         self.__api.terminate()
-        if self.__executeThrd.isAlive():
-            self.__executeThrd.terminate()
-            self.__executeThrd.join()
-        if self.__priorityThrd.isAlive():
-            self.__priorityThrd.terminate()
-            self.__priorityThrd.join()        
+        self.__link.terminate()
+        self.__link.join()
+        if self.__scheduler.is_alive():
+            self.__scheduler.terminate()
+            self.__scheduler.join()
         
         return r
     
@@ -257,6 +282,10 @@ class LoopUI(QtGui.QMainWindow):
         configAction.setShortcut('Ctrl+C')
         configAction.setStatusTip('Configure controller')
         configAction.triggered.connect(self.__configEvnt)
+        statsAction = QtGui.QAction(QtGui.QIcon('stats.png'), '&Statistics', self)        
+        statsAction.setShortcut('Ctrl+S')
+        statsAction.setStatusTip('Command statistics')
+        statsAction.triggered.connect(self.statistics)
         
         menubar = self.menuBar()
         fileMenu = menubar.addMenu('&File')
@@ -264,6 +293,7 @@ class LoopUI(QtGui.QMainWindow):
         configMenu = menubar.addMenu('&Edit')
         configMenu.addAction(configAction)
         helpMenu = menubar.addMenu('&Help')
+        helpMenu.addAction(statsAction)
         helpMenu.addAction(aboutAction)
         
         #======================================================================================
@@ -354,6 +384,18 @@ class LoopUI(QtGui.QMainWindow):
         self.trackingbtn.setCheckable(True)
         buttonvbox.addWidget(self.trackingbtn)
         self.trackingbtn.clicked.connect(self.__rxtracking)               
+        # Configure predictive tracking
+        self.chasecb = QtGui.QCheckBox('Chase VFO')
+        self.chasecb.setToolTip('Aim ahead of a moving VFO when tracking')
+        self.chasecb.setChecked(self.__state.get(TRACK_MODE, TRACK_FOLLOW) == TRACK_CHASE)
+        buttonvbox.addWidget(self.chasecb)
+        self.chasecb.stateChanged.connect(self.__chase)
+        # Configure setpoint learning
+        self.learncb = QtGui.QCheckBox('Learn setpoints')
+        self.learncb.setToolTip('Refine the setpoints from each successful tune')
+        self.learncb.setChecked(self.__state.get(LEARN, False))
+        buttonvbox.addWidget(self.learncb)
+        self.learncb.stateChanged.connect(self.__learn)
         
         #======================================================================================
         # Motor speed
@@ -427,6 +469,14 @@ class LoopUI(QtGui.QMainWindow):
         self.vswrle.setText("-RX-")
         self.vswrle.setStyleSheet("QLabel {color: rgb(232,75,0); font: 14px}")
         statusgrid.addWidget(self.vswrle, 0, 1)
+        self.mistunedlabel = QtGui.QLabel(self)
+        self.mistunedlabel.setText('Mistuned')
+        self.mistunedlabel.setStyleSheet("QLabel {color: rgb(78,78,78); font: 10px}")
+        statusgrid.addWidget(self.mistunedlabel, 0, 3)
+        self.mistunedvalue = QtGui.QLabel(self)
+        self.mistunedvalue.setText('_')
+        self.mistunedvalue.setStyleSheet("QLabel {color: rgb(78,78,78); font: 10px}")
+        statusgrid.addWidget(self.mistunedvalue, 0, 4)
         
         self.fwdlabel = QtGui.QLabel(self)
         self.fwdlabel.setText('Fwd')
@@ -534,6 +584,32 @@ Loop Controller
     email:  bob@bobcowdery.plus.com
 """
         QtGui.QMessageBox.about(self, 'About', text)
+    
+    def statistics(self):
+        """ User hit statistics """
+        
+        stats = self.__scheduler.stats()
+        text = 'Scheduler\n'
+        text += '    queued %d (deepest %d)\n' % (stats['depth'], stats['maxdepth'])
+        text += '    cancelled by stop %d, expired %d, superseded %d\n' % (stats['cancelled'], stats['expired'], stats['coalesced'])
+        for key, count in sorted(stats['retargeted'].items()):
+            text += '    retargeted %s %d\n' % (key, count)
+        for policy, count in sorted(stats['overflows'].items()):
+            text += '    queue full %s %d\n' % (policy, count)
+        text += '    stop to idle %s\n' % latency.summary(stats['stoplatency'])
+        for station in self.__stations:
+            stats = station.stats()
+            text += '    %s queued %d (deepest %d), expired %d, superseded %d\n' % (station.name(), stats['depth'], stats['maxdepth'], stats['expired'], stats['coalesced'])
+        text += '\nCommands (queued / executing)\n'
+        for name, histograms in sorted(self.__latency.snapshot().items()):
+            text += '    %s: %s / %s\n' % (name, latency.summary(histograms['wait']), latency.summary(histograms['run']))
+        text += '\nTrackers\n'
+        for name, tracker in sorted(self.__pool.stats().items()):
+            text += '    %s: %s, %.1f requests/s\n' % (name, tracker['source'], tracker['load'])
+            text += '        request late %s\n' % latency.summary(tracker['late'])
+            text += '        CAT response %s\n' % latency.summary(tracker['cat'])
+            text += '        lag %s\n' % latency.summary(tracker['lag'], '%', 1)
+        QtGui.QMessageBox.information(self, 'Statistics', text, QtGui.QMessageBox.Ok)
                
     def quit(self):
         """ User hit quit """
@@ -574,15 +650,22 @@ Loop Controller
             
         """
         
-        self.__settings, r = configurationdialog.ConfigurationDialog.getConfig(self.__cat, self.__executeThrd, self.__api, self.__q, self.__p_q, self.__settings, self.loopcombo.currentText(), self.__statusCallback)
+        # The dialog takes the text events from the API
+        framing = self.__link.framing()
+        if framing != protocol.FRAMING_ASCII:
+            self.__scheduler.submit(self.__link.setFraming, 'framing', protocol.FRAMING_ASCII, preemptible = False)
+        self.__settings, r = configurationdialog.ConfigurationDialog.getConfig(self.__cat, self.__scheduler, self.__api, self.__settings, self.loopcombo.currentText(), self.__statusCallback)
         # Restore the magcontrol callback in case it was nicked
         self.__api.restoreRespCallback()
         self.__api.restoreEvntCallback()
-        self.__executeThrd.restoreCallback()
+        self.__scheduler.restoreCallback()
+        if framing != protocol.FRAMING_ASCII:
+            self.__scheduler.submit(self.__link.setFraming, 'framing', framing, preemptible = False)
         # If Ok save the new config and update internally
         if r:
             # Settings
             persist.saveCfg(SETTINGS_PATH, self.__settings)
+            self.__tracking.invalidate()
             # Update the UI
             self.loopcombo.clear()
             self.freqcombo.clear()
@@ -596,15 +679,22 @@ Loop Controller
                 self.loopcombo.clear()
             # Network settings
             self.__api.resetNetworkParams(self.__settings[ARDUINO_SETTINGS][NETWORK][IP], self.__settings[ARDUINO_SETTINGS][NETWORK][PORT])
-                
+            self.__link.resetNetworkParams(self.__settings[ARDUINO_SETTINGS][NETWORK][IP], self.__settings[ARDUINO_SETTINGS][NETWORK][PORT])
             # Pot limit settings
+            commands = []
             if self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MAXCAP] != None and self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MINCAP] != None:
-                self.__q.put((self.__api.setCapMaxSetpoint, 'capmaxsetpoint', (self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MAXCAP])))
-                self.__q.put((self.__api.setCapMinSetpoint, 'capminsetpoint', (self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MINCAP])))
+                commands.append(('setCapMaxSetpoint', self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MAXCAP]))
+                commands.append(('setCapMinSetpoint', self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MINCAP]))
                 
             # Band edge settings
-            self.__q.put((self.__api.setLowSetpoint, 'freqpminsetpoint', (self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_OFFSETS][I_LOW_FREQ])))
-            self.__q.put((self.__api.setHighSetpoint, 'freqmaxsetpoint', (self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_OFFSETS][I_HIGH_FREQ])))
+            commands.append(('setLowSetpoint', self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_OFFSETS][I_LOW_FREQ]))
+            commands.append(('setHighSetpoint', self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_OFFSETS][I_HIGH_FREQ]))
+            if self.__connected:
+                # The controller may have changed so find what it supports again
+                self.__scheduler.submit(self.__negotiate, 'negotiate', ([('limits', commands)], str(self.loopcombo.currentText())), preemptible = False)
+            else:
+                self.__configure('limits', commands)
+                self.__syncTable(str(self.loopcombo.currentText()))
 
     # ======================================================================================================
     # Main Event Handlers
@@ -622,19 +712,24 @@ Loop Controller
         
         # Adjust state
         self.__state[SELECTED_LOOP] = loop
+        self.__tracking.set_loop(loop)
+        self.__tuneCache.reset()
+        if self.__trace != None:
+            # A trace is for one loop
+            self.__stopTrace()
+            self.__startTrace()
         
         # Set the params
         self.__vswr = [0.0,0.0]
         
         # Select the correct relays for the loop
-        relayArray = self.__settings[LOOP_SETTINGS][loop][I_RELAYS]
-        if len(relayArray) == 4:
-            for relay, state in enumerate(relayArray):
-                self.__q.put((self.__api.setRelay, 'relay', (relay+1, int(state))))
+        commands = self.__relayCommands(self.__settings[LOOP_SETTINGS][loop][I_RELAYS])
                 
         # Band edge settings
-        self.__q.put((self.__api.setLowSetpoint, 'freqpminsetpoint', (self.__settings[LOOP_SETTINGS][loop][I_OFFSETS][I_LOW_FREQ])))
-        self.__q.put((self.__api.setHighSetpoint, 'freqmaxsetpoint', (self.__settings[LOOP_SETTINGS][loop][I_OFFSETS][I_HIGH_FREQ])))
+        commands.append(('setLowSetpoint', self.__settings[LOOP_SETTINGS][loop][I_OFFSETS][I_LOW_FREQ]))
+        commands.append(('setHighSetpoint', self.__settings[LOOP_SETTINGS][loop][I_OFFSETS][I_HIGH_FREQ]))
+        self.__configure('loopselect', commands)
+        self.__syncTable(str(loop))
     
     def __setSpeed(self, id):
         
@@ -655,23 +750,24 @@ Loop Controller
                 speed = self.__setFast()
             
             self.__speed = speed
+            self.__tracking.set_speed(speed)
     
     def __setSlow(self):
         
         speed = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_PARAMS][I_SLOW]
-        self.__q.put((self.__api.speed, 'speed', (speed)))
+        self.__scheduler.submit(self.__api.speed, 'speed', (speed), preemptible = False, coalesce = 'speed')
         return speed
     
     def __setMedium(self):
         
         speed = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_PARAMS][I_MEDIUM]
-        self.__q.put((self.__api.speed, 'speed', (speed)))
+        self.__scheduler.submit(self.__api.speed, 'speed', (speed), preemptible = False, coalesce = 'speed')
         return speed
     
     def __setFast(self):
         
         speed = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_PARAMS][I_FAST]
-        self.__q.put((self.__api.speed, 'speed', (speed)))
+        self.__scheduler.submit(self.__api.speed, 'speed', (speed), preemptible = False, coalesce = 'speed')
         return speed
     
     def __nudgeFwd(self):
@@ -680,7 +776,7 @@ Loop Controller
         nudgeExtension = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_PARAMS][I_NUDGE]
         analogMin = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MINCAP]
         analogMax = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MAXCAP]
-        self.__q.put((self.__api.nudge, 'nudge', (FORWARD, nudgeExtension, analogMin, analogMax)))
+        self.__scheduler.submit(self.__api.nudge, 'nudge', (FORWARD, nudgeExtension, analogMin, analogMax))
             
     def __nudgeRev(self):
         """ Nudge reverse from current position by the nudge % setting """
@@ -688,18 +784,27 @@ Loop Controller
         nudgeExtension = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_PARAMS][I_NUDGE]
         analogMin = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MINCAP]
         analogMax = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_POT][I_MAXCAP]
-        self.__q.put((self.__api.nudge, 'nudge', (REVERSE, nudgeExtension, analogMin, analogMax)))
+        self.__scheduler.submit(self.__api.nudge, 'nudge', (REVERSE, nudgeExtension, analogMin, analogMax))
             
     def __tune(self):
         """ Tune for lowest VSWR """
         
-        self.__q.put((self.__api.tune, 'tune', ()))
+        self.__sweep.reset()
+        self.__sweeping = True
+        start = self.__warmStart()
+        if start != None:
+            # Search around where the match should be before the whole span
+            self.__scheduler.submit(self.__warmTune, 'tune', start)
+        else:
+            self.__scheduler.submit(self.__api.tune, 'tune', ())
                      
     def __autotune(self):
         """ Set/reset auto tune """
         
         self.__autoTuneState = self.autotunebtn.isChecked()
-        self.__q.put((self.__api.autoTune, 'autotune', (self.__autoTuneState)))
+        # The sketch starts its totals again
+        self.__autoTuneStats = None
+        self.__scheduler.submit(self.__api.autoTune, 'autotune', (self.__autoTuneState))
         
     def __goto(self):
         
@@ -707,25 +812,36 @@ Loop Controller
        
         if self.selExtension.isChecked():
             # Move to extension setting
-            self.__q.put((self.__api.move, 'move', (self.exttosb.value(), True)))
+            self.__scheduler.submit(self.__api.move, 'move', (self.exttosb.value(), True), coalesce = 'move')
         elif self.selAnalog.isChecked():
             # Move to analog value setting
-            self.__q.put((self.__api.move, 'move', (self.exttosb.value(), False)))
+            self.__scheduler.submit(self.__api.move, 'move', (self.exttosb.value(), False), coalesce = 'move')
         elif self.selFreq.isChecked():
             # Move to the frequency setpoint
             setpoint = self.__settings[LOOP_SETTINGS][self.loopcombo.currentText()][I_SETPOINTS][self.freqcombo.currentText()]
-            self.__q.put((self.__api.move, 'move', (setpoint, True)))
+            self.__scheduler.submit(self.__api.move, 'move', (setpoint, True), coalesce = 'move')
         
     def __stop(self):
         
         """ Stop the motor """
         
-        if self.__running:
-            # Must be an interrupt stop, make priority
-            self.__p_q.put((self.__api.stop, 'stop', ()))
-        else:
-            self.__q.put((self.__api.stop, 'stop', ()))
+        # The scheduler interrupts any running command and cancels queued moves
+        self.__scheduler.submit(self.__api.stop, 'stop', (), PRIORITY_STOP)
     
+    def __chase(self):
+        """ Change tracking mode """
+        
+        if self.chasecb.isChecked():
+            self.__state[TRACK_MODE] = TRACK_CHASE
+        else:
+            self.__state[TRACK_MODE] = TRACK_FOLLOW
+        self.__tracking.set_mode(self.__state[TRACK_MODE])
+        
+    def __learn(self):
+        """ Change setpoint learning """
+        
+        self.__state[LEARN] = self.learncb.isChecked()
+        
     def __rxtracking(self):
         """ Change tracking state """
         
@@ -734,11 +850,13 @@ Loop Controller
             # Disable tracking
             self.__enable_tracking = False
             self.__tracking.pause_tracker()
+            self.__stopTrace()
             self.__absoluteExtension = None
             self.__currentFreq = None
         else:
             # Enable tracking
             self.__enable_tracking = True
+            self.__startTrace()
             self.__tracking.reset_tracker()
             self.__tracking.run_tracker()
         
@@ -756,11 +874,15 @@ Loop Controller
             
         """
          
+        self.__lastResponse = message
         try:
             # This set comes from command completions via magcontrol
             if 'success' in message:
                 # Completed, so reset
-                self.__statusMessage = 'Finished'
+                if protocol.moveResult(message) != None:
+                    self.__statusMessage = 'Finished in %dms, %d off target' % protocol.moveResult(message)
+                else:
+                    self.__statusMessage = 'Finished'
                 self.__progress = 100
             elif 'failure' in message:
                 # Error, so reset
@@ -772,6 +894,13 @@ Loop Controller
                 # Try a reset
                 if self.__state[SELECTED_LOOP] != None:
                     self.__api.resetNetworkParams(self.__settings[ARDUINO_SETTINGS][NETWORK][IP], self.__settings[ARDUINO_SETTINGS][NETWORK][PORT])
+                    self.__link.resetNetworkParams(self.__settings[ARDUINO_SETTINGS][NETWORK][IP], self.__settings[ARDUINO_SETTINGS][NETWORK][PORT])
+            elif protocol.relayState(message) != None:
+                # Relay state after a relay mask command
+                if self.__relayMask != None and protocol.relayState(message) != self.__relayMask:
+                    self.__statusMessage = '**Failed - relays set to %d not %d**' % (protocol.relayState(message), self.__relayMask)
+                else:
+                    self.__statusMessage = 'Finished'
             elif 'tx' in message:
                 # TX status request
                 _, status = message.split(':')
@@ -804,6 +933,17 @@ Loop Controller
             elif 'endbatch' in message:
                 # When we finish executing commands from the q
                 self.__running = False
+            elif 'overflow' in message:
+                # Command queue full, the scheduler applied the overflow policy
+                if 'rejected' in message:
+                    _, name, _, _ = message.split(':')
+                    self.__statusMessage = 'Busy, %s not queued!' % (name)
+            elif message == 'executed:tune':
+                # Pass where the tune finished to the main thread, see __tuned()
+                sweeping = self.__sweeping
+                self.__sweeping = False
+                if 'success' in self.__lastResponse:
+                    self.tuned.emit(sweeping, float(self.__virtualExtension), vswr.getVSWR(self.__vswr[0], self.__vswr[1]))
             elif 'name' in message:
                 # When we finish executing a command from the q
                 pass
@@ -840,8 +980,10 @@ Loop Controller
                 _, forward, reverse = message.split(':')
                 self.__vswr[0] = float(forward)
                 self.__vswr[1] = float(reverse)
+                if self.__sweeping: self.__sweep.vswr(self.__vswr[0], self.__vswr[1])
             elif 'pot' in message:
                 _, self.__realExtension, self.__virtualExtension = message.split(':')
+                if self.__sweeping: self.__sweep.pot(self.__virtualExtension)
             elif 'tx' in message:
                 # TX status request
                 _, status = message.split(':')
@@ -849,6 +991,10 @@ Loop Controller
                     self.__isTX = True
                 elif status == 'off':
                     self.__isTX = False
+            elif message.startswith(protocol.NOISE_PREFIX):
+                self.__noiseFloor = protocol.noiseFloor(message)
+            elif message.startswith(protocol.AUTOTUNE_PREFIX):
+                self.__autoTuneStats = protocol.autoTuneStats(message)
             elif 'alarm' in message:
                 _, reason = message.split(':')
                 if 'autotune' in reason:
@@ -857,6 +1003,48 @@ Loop Controller
         except Exception as e:
             self.__statusMessage = 'Exception getting event status!'
         
+    def __frameCallback(self, event, values):
+        
+        """
+        Callback for binary event frames, as __evntCallback() for the text events.
+        Not called from the main thread.
+        
+        Arguments:
+            event   --  frame event type
+            values  --  values of the event, see protocol.decodeFrame()
+            
+        """
+        
+        if event == protocol.EVENT_PROGRESS:
+            self.__progress = (100 - values[0])
+        elif event == protocol.EVENT_VSWR:
+            self.__vswr[0], self.__vswr[1] = values
+            if self.__sweeping: self.__sweep.vswr(self.__vswr[0], self.__vswr[1])
+        elif event == protocol.EVENT_POT:
+            self.__realExtension = values[0]
+            self.__virtualExtension = round(values[1], 1)
+            if self.__sweeping: self.__sweep.pot(self.__virtualExtension)
+        elif event == protocol.EVENT_TX:
+            self.__isTX = (values[0] != 0)
+        elif event == protocol.EVENT_NOISE:
+            self.__noiseFloor = values
+        elif event == protocol.EVENT_AUTOTUNE:
+            self.__autoTuneStats = values
+        elif event == protocol.EVENT_ALARM:
+            if values[0] == protocol.ALARM_AUTOTUNE:
+                self.__statusMessage = 'Autotune problem (excessive SWR?)!'
+                self.__autoTuneState = False
+        elif event == protocol.EVENT_TELEMETRY:
+            sequence, _, channels = values
+            if protocol.isStale(sequence, self.__telemetrySeq):
+                # Overtaken by a later frame
+                return
+            self.__telemetrySeq = sequence
+            # The pot first so a sweep pairs the VSWR with the position it was read at
+            for channel in (protocol.TELEMETRY_TX, protocol.TELEMETRY_POT, protocol.TELEMETRY_VSWR):
+                if channel in channels:
+                    self.__frameCallback(protocol.TELEMETRY_EVENTS[channel], channels[channel])
+        
     def __track_callback(self, form, freq, moveToExtension = None, message = ''):
         
         """
@@ -877,7 +1065,10 @@ Loop Controller
             self.__tracking.pause_tracker() # Stop updates            
             if form == TRACKING_TO_DEGS:
                 # Move to the given extension %
-                self.__q.put((self.__api.move, 'move', (int(moveToExtension), True)))
+                self.__scheduler.submit(self.__api.move, 'move', (int(moveToExtension), True), PRIORITY_TRACKING, coalesce = 'track-move', retarget = self.__retarget)
+            elif form == TRACKING_TO_FREQ:
+                # The controller holds the setpoints, move to the frequency
+                self.__scheduler.submit(self.__trackFreq, 'move', (freq, moveToExtension), PRIORITY_TRACKING, coalesce = 'track-freq', retarget = self.__retargetFreq)
             elif form == TRACKING_ERROR:
                 # Oops, something went wrong.
                 self.__statusMessage = 'Tracking problem! (%s)' % (message)
@@ -890,6 +1081,19 @@ Loop Controller
                 # Just a display current frequency
                 self.__currentFreq = freq
                
+    def __stationCallback(self, name, message):
+        """
+        Callback for status messages from the further stations. Note that this is
+        not called from the main thread.
+        
+        Arguments:
+            name    --  station name
+            message --  message text
+            
+        """
+        
+        self.__statusMessage = '%s: %s' % (name, message)
+        
     def __statusCallback(self, message):
         """
         Callback for status messages from the configuration dialog.
@@ -1014,12 +1218,14 @@ Loop Controller
             # Get TX state
             # Not currently used but may be needed in the future 
             #if self.__connected:
-            #    self.__q.put((self.__api.is_tx, 'istx', ()))
+            #    self.__scheduler.submit(self.__api.is_tx, 'istx', (), PRIORITY_BACKGROUND)
             
             # Display status
             self.__showVSWR()                               # Current fwd and ref and SWR if TXing
             self.virtualextvalue.setText('%s' % (str(self.__virtualExtension)))
             self.realextvalue.setText('(%s)' % (str(self.__realExtension)))
+            if self.__noiseFloor != None:
+                self.realextvalue.setToolTip('Noise +/- %.1f' % self.__noiseFloor[0])
             if self.__currentFreq == None:          
                 self.freqvalue.setText("_._")
             else:
@@ -1038,16 +1244,287 @@ Loop Controller
             if not self.__relays_set and not self.__running:
                 if self.__connected:
                     # Select the correct relays for the loop
-                    relayArray = self.__settings[LOOP_SETTINGS][self.__state[SELECTED_LOOP]][I_RELAYS]
-                    if len(relayArray) == 4:
-                        for relay, state in enumerate(relayArray):
-                            self.__q.put((self.__api.setRelay, 'relay', (relay+1, int(state))))
+                    self.__configure('relays', self.__relayCommands(self.__settings[LOOP_SETTINGS][self.__state[SELECTED_LOOP]][I_RELAYS]))
                     self.__relays_set = True                    
                 
         # Set next idle time    
         QtCore.QTimer.singleShot(IDLE_TICKER, self.__idleProcessing)
     
     # Helpers =========================================================================================================
+    def __tuned(self, sweeping, finished, ratio):
+        """
+        A tune succeeded, measure the bandwidth and learn from where it finished.
+        Connected to the tuned signal so it runs on the main thread.
+        
+        Arguments:
+            sweeping    --  True if the sweep was recorded for the bandwidth
+            finished    --  % extension the tune finished at
+            ratio       --  VSWR where the tune finished or None
+            
+        """
+        
+        if self.__tracking.frequency() != None:
+            self.__tuneCache.add(self.__tracking.frequency(), finished)
+        changed = False
+        if sweeping:
+            changed = self.__recordBandwidth()
+        if self.__state.get(LEARN, False):
+            changed = self.__learnSetpoint(finished, ratio) or changed
+        if changed:
+            # Keep what was learnt should we not exit cleanly
+            persist.saveCfg(SETTINGS_PATH, self.__settings)
+        
+    def __recordBandwidth(self):
+        """ Save the 2:1 bandwidth measured by the last tune against the current frequency, returns True if saved """
+        
+        loop = self.__state[SELECTED_LOOP]
+        freq = self.__tracking.frequency()
+        if loop == None or freq == None:
+            return False
+        curve = setpoints.SetpointCurve(self.__settings[LOOP_SETTINGS][loop][I_SETPOINTS])
+        widthKHz = bandwidth.toKHz(self.__sweep.width(), curve, freq/1000.0)
+        if widthKHz == None:
+            return False
+        if len(self.__settings[LOOP_SETTINGS][loop]) <= I_BANDWIDTH:
+            self.__settings[LOOP_SETTINGS][loop].append({})
+        self.__settings[LOOP_SETTINGS][loop][I_BANDWIDTH]['%.3f' % (freq/1000000.0)] = round(widthKHz, 2)
+        self.__tracking.invalidate(loop)
+        self.__statusMessage = 'Tune complete, bandwidth %.1f kHz' % (widthKHz)
+        return True
+        
+    def __warmStart(self):
+        """ Return (predicted extension, window) to tune around or None for a full sweep """
+        
+        if not self.__link.hasWarmTune():
+            return None
+        loop = self.__state[SELECTED_LOOP]
+        freq = self.__tracking.frequency()
+        if loop == None or freq == None:
+            return None
+        curve = setpoints.SetpointCurve(self.__settings[LOOP_SETTINGS][loop][I_SETPOINTS])
+        return learning.warmStart(curve, self.__tuneCache, freq, self.__tracking.deadband(freq))
+    
+    def __warmTune(self, args):
+        """
+        Tune within a window, the controller falls back to the full span
+        
+        Arguments:
+            args    --  (predicted extension, window)
+            
+        """
+        
+        reply = self.__link.send(protocol.encode('warmTune', args), TUNE_TIMEOUT).result()
+        self.__respCallback(reply)
+        if reply == protocol.WARM_MATCH:
+            self.__statusMessage = 'Tuned within %d%% of %d%%' % (args[1], args[0])
+        elif reply == protocol.FULL_MATCH:
+            self.__statusMessage = 'Tuned, not within %d%% of %d%%' % (args[1], args[0])
+    
+    def __learnSetpoint(self, finished, ratio):
+        """
+        Fold where the last tune finished into the setpoints for the current frequency,
+        returns True if the setpoints changed
+        
+        Arguments:
+            finished    --  % extension the tune finished at
+            ratio       --  VSWR where the tune finished or None
+            
+        """
+        
+        loop = self.__state[SELECTED_LOOP]
+        freq = self.__tracking.frequency()
+        if loop == None or freq == None:
+            return False
+        table = self.__settings[LOOP_SETTINGS][loop][I_SETPOINTS]
+        # Where tracking would have put the antenna, to show the correction
+        predicted = None
+        if len(table) > 0:
+            predicted = setpoints.SetpointCurve(table).extension(freq/1000.0)
+        learnt = learning.learn(table, freq/1000000.0, finished, ratio)
+        if learnt == None:
+            self.__statusMessage = 'Tune complete, VSWR too high to learn from'
+            return False
+        key, extension = learnt
+        self.__tracking.invalidate(loop)
+        self.__syncTable(loop)
+        if predicted != None:
+            self.__statusMessage = 'Learnt setpoint %s MHz at %d%% (setpoints were %+.1f%% out)' % (key, extension, finished - predicted)
+        else:
+            self.__statusMessage = 'Learnt setpoint %s MHz at %d%%' % (key, extension)
+        return True
+        
+    def __retarget(self, args):
+        """
+        Give an executing tracking move a new target, returns True if the controller took it.
+        Called on a scheduler thread so it must not touch Qt.
+        
+        Arguments:
+            args    --  (extension, True) as the move args
+            
+        """
+        
+        extension, isExtension = args
+        if not isExtension:
+            return False
+        saving = self.__tracking.retarget_saving(extension)
+        if not self.__link.retarget(extension):
+            # Finished or not a move, it will be queued instead
+            return False
+        self.__retargets += 1
+        self.__retargetSaved += saving
+        self.__statusMessage = 'Retargeted, %.1fs saved (%d retargets, %.1fs total)' % (saving, self.__retargets, self.__retargetSaved)
+        return True
+    
+    def __trackFreq(self, args):
+        """
+        Move to a frequency from the setpoint table held by the controller
+        
+        Arguments:
+            args    --  (frequency in Hz, extension tracking expects)
+            
+        """
+        
+        self.__respCallback(self.__link.send(protocol.encode('trackFreq', args[0]), MOVE_TIMEOUT).result())
+    
+    def __retargetFreq(self, args):
+        """
+        As __retarget() for a move to a frequency
+        
+        Arguments:
+            args    --  (frequency in Hz, extension tracking expects)
+            
+        """
+        
+        freq, extension = args
+        saving = self.__tracking.retarget_saving(extension)
+        if not protocol.retargeted(self.__link.send(protocol.encode('retargetFreq', freq)).result()):
+            return False
+        self.__retargets += 1
+        self.__retargetSaved += saving
+        self.__statusMessage = 'Retargeted, %.1fs saved (%d retargets, %.1fs total)' % (saving, self.__retargets, self.__retargetSaved)
+        return True
+    
+    def __syncTable(self, loop):
+        """
+        Give the controller the setpoint table for the selected loop if it can hold one
+        
+        Arguments:
+            loop    --  name of the selected loop
+            
+        """
+        
+        # Track by extension until the controller has the table
+        self.__tracking.set_device_table(False)
+        self.__tablePoints = None
+        if not self.__link.hasTable() or loop not in self.__settings[LOOP_SETTINGS]:
+            return
+        points = setpoints.SetpointCurve(self.__settings[LOOP_SETTINGS][loop][I_SETPOINTS], TRACKING_INTERPOLATION).table(protocol.MAX_TABLE_POINTS)
+        if points == None or len(points) == 0:
+            # Too many setpoints to hold or none, track by extension
+            return
+        self.__tablePoints = points
+        self.__scheduler.submit(self.__uploadTable, 'table', points, preemptible = False, coalesce = 'table')
+    
+    def __uploadTable(self, points):
+        """
+        Upload a setpoint table unless the controller already holds it, each upload writes EEPROM
+        
+        Arguments:
+            points  --  [(Hz, % extension), ...]
+            
+        """
+        
+        wanted = (len(protocol.tableEntries(points)), protocol.tableChecksum(points))
+        if protocol.tableState(self.__link.send(protocol.encode('getTable', ())).result()) != wanted:
+            self.__link.send(protocol.encode('clearTable', ())).result()
+            self.__link.execute([protocol.encode('addTablePoint', point) for point in points])
+            if protocol.tableState(self.__link.send(protocol.encode('saveTable', ())).result()) != wanted:
+                self.__statusMessage = 'Unable to give the controller the setpoint table'
+                return
+            self.__statusMessage = 'Setpoint table of %d points saved on the controller' % (wanted[0])
+        if points is self.__tablePoints:
+            # Still the table for the selected loop
+            self.__tracking.set_device_table(True)
+    
+    def __startTrace(self):
+        """ Record the CAT frequencies while tracking, for replay.py """
+        
+        if self.__trace != None or not os.path.isdir(TRACE_DIR):
+            return
+        loop = str(self.loopcombo.currentText())
+        path = os.path.join(TRACE_DIR, '%s_%s.trace' % (time.strftime('%Y%m%d_%H%M%S'), loop.replace(' ', '_')))
+        try:
+            self.__trace = trace.TraceWriter(path, loop)
+        except IOError as e:
+            self.__statusMessage = 'Unable to record trace (%s)' % (str(e))
+            return
+        self.__tracking.record(self.__trace)
+    
+    def __stopTrace(self):
+        """ Finish any trace being recorded """
+        
+        if self.__trace == None:
+            return
+        self.__tracking.record(None)
+        self.__trace.close()
+        self.__trace = None
+    
+    def __negotiate(self, args):
+        """
+        Find what the controller supports then send the configuration to suit, run by the
+        scheduler as negotiation takes several round trips
+        
+        Arguments:
+            args    --  ([(set name, [(ControllerAPI method name, args), ...]), ...], selected loop)
+            
+        """
+        
+        sets, loop = args
+        self.__link.negotiate()
+        for name, commands in sets:
+            self.__configure(name, commands)
+        # Telemetry is its own set so the other sets always fit one datagram
+        self.__configure('telemetry', self.__telemetryCommands())
+        self.__syncTable(loop)
+    
+    def __telemetryCommands(self):
+        """ Return the commands to set the telemetry periods when the controller frames telemetry """
+        
+        if self.__link.framing() < protocol.FRAME_TELEMETRY:
+            return []
+        self.__telemetrySeq = None
+        commands = []
+        for channel in (protocol.TELEMETRY_TX, protocol.TELEMETRY_VSWR, protocol.TELEMETRY_POT):
+            commands.append(('setTelemetryIdle', (channel, TELEMETRY_IDLE[channel])))
+            commands.append(('setTelemetryBusy', (channel, TELEMETRY_BUSY[channel])))
+        return commands
+    
+    def __relayCommands(self, relayArray):
+        """
+        Return the commands to set the relays for a loop
+        
+        Arguments:
+            relayArray  --  state of relay 1, 2 ...
+            
+        """
+        
+        commands = protocol.relayCommands(relayArray, self.__link.hasRelayMask())
+        if len(commands) > 0:
+            self.__relayMask = protocol.relayMask(relayArray)
+        return commands
+        
+    def __configure(self, name, commands):
+        """
+        Send a set of configuration commands
+        
+        Arguments:
+            name        --  dispatcher name for the set, a newer set with the same name replaces a queued one
+            commands    --  list of (ControllerAPI method name, args)
+            
+        """
+        
+        link.configure(self.__scheduler, self.__link, self.__api, name, commands)
+        
     def __setButtonState(self, enabled, widgets):
         """
         Set enabled/disabled state
@@ -1077,11 +1554,19 @@ Loop Controller
             # Show actuals
             self.fwdvalue.setText('%d' % int(self.__vswr[0]))
             self.refvalue.setText('%d' % int(self.__vswr[1]))            
+            if self.__noiseFloor != None:
+                self.fwdvalue.setToolTip('Noise +/- %.1f' % self.__noiseFloor[1])
+                self.refvalue.setToolTip('Noise +/- %.1f' % self.__noiseFloor[2])
         else:
             # RX mode
             self.vswrle.setText("-RX-")
             self.fwdvalue.setText('_')
             self.refvalue.setText('_')
+        # Share of TX time above the autotune VSWR since autotune went on
+        if self.__autoTuneStats != None and self.__autoTuneStats[0] > 0:
+            self.mistunedvalue.setText('%d%%' % (100*self.__autoTuneStats[1]/self.__autoTuneStats[0]))
+        else:
+            self.mistunedvalue.setText('_')
  
 #======================================================================================================================
 # Main code
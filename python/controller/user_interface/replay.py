@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# replay.py
+#
+# Replay recorded CAT frequency traces through tracking
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os,sys
+import argparse
+from bisect import bisect_right
+
+sys.path.append(os.path.join('..', '..'))
+
+# Application imports
+from common.defs import *
+from common import clock
+from common import trace
+import tracking
+
+"""
+Tracking is normally driven by a live CAT instance in real time. To compare tracking
+modes and settings reproducibly a recorded trace (see common.trace) is replayed through
+Tracking against a FakeCAT, which answers each frequency request from the trace, and a
+FakeDispatcher, which records the moves tracking asks for. A VirtualClock stands in for
+real time so an hour of operating replays in a fraction of a second. For a variant in
+CAT_TRANSCEIVE the FakeCAT also pushes each frequency change at its time in the trace.
+
+Usage:
+    python replay.py trace [trace ...] [--loop name] [--mode follow|chase] [--speed n] [--variant name]
+"""
+class FakeCAT:
+
+    def __init__(self, samples, clk, on_end, push = False):
+        """
+        Constructor
+
+        Arguments:
+            samples --  [(seconds, Hz), ...] from the trace
+            clk     --  the virtual clock tracking runs on
+            on_end  --  called when the trace is exhausted
+            push    --  push frequency changes as a transceive rig does
+
+        """
+
+        self.__times = [t for t, _ in samples]
+        self.__freqs = [freq for _, freq in samples]
+        self.__clock = clk
+        self.__on_end = on_end
+        self.__callback = None
+        self.__start = clk.monotonic()
+        self.requests = 0
+        self.pushes = 0
+        if push:
+            last = None
+            for t, freq in samples:
+                if freq != last:
+                    clk.call_at(self.__start + t, lambda freq = freq: self.__push(freq))
+                    last = freq
+            if len(samples) > 0:
+                clk.call_at(self.__start + samples[-1][0], on_end)
+
+    def set_callback(self, callback):
+        """ Response callback, as cat.CAT """
+
+        self.__callback = callback
+
+    def do_command(self, command):
+        """ Answer a frequency request with the trace frequency at the current time """
+
+        if command != CAT_FREQ_GET:
+            return
+        t = self.__clock.monotonic() - self.__start
+        if len(self.__times) == 0 or t > self.__times[-1]:
+            self.__on_end()
+            return
+        self.requests += 1
+        i = max(0, bisect_right(self.__times, t) - 1)
+        self.__callback((True, self.__freqs[i]))
+
+    def terminate(self):
+        """ As cat.CAT """
+
+        pass
+
+    def __push(self, freq):
+        """ An unsolicited frequency frame """
+
+        if self.__callback != None:
+            self.pushes += 1
+            self.__callback((True, freq))
+
+class FakeDispatcher:
+
+    def __init__(self):
+        """ Records the moves tracking asks for in place of LoopUI and the scheduler """
+
+        self.moves = []         # [% extension, ...]
+        self.errors = []
+
+    def callback(self, form, *args):
+        """ Tracking callback """
+
+        if form == TRACKING_TO_DEGS:
+            self.moves.append(args[1])
+        elif form == TRACKING_ERROR:
+            self.errors.append(args[-1])
+
+    def travel(self):
+        """ Total % extension travelled between the moves """
+
+        return sum(abs(b - a) for a, b in zip(self.moves, self.moves[1:]))
+
+def replay(samples, settings, loopname, mode = TRACK_FOLLOW, speed = MAX_SPEED, interpolation = TRACKING_INTERPOLATION, variant = None):
+    """
+    Replay a trace through tracking and return the results as a dictionary
+        moves       --  moves issued
+        travel      --  % extension travelled
+        lag         --  lag histogram, see Tracking.lag_stats()
+        polls       --  CAT frequency requests
+        pushes      --  unsolicited frequency frames
+        duration    --  seconds of trace
+        errors      --  tracking errors
+
+    Arguments:
+        samples         --  [(seconds, Hz), ...] from the trace
+        settings        --  see common.py DEFAULT_SETTINGS for structure
+        loopname        --  loop to track with
+        mode            --  TRACK_FOLLOW | TRACK_CHASE
+        speed           --  motor speed 0 - MAX_SPEED
+        interpolation   --  INTERP_LINEAR | INTERP_PCHIP
+        variant         --  CAT variant, one in CAT_TRANSCEIVE pushes frequency changes
+
+    """
+
+    clk = clock.VirtualClock()
+    dispatcher = FakeDispatcher()
+    tracker = []
+    cat = FakeCAT(samples, clk, lambda: tracker[0].terminate(), variant in CAT_TRANSCEIVE)
+    tracker.append(tracking.Tracking(cat, variant, settings, loopname, dispatcher.callback, interpolation, clk))
+    t = tracker[0]
+    t.set_mode(mode)
+    t.set_speed(speed)
+    t.reset_tracker()
+    t.run_tracker()
+    # Run the thread body here, it returns when the trace is exhausted
+    t.run()
+    return {
+        'moves': len(dispatcher.moves),
+        'travel': dispatcher.travel(),
+        'lag': t.lag_stats(),
+        'polls': cat.requests,
+        'pushes': cat.pushes,
+        'duration': samples[-1][0] if len(samples) > 0 else 0.0,
+        'errors': len(dispatcher.errors),
+    }
+
+def main():
+    """ Replay each trace and print the results """
+
+    parser = argparse.ArgumentParser(description='Replay CAT frequency traces through tracking')
+    parser.add_argument('traces', nargs='+', help='trace files')
+    parser.add_argument('--loop', help='loop to track with, default the loop recorded in the trace')
+    parser.add_argument('--mode', default=TRACK_FOLLOW, choices=(TRACK_FOLLOW, TRACK_CHASE))
+    parser.add_argument('--speed', type=int, default=MAX_SPEED, help='motor speed 0 - %d' % MAX_SPEED)
+    parser.add_argument('--interpolation', default=TRACKING_INTERPOLATION, choices=(INTERP_LINEAR, INTERP_PCHIP))
+    parser.add_argument('--variant', choices=CAT_VARIANTS, help='CAT variant, default polled')
+    args = parser.parse_args()
+
+    # Only the command line needs Qt, to read the saved settings
+    from common import persist
+    settings = persist.getSavedCfg(SETTINGS_PATH)
+    if settings == None:
+        print('No settings found at %s' % SETTINGS_PATH)
+        return 1
+    for path in args.traces:
+        loopname, samples = trace.readTrace(path)
+        if args.loop != None:
+            loopname = args.loop
+        if loopname not in settings[LOOP_SETTINGS]:
+            print('%s: loop %s is not configured' % (path, loopname))
+            continue
+        r = replay(samples, settings, loopname, args.mode, args.speed, args.interpolation, args.variant)
+        lag = r['lag']
+        print('%s: %.0fs %d polls, %d pushes, %d moves, travel %.1f%%, lag mean %s p90 %s max %s, %d errors' % (
+            path, r['duration'], r['polls'], r['pushes'], r['moves'], r['travel'],
+            '%.1f%%' % lag['mean'] if lag['mean'] != None else '-',
+            '%.1f%%' % lag['p90'] if lag['p90'] != None else '-',
+            '%.1f%%' % lag['max'] if lag['max'] != None else '-',
+            r['errors']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
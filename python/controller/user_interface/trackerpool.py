@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# trackerpool.py
+#
+# Several RX frequency trackers on one thread for the Mag Loop application
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os,sys
+import threading
+
+sys.path.append(os.path.join('..', '..'))
+sys.path.append(os.path.join('..','..','..','..','..','Common','trunk','python'))
+
+# Application imports
+from common.defs import *
+from common import clock
+from common import latency
+from controller.hw_interface import dispatcher
+from controller.hw_interface import link
+from controller.hw_interface import protocol
+import tracking
+
+# Common files
+import cat
+import loop_control_if
+
+"""
+One host can track for several stations, each a radio with its own CAT link feeding a
+loop with its own controller. Rather than a thread per tracker, the TrackerPool thread
+sends every frequency request. Each tracker says how long to wait before its next request
+and the pool sleeps until the earliest is due, or a tracker asks for an early poll. CAT
+responses arrive on the CAT threads as before so a slow rig does not hold up the others.
+
+The pool records for each tracker how late each request went out against when it was due,
+this together with the tracker's own CAT response and lag histograms is in stats().
+
+Station pairs a tracker with its controller for the stations beyond the one in the UI.
+Each controller has its own scheduler so a long tune or a stop on one loop does not hold
+up or cancel another's tracking. Command names are prefixed by station and the latencies
+recorded with the UI's so they show together in its statistics.
+"""
+class TrackerPool(threading.Thread):
+
+    MAX_WAIT = 1.0      # Longest sleep in seconds, so a tracker added while asleep is soon polled
+
+    def __init__(self, clk = None):
+        """
+        Constructor
+
+        Arguments:
+            clk --  clock for time and waits, default the real clock
+
+        """
+
+        super(TrackerPool, self).__init__()
+
+        self.__clock = clk if clk != None else clock.RealClock()
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__trackers = {}        # {name: [Tracking, due time, lateness Histogram]}
+        self.__terminate = False
+
+    def add(self, name, tracker):
+        """
+        Poll a tracker, which must not be started as a thread itself
+
+        Arguments:
+            name    --  unique name for stats
+            tracker --  tracking.Tracking instance
+
+        """
+
+        tracker.attach(self.__wake)
+        with self.__lock:
+            self.__trackers[name] = [tracker, None, latency.Histogram()]
+        self.__wake.set()
+
+    def remove(self, name):
+        """
+        Stop polling a tracker
+
+        Arguments:
+            name    --  name given to add()
+
+        """
+
+        with self.__lock:
+            self.__trackers.pop(name, None)
+
+    def names(self):
+        """ Names of the trackers polled """
+
+        with self.__lock:
+            return sorted(self.__trackers.keys())
+
+    def stats(self):
+        """
+        Return the stats for each tracker as {name: dictionary}
+            late    --  histogram of ms each request went out after it was due
+            cat     --  histogram of ms from request to response, see Tracking.cat_stats()
+            lag     --  histogram of % extension lag, see Tracking.lag_stats()
+            load    --  CAT frequency requests per second, see Tracking.poll_stats()
+            source  --  'push' | 'poll', see Tracking.poll_stats()
+
+        """
+
+        with self.__lock:
+            trackers = dict(self.__trackers)
+        stats = {}
+        for name, (tracker, _, late) in trackers.items():
+            polls = tracker.poll_stats()
+            stats[name] = {
+                'late': late.snapshot(),
+                'cat': tracker.cat_stats(),
+                'lag': tracker.lag_stats(),
+                'load': polls['load'],
+                'source': polls['source'],
+            }
+        return stats
+
+    def terminate(self):
+        """ Terminate every tracker and the thread """
+
+        with self.__lock:
+            trackers = [entry[0] for entry in self.__trackers.values()]
+            self.__trackers = {}
+        for tracker in trackers:
+            tracker.terminate()
+        self.__terminate = True
+        self.__wake.set()
+
+    def run(self):
+        """ Thread entry point """
+
+        while not self.__terminate:
+            with self.__lock:
+                entries = list(self.__trackers.items())
+            now = self.__clock.monotonic()
+            wait = TrackerPool.MAX_WAIT
+            for name, entry in entries:
+                tracker, due, late = entry
+                if tracker.terminated():
+                    self.remove(name)
+                    continue
+                if tracker.urgent() or due == None or now >= due:
+                    if due != None and now >= due:
+                        late.record((now - due)*1000.0)
+                    entry[1] = due = now + tracker.poll()
+                wait = min(wait, due - now)
+            self.__clock.wait(self.__wake, max(0.0, wait))
+            self.__wake.clear()
+
+class Station:
+
+    def __init__(self, name, station, settings, pool, latencies, callback):
+        """
+        Constructor
+
+        Arguments:
+            name        --  unique name for the station
+            station     --  see common.py DEFAULT_SETTINGS STATIONS for structure
+            settings    --  see common.py DEFAULT_SETTINGS for structure
+            pool        --  TrackerPool to poll the tracker
+            latencies   --  latency.CommandLatency shared with the UI
+            callback    --  callback here with (name, status message)
+
+        """
+
+        self.__name = name
+        self.__loopname = station[STATION_LOOP]
+        self.__settings = settings
+        self.__pool = pool
+        self.__callback = callback
+        # Prefix to command names so the shared latencies tell the stations apart
+        self.__scope = '%s-' % name
+        self.__scheduler = dispatcher.CommandScheduler(self.__executeCallback, latencies = latencies)
+
+        self.__api = loop_control_if.ControllerAPI(station[NETWORK], self.__respCallback, self.__evntCallback)
+        self.__link = link.ControllerLink(station[NETWORK], self.__respCallback)
+        self.__cat = cat.CAT(station[CAT_SETTINGS][VARIANT], station[CAT_SETTINGS])
+        self.__tracking = tracking.Tracking(self.__cat, station[CAT_SETTINGS][VARIANT], settings, self.__loopname, self.__track_callback)
+
+    def start(self):
+        """ Select the loop and start tracking """
+
+        self.__link.start()
+        self.__scheduler.start()
+        if not self.__cat.start_thrd():
+            self.__callback(self.__name, 'CAT failed to start')
+        # Select the relays for the loop once we know what the controller supports
+        self.__scheduler.submit(self.__negotiate, self.__scope + 'negotiate', None, preemptible = False)
+        self.__pool.add(self.__name, self.__tracking)
+        self.__tracking.reset_tracker()
+        self.__tracking.run_tracker()
+
+    def name(self):
+        """ The station's name """
+
+        return self.__name
+
+    def tracking(self):
+        """ The station's tracker """
+
+        return self.__tracking
+
+    def stats(self):
+        """ The station's scheduler counters, see CommandScheduler.stats() """
+
+        return self.__scheduler.stats()
+
+    def terminate(self):
+        """ Stop tracking and release the controller """
+
+        self.__pool.remove(self.__name)
+        self.__tracking.terminate()
+        if self.__scheduler.is_alive():
+            self.__scheduler.terminate()
+            self.__scheduler.join()
+        self.__api.terminate()
+        self.__link.terminate()
+        self.__link.join()
+
+    def __negotiate(self, args):
+        """ Find what the controller supports then select the relays, run by the scheduler """
+
+        self.__link.negotiate()
+        commands = protocol.relayCommands(self.__settings[LOOP_SETTINGS][self.__loopname][I_RELAYS], self.__link.hasRelayMask())
+        link.configure(self.__scheduler, self.__link, self.__api, 'relays', commands, self.__scope)
+
+    def __retarget(self, args):
+        """ Give an executing tracking move a new target, as LoopUI """
+
+        extension, isExtension = args
+        return isExtension and self.__link.retarget(extension)
+
+    def __track_callback(self, form, freq, moveToExtension = None, message = ''):
+        """ Tracker callback, as LoopUI """
+
+        if form == TRACKING_TO_DEGS:
+            self.__scheduler.submit(self.__api.move, self.__scope + 'move', (int(moveToExtension), True), PRIORITY_TRACKING, coalesce = self.__scope + 'track-move', retarget = self.__retarget)
+        elif form == TRACKING_ERROR:
+            self.__callback(self.__name, 'Tracking problem! (%s)' % (message))
+
+    def __executeCallback(self, message):
+        """ Scheduler messages """
+
+        if 'overflow' in message or 'fatal' in message:
+            self.__callback(self.__name, message)
+
+    def __respCallback(self, message):
+        """ Controller responses """
+
+        if 'failure' in message:
+            self.__callback(self.__name, message)
+        elif 'offline' in message:
+            self.__callback(self.__name, 'Controller is offline!')
+
+    def __evntCallback(self, message):
+        """ Controller events, only alarms are of interest """
+
+        if 'alarm' in message:
+            self.__callback(self.__name, message)
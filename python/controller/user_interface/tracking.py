@@ -26,15 +26,17 @@
 # System imports
 import os, sys
 import threading
-from time import sleep
+from collections import deque
 import traceback
 
 sys.path.append(os.path.join('..','..','..','..','..','Common','trunk','python'))
 # Application imports
 from common.defs import *
-
-# Common files
-import cat
+from common import setpoints
+from common import motion
+from common import latency
+from common import bandwidth
+from common import clock
 
 """
 
@@ -42,27 +44,61 @@ Tracking follows the RX frequency, retuning the antenna as necessary. This means
 will always be optimal for RX as loops have a narrow bandwidth and 'should' present
 a low SWR on TX without retuning.
 
-This is a separate autonomous thread that performs a CAT exchange every TRACK_UPDATE
-mseconds to get the current receiver frequency (if tracking is enabled). If the
-frequency has changed by more than TRACK_FREQ Hz then a callback is made to move the
-dc motor by an amount to bring the antenna back to resonance.
+This is a separate autonomous thread that performs a CAT exchange to get the current
+receiver frequency. If the frequency has changed by more than the dead-band then a
+callback is made to move the dc motor by an amount to bring the antenna back to resonance.
+The dead-band is a fraction of the loop 2:1 bandwidth at the frequency where this has been
+measured, otherwise DEADBAND_DEFAULT Hz.
+
+The CAT link is shared with other software so the poll rate adapts. While the VFO is
+moving the frequency is requested every TRACK_UPDATE ms. While it is stable the interval
+backs off to POLL_SLOW ms and while tracking is paused it drops to POLL_IDLE ms. Each
+decision and the resulting CAT load is available from poll_stats().
+
+Variants in CAT_TRANSCEIVE report every frequency change unsolicited, these frames arrive
+through the same CAT callback as a polled response and are acted on at once. Tracking then
+only polls every PUSH_CHECK ms to confirm the rig is still reporting. If that poll finds a
+frequency that was never reported, transceive is off in the rig menu, and tracking falls
+back to adaptive polling. An unsolicited frame at any time switches it back to push.
+
+In TRACK_CHASE mode the VFO velocity is estimated from the CAT samples and the move is
+aimed at the frequency the VFO will have reached when the move completes, rather than
+where it was when the move started. The difference between the extension the frequency
+needs and the modelled actuator position is recorded for every sample, see lag_stats().
+
+Tracking runs as its own thread or, for several stations on one host, is polled along with
+the other trackers by a single trackerpool.TrackerPool thread, see attach() and poll().
+
+The setpoints for each loop are compiled into a SetpointCurve on first use and cached
+until the loop settings change, see invalidate().
+
+When the controller holds the setpoint table for the loop, see set_device_table(), the
+frequency is sent rather than the extension and the controller interpolates.
 
 """
 class Tracking(threading.Thread):
 	
-	TRACK_UPDATE = 100 		# Get RX freq every n ms
-	TRACK_FREQ = 10000 		# Track if the frequency changes by >n Hz
+	TRACK_UPDATE = 100 		# Get RX freq every n ms while the VFO is moving
+	POLL_SLOW = 1000		# Slowest poll in ms while the frequency is stable
+	POLL_IDLE = 2000		# Poll in ms while tracking is paused
+	POLL_BACKOFF = 1.5		# Multiply the interval by this for each stable poll
+	POLL_MOVING = 10		# VFO is moving if the frequency changes by >=n Hz between polls
+	POLL_WINDOW = 10.0		# Seconds over which the CAT load is measured
+	POLL_HISTORY = 50		# Number of poll decisions kept
+	PUSH_CHECK = 10000		# Poll in ms to confirm the rig is still pushing frequency changes
 	
-	def __init__(self, cat_inst, variant, settings, loopname, callback):
+	def __init__(self, cat_inst, variant, settings, loopname, callback, interpolation = TRACKING_INTERPOLATION, clk = None):
 		"""
 		Constructor
 		
 		Arguments:
-			cat_inst	--	CAT class instance
-			variant		--	CAT command set and format
-			settings	--  see common.py DEFAULT_SETTINGS for structure
-			loopname	--  current selected loop
-			callback	--  callback here with async responses
+			cat_inst		--	CAT class instance
+			variant			--	CAT command set and format
+			settings		--  see common.py DEFAULT_SETTINGS for structure
+			loopname		--  current selected loop
+			callback		--  callback here with async responses
+			interpolation	--	INTERP_LINEAR | INTERP_PCHIP between setpoints
+			clk				--	clock for time and waits, default the real clock
 		
 		"""
 		
@@ -72,6 +108,7 @@ class Tracking(threading.Thread):
 		self.__settings = settings
 		self.__loopname = loopname
 		self.__callback = callback
+		self.__clock = clk if clk != None else clock.RealClock()
 		
 		# Get the CAT interface
 		self.__cat = cat_inst
@@ -83,18 +120,56 @@ class Tracking(threading.Thread):
 		self.__terminate = False
 		self.__run = False
 		self.__degrees_moved = 0
+		self.__interpolation = interpolation
+		self.__curves = {}			# Compiled setpoints {loopname: SetpointCurve}
+		self.__bandwidths = {}		# Compiled bandwidths {loopname: SetpointCurve}
+		self.__device_table = False	# The controller holds the setpoints for the loop
+		
+		# Adaptive polling
+		self.__interval = Tracking.TRACK_UPDATE
+		self.__sample_freq = None	# Last frequency from CAT
+		self.__moved = False		# Frequency changed since the last poll decision
+		self.__polls = deque()		# Poll times within POLL_WINDOW
+		self.__decisions = deque(maxlen=Tracking.POLL_HISTORY)
+		self.__counts = {'moving': 0, 'stable': 0, 'idle': 0, 'push': 0}
+		self.__responses = 0
+		
+		# Pushed frequency updates
+		self.__push = variant in CAT_TRANSCEIVE	# Rig expected to report changes unsolicited
+		self.__outstanding = False		# A frequency request is awaiting its response
+		self.__pushes = 0				# Unsolicited frequency frames
+		self.__fallbacks = 0			# Times a missed change forced a return to polling
+		self.__wake = threading.Event()	# Cuts short the wait for the next poll
+		self.__urgent = False			# Poll now rather than when the interval expires
+		self.__restart = False			# Reset since last run
+		self.__requested = None			# Time of the outstanding frequency request
+		self.__cat_latency = latency.Histogram()	# CAT request to response ms
+		self.__recorder = None			# Records CAT frequencies
+		
+		# Predictive tracking
+		self.__mode = TRACK_FOLLOW
+		self.__velocity = motion.VelocityEstimator()
+		self.__actuator = motion.ActuatorModel()
+		self.__lag = latency.Histogram(LAG_BUCKETS)
 	
 	def terminate(self):
 		""" Asked to terminate the thread """
 		
 		self.__terminate = True
-		self.join()
+		self.__nudge()
+		# May have been run without starting the thread, or asked to terminate from within
+		if self.is_alive() and threading.current_thread() is not self:
+			self.join()
 		self.__cat.terminate()
 
 	def run_tracker(self):
 		""" Run the tracker """
 		
 		self.__run = True
+		if self.__restart:
+			# Poll straight away rather than wait out the idle interval
+			self.__restart = False
+			self.__nudge()
 	
 	def pause_tracker(self):
 		""" Pause the tracker """
@@ -107,6 +182,166 @@ class Tracking(threading.Thread):
 		self.__last_freq = None
 		self.__last_setpoint = None
 		self.__degrees_moved = 0
+		# Poll at the fast rate when next run
+		self.__moved = True
+		self.__restart = True
+		self.__velocity.reset()
+	
+	def attach(self, wake):
+		"""
+		Use an event shared with other trackers to ask for an early poll, when polled by a pool
+		
+		Arguments:
+			wake	--	threading.Event the pool waits on
+		
+		"""
+		
+		self.__wake = wake
+	
+	def urgent(self):
+		""" True, once, if a poll is wanted before the interval expires """
+		
+		urgent = self.__urgent
+		self.__urgent = False
+		return urgent
+	
+	def terminated(self):
+		""" True if asked to terminate """
+		
+		return self.__terminate
+	
+	def set_loop(self, loopname):
+		"""
+		Track for a different loop
+		
+		Arguments:
+			loopname	--  new selected loop
+		
+		"""
+		
+		if loopname != self.__loopname:
+			self.__loopname = loopname
+			self.reset_tracker()
+	
+	def set_interpolation(self, interpolation):
+		"""
+		Change the interpolation between setpoints
+		
+		Arguments:
+			interpolation	--	INTERP_LINEAR | INTERP_PCHIP
+		
+		"""
+		
+		self.__interpolation = interpolation
+		self.invalidate()
+	
+	def set_device_table(self, on):
+		"""
+		The controller does or no longer holds the setpoint table for the loop
+		
+		Arguments:
+			on	--	True to track by frequency, False by extension
+		
+		"""
+		
+		self.__device_table = on
+	
+	def set_mode(self, mode):
+		"""
+		Change the tracking mode
+		
+		Arguments:
+			mode	--	TRACK_FOLLOW | TRACK_CHASE
+		
+		"""
+		
+		self.__mode = mode
+	
+	def set_speed(self, speed):
+		"""
+		The motor speed has changed
+		
+		Arguments:
+			speed	--	motor speed 0 - MAX_SPEED
+		
+		"""
+		
+		self.__actuator.set_rate(ACTUATOR_RATE*float(speed)/MAX_SPEED)
+	
+	def lag_stats(self, reset = False):
+		"""
+		Return the histogram of % extension between where the antenna should be and the
+		modelled actuator position, one value per CAT sample while tracking
+		
+		Arguments:
+			reset	--	clear the histogram after reading
+		
+		"""
+		
+		stats = self.__lag.snapshot()
+		if reset:
+			self.__lag.reset()
+		return stats
+	
+	def cat_stats(self, reset = False):
+		"""
+		Return the histogram of ms from a frequency request to its response
+		
+		Arguments:
+			reset	--	clear the histogram after reading
+		
+		"""
+		
+		stats = self.__cat_latency.snapshot()
+		if reset:
+			self.__cat_latency.reset()
+		return stats
+	
+	def poll_stats(self):
+		"""
+		Return the poll state and CAT load as a dictionary
+			interval	--	current poll interval ms
+			reason		--	'moving' | 'stable' | 'idle' | 'push', why the interval was chosen
+			counts		--	{reason: number of decisions, ...}
+			load		--	CAT frequency requests per second over the last POLL_WINDOW seconds
+			responses	--	total CAT frequency responses
+			source		--	'push' if the rig reports frequency changes, otherwise 'poll'
+			pushes		--	total unsolicited frequency frames
+			fallbacks	--	times a change the rig did not report forced a return to polling
+			decisions	--	last POLL_HISTORY decisions as (monotonic time, interval ms, reason)
+		
+		"""
+		
+		now = self.__clock.monotonic()
+		recent = [t for t in list(self.__polls) if now - t <= Tracking.POLL_WINDOW]
+		decisions = list(self.__decisions)
+		return {
+			'interval': self.__interval,
+			'reason': decisions[-1][2] if len(decisions) > 0 else None,
+			'counts': dict(self.__counts),
+			'load': len(recent)/Tracking.POLL_WINDOW,
+			'responses': self.__responses,
+			'source': 'push' if self.__push else 'poll',
+			'pushes': self.__pushes,
+			'fallbacks': self.__fallbacks,
+			'decisions': decisions,
+		}
+	
+	def invalidate(self, loopname = None):
+		"""
+		Discard compiled setpoints, must be called when LOOP_SETTINGS change
+		
+		Arguments:
+			loopname	--  loop whose settings changed, None for all loops
+		
+		"""
+		
+		if loopname == None:
+			self.__curves = {}
+			self.__bandwidths = {}
+		else:
+			self.__curves.pop(loopname, None)
+			self.__bandwidths.pop(loopname, None)
 		
 	def run(self):
 
@@ -120,16 +355,29 @@ class Tracking(threading.Thread):
 		#
 			
 		while not self.__terminate:
-			try:
-				# Send a freq request every TRACK_UPDATE ms
-				self.__cat.do_command(CAT_FREQ_GET)
-				sleep(Tracking.TRACK_UPDATE/1000.0)				
-			except Exception as e:
-				self.__callback(TRACKING_ERROR, None, None, None, 'CAT error [%s]' % (str(e)))
+			# Send a freq request and wait as long as the VFO activity allows
+			self.__clock.wait(self.__wake, self.poll())
+			self.__wake.clear()
+	
+	def poll(self):
+		""" Send a frequency request, returns the seconds to wait before the next """
+		
+		try:
+			now = self.__clock.monotonic()
+			self.__outstanding = True
+			self.__requested = now
+			self.__cat.do_command(CAT_FREQ_GET)
+			self.__polls.append(now)
+			while now - self.__polls[0] > Tracking.POLL_WINDOW:
+				self.__polls.popleft()
+			return self.__next_interval(now)/1000.0
+		except Exception as e:
+			self.__callback(TRACKING_ERROR, None, None, 'CAT error [%s]' % (str(e)))
+			return Tracking.POLL_IDLE/1000.0
 
 	def __cat_callback(self, data):
 		"""
-		Response from CAT GET_FREQ command
+		Response from CAT GET_FREQ command or an unsolicited frequency frame
 		
 		Arguments:
 			data	--	(True|False, current freq in Hz)
@@ -139,88 +387,55 @@ class Tracking(threading.Thread):
 		# Algorithm to see if, and where, we need to move capacitor to
 		(r, freq) = data
 		if r:
+			# Note VFO movement for the poller
+			self.__responses += 1
+			self.__source(freq)
+			if self.__recorder != None:
+				self.__recorder.write(self.__clock.monotonic(), freq)
+			if self.__sample_freq == None or abs(freq - self.__sample_freq) >= Tracking.POLL_MOVING:
+				self.__moved = True
+			self.__sample_freq = freq
 			# Good response
 			if self.__run:
 				try:
 					self.__callback(TRACKING_UPDATE, float(freq/1000000.0))
+					now = self.__clock.monotonic()
+					self.__velocity.add(now, freq)
+					self.__measure_lag(now, freq)
+					# The frequency to tune for
+					aim = freq
+					if self.__mode == TRACK_CHASE:
+						aim = self.__predict(now, freq)
 					tune = False
 					if self.__last_freq == None:
 						# Start or restart so force a tune
 						tune = True
 					else:
 						# We don't want to be continuously nudging the tuning so,
-						# tune only if we have moved in frequency more than TRACK_FREQ Hz since the last tune
-						if abs(freq - self.__last_freq) >= Tracking.TRACK_FREQ:
+						# tune only if we have moved in frequency more than the dead-band since the last tune
+						if abs(aim - self.__last_freq) >= self.__deadband(self.__last_freq):
 							tune = True
 					if tune:
 						# Required to do a retune
-						freqMHz = float(freq/1000000.0)
-						freqKHz = int(freq/1000)
 						# Do a sensibility check
-						if freqMHz >= float(self.__settings[LOOP_SETTINGS][self.__loopname][I_FREQ][I_LOWER]) and freqMHz <= float(self.__settings[LOOP_SETTINGS][self.__loopname][I_FREQ][I_UPPER]):
+						if self.__in_range(freq):
 							# Within the loop frequency range
-							# We now need to find the closest before and after setpoints to the frequency
-							# If between setpoints we interpolate between points
-							# Get the setpoint list for this loop
-							setpoints = self.__settings[LOOP_SETTINGS][self.__loopname][I_SETPOINTS]
-							if len(setpoints) == 0:
+							# Interpolate between the closest setpoints either side of the frequency
+							curve = self.__curve()
+							if len(curve) == 0:
 								# Nothing we can do
 								self.__callback(TRACKING_ERROR, None, None, 'There are no setpoints!')
 								return
-							#=========================================================================================
-							# Main loop
-							
-							# Initial conditions
-							diff = None				# Current difference in freq between current freq and current setpoint
-							# We note the closest setpoint both below and above the current frequency (as present)
-							#[[freq difference, setpoint freq, degrees], [freq difference, setpoint freq, degrees]]
-							span = [None, None]
-							
-							# We work in KHz here as we don't need Hz granularity.
-							# Iterate setpoints.
-							for setpointfreq in setpoints:
-								# Setpoints held as MHz strings in configuration
-								setpointKHz = int(float(setpointfreq)*1000)
-								# Get the difference between the setpoint and the actual Rx frequency in KHz
-								diff = freqKHz-setpointKHz
-								if diff < 0:
-									# Below the current frequency
-									if span[0] == None:
-										# First time below
-										span[0] = [diff, setpointfreq, setpoints[setpointfreq]]
-									else:
-										# Subsequent pass
-										if abs(diff) < abs(span[0][0]):
-											# Closer
-											span[0] = [diff, setpointfreq, setpoints[setpointfreq]]									
-								else:
-									# Above or equal to the current frequency
-									if span[1] == None:
-										# First time above
-										span[1] = [diff, setpointfreq, setpoints[setpointfreq]]
-									else:
-										# Subsequent pass
-										if diff < span[1][0]:
-											# Closer
-											span[1] = [diff, setpointfreq, setpoints[setpointfreq]]
-							
-							# Move to the frequency
-							if span[0] == None:
-								# Only had a higher freq setpoint
-								self.__callback(TRACKING_TO_DEGS, span[1][1], span[1][2], '')
-							elif span[1] == None:
-								# Only had a lower freq setpoint
-								self.__callback(TRACKING_TO_DEGS, span[0][1], span[0][2], '')
+							extension = curve.extension(aim/1000.0)
+							if self.__device_table:
+								# The controller works out the extension from its table
+								self.__callback(TRACKING_TO_FREQ, int(aim), extension, '')
 							else:
-								# We had an upper and lower setpoint
-								# Interpolate between them to create a pseudo setpoint
-								fracFreqRatio = float (abs (span[0][0]) ) /( float (abs(span[0][0]) ) + float (span[1][0]) )
-								fracDegRatio = fracFreqRatio * float(span[1][2] - span[0][2])
-								newHeading = fracDegRatio + span[0][2]
-								self.__callback(TRACKING_TO_DEGS, freqKHz, newHeading, '')
+								self.__callback(TRACKING_TO_DEGS, int(aim/1000), extension, '')
+							self.__actuator.command(now, extension)
 								
 							# Remember last freq we moved to
-							self.__last_freq = freq
+							self.__last_freq = aim
 							# End main loop
 							#============================================================================================
 						
@@ -236,4 +451,173 @@ class Tracking(threading.Thread):
 				self.__callback(TRACKING_UPDATE, float(freq/1000000.0))
 		else:
 			# Bad response from CAT
-			self.__callback(TRACKING_ERROR, None, None, 'Bad response from CAT, unknown error!')
\ No newline at end of file
+			self.__callback(TRACKING_ERROR, None, None, 'Bad response from CAT, unknown error!')
+	
+	def __curve(self):
+		""" Compiled setpoints for the current loop """
+		
+		curve = self.__curves.get(self.__loopname)
+		if curve == None:
+			curve = setpoints.SetpointCurve(self.__settings[LOOP_SETTINGS][self.__loopname][I_SETPOINTS], self.__interpolation)
+			self.__curves[self.__loopname] = curve
+		return curve
+	
+	def __source(self, freq):
+		"""
+		Decide between pushed and polled updates from a frequency frame
+		
+		Arguments:
+			freq	--	frequency in Hz
+		
+		"""
+		
+		if not self.__outstanding:
+			# Nobody asked so the rig is pushing changes
+			self.__pushes += 1
+			if not self.__push:
+				self.__push = True
+				self.__nudge()
+		else:
+			self.__outstanding = False
+			self.__cat_latency.record((self.__clock.monotonic() - self.__requested)*1000.0)
+			if self.__push and self.__sample_freq != None and abs(freq - self.__sample_freq) >= Tracking.POLL_MOVING:
+				# The frequency changed and the rig never said, poll until it does
+				self.__push = False
+				self.__fallbacks += 1
+				self.__nudge()
+	
+	def __nudge(self):
+		""" Poll as soon as possible """
+		
+		self.__urgent = True
+		self.__wake.set()
+	
+	def __next_interval(self, now):
+		"""
+		Decide the interval to the next poll
+		
+		Arguments:
+			now	--	monotonic time of this poll
+		
+		"""
+		
+		if self.__push:
+			# The rig reports changes, just check it still is
+			interval = Tracking.PUSH_CHECK
+			reason = 'push'
+			self.__moved = False
+		elif not self.__run:
+			# Only the display needs the frequency
+			interval = Tracking.POLL_IDLE
+			reason = 'idle'
+		elif self.__moved:
+			# Keep up with the VFO
+			interval = Tracking.TRACK_UPDATE
+			reason = 'moving'
+			self.__moved = False
+		else:
+			# Back off while nothing changes
+			interval = min(self.__interval*Tracking.POLL_BACKOFF, Tracking.POLL_SLOW)
+			reason = 'stable'
+		self.__interval = interval
+		self.__counts[reason] += 1
+		self.__decisions.append((now, interval, reason))
+		return interval
+	
+	def retarget_saving(self, extension):
+		"""
+		Seconds of actuator time saved by retargeting the current move to extension
+		
+		Arguments:
+			extension	--	new target % extension
+		
+		"""
+		
+		return self.__actuator.retarget_saving(self.__clock.monotonic(), extension)
+	
+	def record(self, recorder):
+		"""
+		Record every CAT frequency
+		
+		Arguments:
+			recorder	--	trace.TraceWriter or None to stop recording
+		
+		"""
+		
+		self.__recorder = recorder
+	
+	def frequency(self):
+		""" Last frequency in Hz from CAT or None """
+		
+		return self.__sample_freq
+	
+	def deadband(self, freq):
+		"""
+		Retune dead-band in Hz at a frequency for the current loop
+		
+		Arguments:
+			freq	--	frequency in Hz
+		
+		"""
+		
+		return self.__deadband(freq)
+	
+	def __deadband(self, freq):
+		""" Dead-band in Hz at freq Hz from the measured bandwidth """
+		
+		curve = self.__bandwidths.get(self.__loopname)
+		if curve == None:
+			loop = self.__settings[LOOP_SETTINGS][self.__loopname]
+			# Loops configured before bandwidth was measured have no entry
+			widths = loop[I_BANDWIDTH] if len(loop) > I_BANDWIDTH else {}
+			# Bandwidth in kHz is interpolated between measurements the same as setpoints
+			curve = setpoints.SetpointCurve(widths)
+			self.__bandwidths[self.__loopname] = curve
+		return bandwidth.deadband(curve.extension(freq/1000.0))
+	
+	def __in_range(self, freq):
+		""" True if freq Hz is within the current loop range """
+		
+		freqMHz = float(freq/1000000.0)
+		return freqMHz >= float(self.__settings[LOOP_SETTINGS][self.__loopname][I_FREQ][I_LOWER]) and freqMHz <= float(self.__settings[LOOP_SETTINGS][self.__loopname][I_FREQ][I_UPPER])
+	
+	def __predict(self, now, freq):
+		"""
+		Return the frequency the VFO will have reached when a move to it completes
+		
+		Arguments:
+			now		--	monotonic time of the sample
+			freq	--	current frequency in Hz
+		
+		"""
+		
+		v = self.__velocity.velocity(now)
+		curve = self.__curve()
+		if abs(v) < CHASE_MIN_VELOCITY or len(curve) == 0 or not self.__in_range(freq):
+			return freq
+		lower = float(self.__settings[LOOP_SETTINGS][self.__loopname][I_FREQ][I_LOWER])*1000000.0
+		upper = float(self.__settings[LOOP_SETTINGS][self.__loopname][I_FREQ][I_UPPER])*1000000.0
+		position = self.__actuator.position(now)
+		aim = freq
+		# The move time depends on the target so refine the estimate once
+		for i in range(2):
+			t = self.__actuator.move_time(position, curve.extension(aim/1000.0))
+			aim = min(max(freq + v*t, lower), upper)
+		return aim
+	
+	def __measure_lag(self, now, freq):
+		"""
+		Record how far the antenna is from where the frequency needs it
+		
+		Arguments:
+			now		--	monotonic time of the sample
+			freq	--	current frequency in Hz
+		
+		"""
+		
+		position = self.__actuator.position(now)
+		if position == None or not self.__in_range(freq):
+			return
+		curve = self.__curve()
+		if len(curve) > 0:
+			self.__lag.record(abs(curve.extension(freq/1000.0) - position))
\ No newline at end of file
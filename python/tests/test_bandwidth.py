@@ -0,0 +1,69 @@
+#
+# test_bandwidth.py
+#
+# Tests for measuring the loop bandwidth
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+import random
+
+import pytest
+
+from common.defs import *
+from common import bandwidth
+
+def vswrAt(extension):
+    """ A loop matched at 50% with 2:1 at 45% and 55% """
+    
+    return 1.0 + abs(extension - 50.0)*0.2
+
+def measure(extensions):
+    sweep = bandwidth.BandwidthSweep()
+    for extension in extensions:
+        v = vswrAt(extension)
+        sweep.pot(extension)
+        sweep.vswr(1.0, (v - 1.0)/(v + 1.0))
+    return sweep.width(2.0)
+
+def test_width_of_an_ordered_sweep():
+    assert measure(range(30, 71)) == pytest.approx(10.0)
+    
+def test_width_of_a_search_out_of_order():
+    # A coarse sweep then probes either side of the best, as a bracketing search does
+    probes = list(range(30, 71, 5)) + [52.0, 48.0, 53.5, 46.5, 50.5, 49.0, 44.0, 56.0]
+    assert measure(probes) == pytest.approx(10.0)
+    shuffled = list(range(30, 71))
+    random.Random(1).shuffle(shuffled)
+    assert measure(shuffled) == pytest.approx(10.0)
+    
+def test_revisited_extensions_are_averaged():
+    sweep = bandwidth.BandwidthSweep()
+    for extension, v in [(40.0, 3.0), (50.0, 1.0), (60.0, 3.0), (50.0, 1.4), (60.0, 3.0), (40.0, 3.0)]:
+        sweep.pot(extension)
+        sweep.vswr(1.0, (v - 1.0)/(v + 1.0))
+    # 2:1 half way from 1.2 at 50% to 3.0 at 40% and 60%
+    assert sweep.width(2.0) == pytest.approx(2*10.0*0.8/1.8)
+    
+def test_one_sided_crossing_is_taken_as_symmetric():
+    assert measure(range(50, 71)) == pytest.approx(10.0)
+    
+def test_never_matched():
+    assert measure(range(60, 71)) == None
+    assert measure([50.0]) == None
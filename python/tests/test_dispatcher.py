@@ -0,0 +1,322 @@
+#
+# test_dispatcher.py
+#
+# Tests for the command scheduler
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+import threading
+import time
+
+import pytest
+
+from common.defs import *
+from common import latency
+from controller.hw_interface import dispatcher
+
+class Recorder:
+    """ Records scheduler callbacks and executed commands """
+    
+    def __init__(self):
+        self.messages = []
+        self.executed = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        
+    def callback(self, message):
+        with self.lock:
+            self.messages.append(message)
+            
+    def command(self, args):
+        with self.lock:
+            self.executed.append(args)
+        if args == 'last':
+            self.done.set()
+            
+    def stop(self, args, wait = True, response = True):
+        with self.lock:
+            self.executed.append('stop')
+            
+class Gate:
+    """ A command which holds the scheduler until released """
+    
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        
+    def __call__(self, args):
+        self.started.set()
+        self.release.wait(5)
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+def start(recorder, maxsize = COMMAND_QUEUE_SIZE):
+    scheduler = dispatcher.CommandScheduler(recorder.callback, maxsize)
+    scheduler.daemon = True
+    scheduler.start()
+    return scheduler
+
+def hold(scheduler):
+    """ Block the scheduler on a gate so commands queue behind it """
+    
+    gate = Gate()
+    scheduler.submit(gate, 'gate', None, preemptible = False)
+    assert gate.started.wait(5)
+    return gate
+
+def finish(scheduler, recorder, gate):
+    """ Release the gate and wait for everything queued to execute """
+    
+    scheduler.submit(recorder.command, 'last', 'last', priority = PRIORITY_BACKGROUND, deadline = None, preemptible = False)
+    gate.release.set()
+    assert recorder.done.wait(5)
+    scheduler.terminate()
+    scheduler.join(5)
+    
+def test_executes_in_priority_order(recorder):
+    scheduler = start(recorder)
+    gate = hold(scheduler)
+    scheduler.submit(recorder.command, 'b1', 'b1', priority = PRIORITY_BACKGROUND)
+    scheduler.submit(recorder.command, 't1', 't1', priority = PRIORITY_TRACKING)
+    scheduler.submit(recorder.command, 'i1', 'i1', priority = PRIORITY_INTERACTIVE)
+    scheduler.submit(recorder.command, 't2', 't2', priority = PRIORITY_TRACKING)
+    scheduler.submit(recorder.command, 'i2', 'i2', priority = PRIORITY_INTERACTIVE)
+    finish(scheduler, recorder, gate)
+    assert recorder.executed == ['i1', 'i2', 't1', 't2', 'b1', 'last']
+    
+def test_coalesce_keeps_the_latest(recorder):
+    scheduler = start(recorder)
+    gate = hold(scheduler)
+    for n in range(5):
+        scheduler.submit(recorder.command, 'speed', n, coalesce = 'speed')
+    assert scheduler.stats()['depth'] == 1
+    finish(scheduler, recorder, gate)
+    assert recorder.executed == [4, 'last']
+    stats = scheduler.stats()
+    assert stats['coalesced'] == 4
+    assert stats['coalescedby'] == {'speed': 4}
+    
+def test_coalesce_never_supersedes_more_urgent_work(recorder):
+    scheduler = start(recorder)
+    gate = hold(scheduler)
+    scheduler.submit(recorder.command, 'move', 'goto', priority = PRIORITY_INTERACTIVE, coalesce = 'move')
+    scheduler.submit(recorder.command, 'move', 'track', priority = PRIORITY_TRACKING, coalesce = 'move')
+    scheduler.submit(recorder.command, 'move', 'goto2', priority = PRIORITY_INTERACTIVE, coalesce = 'move')
+    finish(scheduler, recorder, gate)
+    # The goto replaces the tracking move but a tracking move never replaces a goto
+    assert recorder.executed == ['goto', 'goto2', 'last']
+    assert scheduler.stats()['coalescedby'] == {'move': 1}
+    
+class Move:
+    """ A move which can be retargeted while it executes """
+    
+    def __init__(self, accept = True):
+        self.accept = accept
+        self.targets = []
+        self.threads = []
+        self.retargeted = threading.Event()
+        
+    def retarget(self, args):
+        self.threads.append(threading.current_thread())
+        self.targets.append(args)
+        self.retargeted.set()
+        return self.accept
+        
+def test_retarget_on_a_scheduler_thread(recorder):
+    scheduler = start(recorder)
+    move = Move()
+    gate = Gate()
+    scheduler.submit(gate, 'track', 10, priority = PRIORITY_TRACKING, coalesce = 'track-move', retarget = move.retarget)
+    assert gate.started.wait(5)
+    assert scheduler.submit(recorder.command, 'track', 20, priority = PRIORITY_TRACKING, coalesce = 'track-move', retarget = move.retarget)
+    assert move.retargeted.wait(5)
+    finish(scheduler, recorder, gate)
+    assert move.targets == [20]
+    assert move.threads[0] is not threading.current_thread()
+    # Nothing was queued for the new target
+    assert recorder.executed == ['last']
+    assert scheduler.stats()['retargeted'] == {'track-move': 1}
+    assert 'retargeted:track' in recorder.messages
+    
+def test_failed_retarget_queues_the_command(recorder):
+    scheduler = start(recorder)
+    move = Move(accept = False)
+    gate = Gate()
+    scheduler.submit(gate, 'track', 10, priority = PRIORITY_TRACKING, coalesce = 'track-move', retarget = move.retarget)
+    assert gate.started.wait(5)
+    scheduler.submit(recorder.command, 'track', 20, priority = PRIORITY_TRACKING, coalesce = 'track-move', retarget = move.retarget)
+    assert move.retargeted.wait(5)
+    # Wait for the retarget thread to queue it
+    for n in range(100):
+        if scheduler.stats()['depth'] == 1: break
+        time.sleep(0.01)
+    finish(scheduler, recorder, gate)
+    assert recorder.executed == [20, 'last']
+    assert scheduler.stats()['retargeted'] == {}
+    
+def test_less_urgent_work_does_not_retarget(recorder):
+    scheduler = start(recorder)
+    move = Move()
+    gate = Gate()
+    scheduler.submit(gate, 'move', 10, priority = PRIORITY_INTERACTIVE, coalesce = 'move', retarget = move.retarget)
+    assert gate.started.wait(5)
+    scheduler.submit(recorder.command, 'move', 20, priority = PRIORITY_TRACKING, coalesce = 'move', retarget = move.retarget)
+    assert scheduler.stats()['depth'] == 1
+    finish(scheduler, recorder, gate)
+    assert move.targets == []
+    assert recorder.executed == [20, 'last']
+    
+def test_overflow_reject(recorder):
+    scheduler = start(recorder, maxsize = 2)
+    gate = hold(scheduler)
+    assert scheduler.submit(recorder.command, 'a', 'a', overflow = OVERFLOW_REJECT)
+    assert scheduler.submit(recorder.command, 'b', 'b', overflow = OVERFLOW_REJECT)
+    assert not scheduler.submit(recorder.command, 'c', 'c', overflow = OVERFLOW_REJECT)
+    assert 'overflow:c:%s:rejected' % OVERFLOW_REJECT in recorder.messages
+    # Configuration is never refused, it makes room at the expense of the oldest
+    assert scheduler.submit(recorder.command, 'last', 'last', preemptible = False)
+    assert 'overflow:last:%s:a' % OVERFLOW_DROP_OLDEST in recorder.messages
+    gate.release.set()
+    assert recorder.done.wait(5)
+    scheduler.terminate()
+    assert recorder.executed == ['b', 'last']
+    assert scheduler.stats()['overflows'][OVERFLOW_REJECT] == 1
+    
+def test_overflow_drop_oldest(recorder):
+    scheduler = start(recorder, maxsize = 2)
+    gate = hold(scheduler)
+    scheduler.submit(recorder.command, 'a', 'a', priority = PRIORITY_BACKGROUND)
+    scheduler.submit(recorder.command, 'b', 'b', priority = PRIORITY_BACKGROUND)
+    assert scheduler.submit(recorder.command, 'c', 'c', priority = PRIORITY_BACKGROUND, overflow = OVERFLOW_DROP_OLDEST)
+    assert 'overflow:c:%s:a' % OVERFLOW_DROP_OLDEST in recorder.messages
+    gate.release.set()
+    scheduler.submit(recorder.command, 'last', 'last', priority = PRIORITY_BACKGROUND, deadline = None, preemptible = False, overflow = OVERFLOW_BLOCK, timeout = 5)
+    assert recorder.done.wait(5)
+    scheduler.terminate()
+    assert recorder.executed == ['b', 'c', 'last']
+    
+def test_overflow_drop_oldest_spares_more_urgent_work(recorder):
+    scheduler = start(recorder, maxsize = 1)
+    gate = hold(scheduler)
+    scheduler.submit(recorder.command, 'a', 'a', priority = PRIORITY_INTERACTIVE)
+    assert not scheduler.submit(recorder.command, 'b', 'b', priority = PRIORITY_BACKGROUND, overflow = OVERFLOW_DROP_OLDEST)
+    gate.release.set()
+    scheduler.terminate()
+    
+def test_overflow_coalesce_replaces_newest(recorder):
+    scheduler = start(recorder, maxsize = 2)
+    gate = hold(scheduler)
+    scheduler.submit(recorder.command, 'a', 'a', priority = PRIORITY_TRACKING)
+    scheduler.submit(recorder.command, 'b', 'b', priority = PRIORITY_TRACKING)
+    assert scheduler.submit(recorder.command, 'c', 'c', priority = PRIORITY_TRACKING, overflow = OVERFLOW_COALESCE)
+    gate.release.set()
+    scheduler.submit(recorder.command, 'last', 'last', priority = PRIORITY_BACKGROUND, deadline = None, preemptible = False, overflow = OVERFLOW_BLOCK, timeout = 5)
+    assert recorder.done.wait(5)
+    scheduler.terminate()
+    assert recorder.executed == ['a', 'c', 'last']
+    
+def test_overflow_block_times_out(recorder):
+    scheduler = start(recorder, maxsize = 1)
+    gate = hold(scheduler)
+    scheduler.submit(recorder.command, 'a', 'a')
+    started = time.monotonic()
+    assert not scheduler.submit(recorder.command, 'b', 'b', overflow = OVERFLOW_BLOCK, timeout = 0.1)
+    assert time.monotonic() - started >= 0.1
+    gate.release.set()
+    scheduler.terminate()
+    
+def test_stop_interrupts_and_cancels_preemptible_work(recorder):
+    scheduler = start(recorder)
+    gate = hold(scheduler)
+    scheduler.submit(recorder.command, 'move', 'move')
+    scheduler.submit(recorder.command, 'config', 'config', preemptible = False)
+    scheduler.submit(recorder.stop, 'stop', None, priority = PRIORITY_STOP)
+    # Sent at once as the gate is executing
+    assert recorder.executed == ['stop']
+    finish(scheduler, recorder, gate)
+    assert recorder.executed == ['stop', 'config', 'last']
+    stats = scheduler.stats()
+    assert stats['cancelled'] == 1
+    assert stats['stoplatency']['count'] == 1
+    
+def test_stop_when_idle_runs_next(recorder):
+    scheduler = start(recorder)
+    scheduler.submit(recorder.command, 'stop', 'stop', priority = PRIORITY_STOP)
+    scheduler.submit(recorder.command, 'last', 'last', preemptible = False)
+    assert recorder.done.wait(5)
+    scheduler.terminate()
+    assert recorder.executed == ['stop', 'last']
+    
+def test_deadline_expires_queued_work(recorder):
+    scheduler = start(recorder)
+    gate = hold(scheduler)
+    scheduler.submit(recorder.command, 'late', 'late', priority = PRIORITY_TRACKING, deadline = 0.01)
+    scheduler.submit(recorder.command, 'forever', 'forever', priority = PRIORITY_TRACKING, deadline = None)
+    time.sleep(0.05)
+    finish(scheduler, recorder, gate)
+    assert recorder.executed == ['forever', 'last']
+    assert 'expired:late' in recorder.messages
+    assert scheduler.stats()['expired'] == 1
+    
+def test_latency_buckets_after_timed_commands(recorder):
+    scheduler = start(recorder)
+    for n in range(3):
+        scheduler.submit(lambda args: time.sleep(0.025), 'timed', None)
+    scheduler.submit(recorder.command, 'last', 'last')
+    assert recorder.done.wait(5)
+    scheduler.terminate()
+    stats = scheduler.latencyStats()
+    run = stats['timed']['run']
+    assert run['count'] == 3
+    assert sum(count for bound, count in run['buckets']) == 3
+    # Nothing can complete faster than the sleep
+    assert sum(count for bound, count in run['buckets'] if bound != None and bound < 25) == 0
+    assert run['min'] >= 25
+    # Each waits behind the ones before it
+    wait = stats['timed']['wait']
+    assert wait['count'] == 3
+    assert wait['max'] >= 50
+    assert stats['last']['run']['count'] == 1
+    
+def test_schedulers_share_latencies_but_not_work():
+    shared = latency.CommandLatency()
+    first, second = Recorder(), Recorder()
+    schedulers = []
+    for recorder in (first, second):
+        scheduler = dispatcher.CommandScheduler(recorder.callback, latencies = shared)
+        scheduler.daemon = True
+        scheduler.start()
+        schedulers.append(scheduler)
+    gate = hold(schedulers[0])
+    schedulers[1].submit(second.command, 'station1-move', 'move', priority = PRIORITY_TRACKING)
+    # A stop on one controller leaves the other's work alone
+    schedulers[0].submit(first.stop, 'stop', None, priority = PRIORITY_STOP)
+    schedulers[1].submit(second.command, 'last', 'last', priority = PRIORITY_BACKGROUND)
+    assert second.done.wait(5)
+    assert second.executed == ['move', 'last']
+    assert schedulers[1].stats()['cancelled'] == 0
+    assert schedulers[1].stats()['stoplatency']['count'] == 0
+    finish(schedulers[0], first, gate)
+    schedulers[1].terminate()
+    stats = shared.snapshot()
+    assert stats['station1-move']['run']['count'] == 1
+    assert stats['gate']['run']['count'] == 1
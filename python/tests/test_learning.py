@@ -0,0 +1,114 @@
+#
+# test_learning.py
+#
+# Tests for setpoint learning and warm starts
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+import time
+
+import pytest
+
+from common.defs import *
+from common import learning
+from common.setpoints import SetpointCurve
+
+def test_quality():
+    assert learning.quality(1.0) == 1.0
+    assert learning.quality(LEARN_VSWR_MAX) == 0.0
+    assert learning.quality(LEARN_VSWR_MAX + 1.0) == 0.0
+    assert learning.quality(None) == 0.0
+    assert 0.0 < learning.quality(1.5) < 1.0
+    
+def test_perfect_result_moves_setpoint_by_the_rate():
+    setpoints = {'7.1': 40}
+    assert learning.learn(setpoints, 7.1001, 60, 1.0) == ('7.1', 50)
+    assert setpoints == {'7.1': 50}
+    
+def test_poor_result_moves_setpoint_less():
+    good = {'7.1': 40}
+    poor = {'7.1': 40}
+    learning.learn(good, 7.1, 60, 1.1)
+    learning.learn(poor, 7.1, 60, 1.8)
+    assert 40 < poor['7.1'] < good['7.1']
+    
+def test_repeated_results_converge():
+    setpoints = {'7.1': 40}
+    for n in range(10):
+        learning.learn(setpoints, 7.1, 60, 1.0)
+    assert setpoints['7.1'] == 60
+    
+def test_bad_result_is_ignored():
+    setpoints = {'7.1': 40}
+    assert learning.learn(setpoints, 7.1, 60, LEARN_VSWR_MAX) == None
+    assert learning.learn(setpoints, 7.1, 60, None) == None
+    assert setpoints == {'7.1': 40}
+    
+def test_nearest_setpoint_is_updated():
+    setpoints = {'7.1': 40, '7.105': 50}
+    assert learning.learn(setpoints, 7.104, 52, 1.0) == ('7.105', 51)
+    assert setpoints['7.1'] == 40
+    
+def test_good_result_away_from_setpoints_is_added():
+    setpoints = {'7.1': 40}
+    assert learning.learn(setpoints, 7.2, 35, 1.1) == ('7.2', 35)
+    assert setpoints == {'7.1': 40, '7.2': 35}
+    
+def test_fair_result_away_from_setpoints_is_not_added():
+    setpoints = {'7.1': 40}
+    assert learning.learn(setpoints, 7.2, 35, 1.7) == None
+    assert setpoints == {'7.1': 40}
+    
+def test_warm_start_from_a_recent_tune():
+    cache = learning.TuneCache()
+    cache.add(7100000, 44.6)
+    curve = SetpointCurve({'7.0': 50.0, '7.2': 30.0})
+    assert learning.warmStart(curve, cache, 7100500, 1000) == (45, WARM_WINDOW_CACHED)
+    
+def test_warm_start_from_the_setpoints():
+    cache = learning.TuneCache()
+    cache.add(14000000, 12.0)
+    curve = SetpointCurve({'7.0': 50.0, '7.2': 30.0})
+    assert learning.warmStart(curve, cache, 7100000, 1000) == (40, WARM_WINDOW)
+    
+def test_no_warm_start_without_setpoints():
+    assert learning.warmStart(SetpointCurve({}), learning.TuneCache(), 7100000, 1000) == None
+    
+def test_cache_prefers_the_most_recent():
+    cache = learning.TuneCache()
+    cache.add(7100000, 40.0)
+    cache.add(7100200, 42.0)
+    assert cache.nearest(7100100, 500) == 42.0
+    assert cache.nearest(7200000, 500) == None
+    cache.reset()
+    assert cache.nearest(7100100, 500) == None
+    
+def test_cache_forgets_old_results():
+    cache = learning.TuneCache(age = 0)
+    cache.add(7100000, 40.0)
+    time.sleep(0.01)
+    assert cache.nearest(7100000, 500) == None
+    
+def test_cache_size():
+    cache = learning.TuneCache(size = 2)
+    for n in range(3):
+        cache.add(7000000 + n*10000, float(n))
+    assert cache.nearest(7000000, 500) == None
+    assert cache.nearest(7020000, 500) == 2.0
@@ -0,0 +1,106 @@
+#
+# test_link.py
+#
+# Tests for sending configuration over the controller link
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+from common.defs import *
+from controller.hw_interface import link
+
+class Scheduler:
+    """ Records submissions """
+    
+    def __init__(self):
+        self.submitted = []
+        
+    def submit(self, callable, name, args, **kwargs):
+        self.submitted.append((callable, name, args, kwargs.get('coalesce')))
+        return True
+        
+class Link:
+    """ A link with the given capabilities """
+    
+    def __init__(self, pipelined, batched):
+        self.pipelined = pipelined
+        self.batched = batched
+        
+    def isPipelined(self):
+        return self.pipelined
+        
+    def isBatched(self):
+        return self.batched
+        
+    def execute(self, commands):
+        pass
+        
+    def executeBatch(self, commands):
+        pass
+        
+class API:
+    
+    def speed(self, args):
+        pass
+        
+    def setRelay(self, args):
+        pass
+        
+    def ping(self, args):
+        pass
+        
+COMMANDS = [('speed', 100), ('setRelay', (1, 1)), ('setRelay', (2, 0))]
+
+def test_batched_set_is_one_datagram():
+    scheduler = Scheduler()
+    controller = Link(True, True)
+    link.configure(scheduler, controller, API(), 'startup', COMMANDS)
+    assert scheduler.submitted == [(controller.executeBatch, 'startup', ['100s', '1e', '2d'], 'startup')]
+    
+def test_set_too_long_for_a_batch_is_pipelined():
+    scheduler = Scheduler()
+    controller = Link(True, True)
+    commands = [('speed', 100)]*10
+    link.configure(scheduler, controller, API(), 'startup', commands)
+    assert scheduler.submitted == [(controller.execute, 'startup', ['100s']*10, 'startup')]
+    
+def test_unpipelined_set_goes_through_the_api():
+    scheduler = Scheduler()
+    api = API()
+    link.configure(scheduler, Link(False, False), api, 'startup', COMMANDS + [('ping', ())])
+    assert scheduler.submitted == [
+        (api.speed, 'speed', 100, 'speed'),
+        (api.setRelay, 'setRelay', (1, 1), 'relay1'),
+        (api.setRelay, 'setRelay', (2, 0), 'relay2'),
+        (api.ping, 'ping', (), None),
+    ]
+    
+def test_scope_keeps_stations_apart():
+    scheduler = Scheduler()
+    api = API()
+    link.configure(scheduler, Link(False, False), api, 'relays', COMMANDS[1:], 'station1-')
+    assert [(name, key) for _, name, _, key in scheduler.submitted] == [('station1-setRelay', 'station1-relay1'), ('station1-setRelay', 'station1-relay2')]
+    controller = Link(True, True)
+    link.configure(scheduler, controller, api, 'relays', COMMANDS[1:], 'station1-')
+    assert scheduler.submitted[-1] == (controller.executeBatch, 'station1-relays', ['1e', '2d'], 'station1-relays')
+    
+def test_empty_set_sends_nothing():
+    scheduler = Scheduler()
+    link.configure(scheduler, Link(True, True), API(), 'telemetry', [])
+    assert scheduler.submitted == []
@@ -0,0 +1,201 @@
+#
+# test_protocol.py
+#
+# Tests for the command encoding
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+import struct
+
+import pytest
+
+from common.defs import *
+from controller.hw_interface import protocol
+
+# A loop with every limit set to its widest value
+WORST_LOOP = [[1023, 1023], [], [], {}, [400, 400, 400, 400], [1023, 1023]]
+
+def test_startup_set_is_one_datagram():
+    commands = protocol.startupCommands(EXTERNAL, WORST_LOOP, MAX_SPEED)
+    encoded = [protocol.encode(method, args) for method, args in commands]
+    assert len(encoded) == 6
+    assert protocol.fitsBatch(encoded)
+    assert protocol.batch(encoded).split(protocol.BATCH_SEPARATOR) == encoded
+    
+def test_startup_set_skips_unset_limits():
+    loop = [[None, None], [], [], {}, [50, 100, 200, 5], [None, None]]
+    assert protocol.startupCommands(INTERNAL, loop) == [('setAnalogRef', INTERNAL)]
+    
+def test_telemetry_set_is_one_datagram():
+    encoded = []
+    for channel in (protocol.TELEMETRY_TX, protocol.TELEMETRY_VSWR, protocol.TELEMETRY_POT):
+        encoded.append(protocol.encode('setTelemetryIdle', (channel, 65535)))
+        encoded.append(protocol.encode('setTelemetryBusy', (channel, 65535)))
+    assert protocol.fitsBatch(encoded)
+    
+def test_batch_refuses_too_many_commands():
+    encoded = ['ping'] * (protocol.MAX_BATCH_COMMANDS + 1)
+    assert not protocol.fitsBatch(encoded)
+    with pytest.raises(ValueError):
+        protocol.batch(encoded)
+        
+def test_batch_refuses_too_long():
+    encoded = ['x' * (protocol.MAX_BATCH_LENGTH // 2)] * 3
+    assert not protocol.fitsBatch(encoded)
+    with pytest.raises(ValueError):
+        protocol.batch(encoded)
+        
+def test_batch_refuses_empty():
+    with pytest.raises(ValueError):
+        protocol.batch([])
+        
+def test_batch_of_one_is_the_command():
+    assert protocol.batch(['ping']) == 'ping'
+    
+def test_encode():
+    assert protocol.encode('setAnalogRef', INTERNAL) == 'refdefault'
+    assert protocol.encode('speed', 200.7) == '200s'
+    assert protocol.encode('move', (55, True)) == '55m'
+    assert protocol.encode('move', (700, False)) == '700n'
+    assert protocol.encode('setRelay', (2, True)) == '2e'
+    assert protocol.encode('setRelay', (2, False)) == '2d'
+    
+def test_coalesce_keys():
+    assert protocol.coalesceKey('speed', 100) == 'speed'
+    assert protocol.coalesceKey('setRelay', (3, True)) == 'relay3'
+    assert protocol.coalesceKey('setRelay', (3, True)) != protocol.coalesceKey('setRelay', (4, True))
+    assert protocol.coalesceKey('stop', None) == None
+    # Tracking moves are scoped apart from user moves
+    assert protocol.coalesceKey('trackFreq', 7100000) == 'track-freq'
+    assert protocol.coalesceKey('move', (50, True)) == 'move'
+    assert protocol.coalesceKey('tune', None) == None
+    
+def test_tag_round_trip():
+    tagged = protocol.tag(42, '55m')
+    assert tagged == '#42:55m'
+    assert protocol.untag('#42:success') == (42, 'success')
+    
+def test_untag_leaves_untagged_replies():
+    assert protocol.untag('success') == (None, 'success')
+    assert protocol.untag('#x:success') == (None, '#x:success')
+    assert protocol.untag('#42') == (None, '#42')
+    
+def test_untag_keeps_colons_in_the_reply():
+    assert protocol.untag('#7:success:120:3') == (7, 'success:120:3')
+    
+def test_unbatch():
+    assert protocol.unbatch('batch:success;failure:Bad', 2) == ['success', 'failure:Bad']
+    assert protocol.unbatch('success', 1) == ['success']
+    # A reply which does not match the batch fails every command
+    assert protocol.unbatch('failure:Invalid command', 3) == ['failure:Invalid command'] * 3
+    assert protocol.unbatch('batch:success', 2) == ['batch:success'] * 2
+    
+def test_window_refused():
+    assert protocol.windowRefused('failure:Invalid window')
+    # Older firmware, a lost reply or a busy controller say nothing about warm tune
+    assert not protocol.windowRefused(protocol.INVALID_COMMAND)
+    assert not protocol.windowRefused('failure:Timeout')
+    assert not protocol.windowRefused('failure:Link closed')
+    assert not protocol.windowRefused('failure:Busy')
+    
+def frame(version, event, layout, *values):
+    """ A frame as the sketch sends it """
+    
+    return struct.pack('<BBB', protocol.FRAME_MAGIC, version, event) + struct.pack(layout, *values)
+    
+def test_framing_reply():
+    assert protocol.framing('framing:2') == 2
+    assert protocol.framing('framing:') == None
+    assert protocol.framing(protocol.INVALID_COMMAND) == None
+    
+def test_is_frame():
+    assert protocol.isFrame(frame(1, protocol.EVENT_TX, '<B', 1))
+    assert not protocol.isFrame(b'vswr:1.0:0.1')
+    assert not protocol.isFrame(b'')
+    
+def test_decode_each_event():
+    for version in (1, 2):
+        assert protocol.decodeFrame(frame(version, protocol.EVENT_PROGRESS, '<h', 75)) == (protocol.EVENT_PROGRESS, (75,))
+        assert protocol.decodeFrame(frame(version, protocol.EVENT_VSWR, '<ff', 1.5, 0.25)) == (protocol.EVENT_VSWR, (1.5, 0.25))
+        assert protocol.decodeFrame(frame(version, protocol.EVENT_POT, '<hf', 512, 50.0)) == (protocol.EVENT_POT, (512, 50.0))
+        assert protocol.decodeFrame(frame(version, protocol.EVENT_TX, '<B', 1)) == (protocol.EVENT_TX, (1,))
+        assert protocol.decodeFrame(frame(version, protocol.EVENT_NOISE, '<fff', 0.5, 1.0, 2.0)) == (protocol.EVENT_NOISE, (0.5, 1.0, 2.0))
+        assert protocol.decodeFrame(frame(version, protocol.EVENT_AUTOTUNE, '<IIh', 70000, 1200, 3)) == (protocol.EVENT_AUTOTUNE, (70000, 1200, 3))
+        assert protocol.decodeFrame(frame(version, protocol.EVENT_ALARM, '<B', protocol.ALARM_AUTOTUNE)) == (protocol.EVENT_ALARM, (protocol.ALARM_AUTOTUNE,))
+        
+def test_decode_refuses_bad_frames():
+    good = frame(1, protocol.EVENT_VSWR, '<ff', 1.5, 0.25)
+    # Truncated, padded, wrong magic, unknown version and unknown event
+    assert protocol.decodeFrame(good[:-1]) == None
+    assert protocol.decodeFrame(good + b'\x00') == None
+    assert protocol.decodeFrame(b'\x00' + good[1:]) == None
+    assert protocol.decodeFrame(frame(protocol.FRAME_VERSION + 1, protocol.EVENT_TX, '<B', 1)) == None
+    assert protocol.decodeFrame(frame(1, 99, '<B', 1)) == None
+    assert protocol.decodeFrame(good[:2]) == None
+    
+def test_telemetry_needs_telemetry_framing():
+    assert protocol.decodeFrame(frame(1, protocol.EVENT_TELEMETRY, '<HIB', 1, 1000, 0)) == None
+    
+def telemetry(sequence, ms, channels):
+    """ A telemetry frame as the sketch sends it, channels is {channel: (layout, values)} """
+    
+    mask = 0
+    values = b''
+    for channel in sorted(channels):
+        mask |= 1 << channel
+        layout, fields = channels[channel]
+        values += struct.pack(layout, *fields)
+    return frame(protocol.FRAME_TELEMETRY, protocol.EVENT_TELEMETRY, '<HIB', sequence, ms, mask) + values
+    
+def test_decode_telemetry():
+    data = telemetry(7, 123456, {protocol.TELEMETRY_TX: ('<B', (0,)), protocol.TELEMETRY_VSWR: ('<ff', (1.5, 0.25)), protocol.TELEMETRY_POT: ('<hf', (300, 29.5))})
+    assert protocol.decodeFrame(data) == (protocol.EVENT_TELEMETRY, (7, 123456, {
+        protocol.TELEMETRY_TX: (0,),
+        protocol.TELEMETRY_VSWR: (1.5, 0.25),
+        protocol.TELEMETRY_POT: (300, 29.5),
+    }))
+    
+def test_decode_telemetry_subset():
+    data = telemetry(8, 5, {protocol.TELEMETRY_POT: ('<hf', (1023, 100.0))})
+    assert protocol.decodeFrame(data) == (protocol.EVENT_TELEMETRY, (8, 5, {protocol.TELEMETRY_POT: (1023, 100.0)}))
+    
+def test_decode_telemetry_refuses_length_mismatch():
+    data = telemetry(9, 5, {protocol.TELEMETRY_VSWR: ('<ff', (1.0, 0.0))})
+    assert protocol.decodeFrame(data[:-1]) == None
+    assert protocol.decodeFrame(data + b'\x00') == None
+    
+def test_stale_telemetry():
+    assert not protocol.isStale(0, None)
+    assert not protocol.isStale(11, 10)
+    # Repeated and overtaken frames
+    assert protocol.isStale(10, 10)
+    assert protocol.isStale(5, 10)
+    # Across the wrap
+    assert not protocol.isStale(2, 0xFFFE)
+    assert protocol.isStale(0xFFFE, 2)
+    # Far behind is a restart of the sketch, not a late frame
+    assert not protocol.isStale(0, 1000)
+    
+def test_relay_commands():
+    assert protocol.relayCommands([1, 0, 1], True) == [('setRelays', [1, 0, 1])]
+    assert protocol.relayCommands([True, False], False) == [('setRelay', (1, 1)), ('setRelay', (2, 0))]
+    # No relays or more than the controller can switch
+    assert protocol.relayCommands([], True) == []
+    assert protocol.relayCommands([1]*(protocol.MAX_RELAYS + 1), True) == []
@@ -0,0 +1,90 @@
+#
+# test_replay.py
+#
+# Tests for replaying a recorded trace through tracking
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+import copy
+import time
+
+import pytest
+
+from common.defs import *
+from common import trace
+import replay
+
+# A 40m loop, extension falls 10% per 100kHz
+LOOP = [[0, 1023], [6.9, 7.4], [], {'7.0': 60, '7.1': 50, '7.2': 40, '7.3': 30}, [50, 100, 200, 5], [None, None]]
+
+@pytest.fixture
+def settings():
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    settings[LOOP_SETTINGS]['40m'] = copy.deepcopy(LOOP)
+    return settings
+
+@pytest.fixture
+def recorded(tmp_path):
+    """ A trace of a VFO parked on three frequencies then nudged within the dead-band """
+    
+    path = str(tmp_path / 'session.trace')
+    writer = trace.TraceWriter(path, '40m')
+    t = 1000.0
+    for freq in [7000000]*20 + [7100000]*20 + [7250000]*20 + [7250100]*10:
+        writer.write(t, freq)
+        t += 0.5
+    assert writer.count() == 70
+    writer.close()
+    return path
+
+def test_trace_round_trip(recorded):
+    loopname, samples = trace.readTrace(recorded)
+    assert loopname == '40m'
+    assert len(samples) == 70
+    assert samples[0] == (0.0, 7000000)
+    assert samples[-1] == (34.5, 7250100)
+    
+def test_replay_polled(recorded, settings):
+    loopname, samples = trace.readTrace(recorded)
+    started = time.monotonic()
+    r = replay.replay(samples, settings, loopname)
+    # The virtual clock runs the whole trace without waiting
+    assert time.monotonic() - started < r['duration']
+    assert r['duration'] == 34.5
+    # One move per frequency, the last nudge is inside the dead-band
+    assert r['moves'] == 3
+    assert r['travel'] == pytest.approx(25.0)
+    assert r['pushes'] == 0
+    assert r['polls'] > 0
+    assert r['lag']['count'] > 0
+    assert r['errors'] == 0
+    
+def test_replay_transceive(recorded, settings):
+    loopname, samples = trace.readTrace(recorded)
+    r = replay.replay(samples, settings, loopname, variant = IC7100)
+    # Each frequency change is pushed once
+    assert r['pushes'] == 4
+    assert r['moves'] == 3
+    assert r['travel'] == pytest.approx(25.0)
+    assert r['polls'] < replay.replay(samples, settings, loopname)['polls']
+    
+def test_replay_is_repeatable(recorded, settings):
+    loopname, samples = trace.readTrace(recorded)
+    assert replay.replay(samples, settings, loopname) == replay.replay(samples, settings, loopname)
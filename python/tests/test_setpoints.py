@@ -0,0 +1,76 @@
+#
+# test_setpoints.py
+#
+# Tests for the setpoint curve
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+import pytest
+
+from common.defs import *
+from common.setpoints import SetpointCurve
+
+# Extension falls as frequency rises with a steep section, as a real loop
+LOOP = {'3.5': 90.0, '3.8': 80.0, '5.3': 60.0, '7.0': 45.0, '7.2': 44.5, '10.1': 30.0, '14.0': 12.0}
+
+def sweep(curve, low, high, steps = 2000):
+    return [curve.extension(low + (high - low)*k/steps) for k in range(steps + 1)]
+
+def test_hits_each_setpoint():
+    for mode in (INTERP_LINEAR, INTERP_PCHIP):
+        curve = SetpointCurve(LOOP, mode)
+        for freq, extension in LOOP.items():
+            assert curve.extension(float(freq)*1000.0) == pytest.approx(extension)
+            
+def test_pchip_is_monotone():
+    values = sweep(SetpointCurve(LOOP, INTERP_PCHIP), 3500.0, 14000.0)
+    assert all(later <= earlier + 1e-9 for earlier, later in zip(values, values[1:]))
+    
+def test_pchip_never_overshoots_the_setpoints_either_side():
+    curve = SetpointCurve(LOOP, INTERP_PCHIP)
+    freqs = sorted(float(freq)*1000.0 for freq in LOOP)
+    for lower, upper in zip(freqs, freqs[1:]):
+        low = min(curve.extension(lower), curve.extension(upper))
+        high = max(curve.extension(lower), curve.extension(upper))
+        for value in sweep(curve, lower, upper, 200):
+            assert low - 1e-9 <= value <= high + 1e-9
+            
+def test_pchip_is_flat_across_a_plateau():
+    curve = SetpointCurve({'3.5': 80.0, '5.0': 50.0, '6.0': 50.0, '7.0': 40.0}, INTERP_PCHIP)
+    for value in sweep(curve, 5000.0, 6000.0, 100):
+        assert value == pytest.approx(50.0)
+        
+def test_linear_between_setpoints():
+    curve = SetpointCurve({'7.0': 40.0, '7.2': 30.0})
+    assert curve.extension(7100.0) == pytest.approx(35.0)
+    
+def test_nearest_setpoint_outside_the_range():
+    curve = SetpointCurve(LOOP, INTERP_PCHIP)
+    assert curve.extension(1800.0) == 90.0
+    assert curve.extension(28000.0) == 12.0
+    
+def test_no_setpoints():
+    curve = SetpointCurve({})
+    assert len(curve) == 0
+    assert curve.extension(7000.0) == None
+    
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        SetpointCurve(LOOP, 'spline')
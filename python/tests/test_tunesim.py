@@ -0,0 +1,74 @@
+#
+# test_tunesim.py
+#
+# Tests for the model of the tune search
+#
+# Copyright (C) 2016 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+import random
+
+import pytest
+
+from controller.hw_interface import tunesim
+
+# Mismatched at resonance so the sweep never reads zero and the search has to refine
+MINIMUM = 1.3
+
+@pytest.mark.parametrize('resonance', [25.0, 50.0, 75.0])
+@pytest.mark.parametrize('position', [20.0, 50.0, 80.0])
+@pytest.mark.parametrize('noise', [0, 2])
+def test_search_finds_the_minimum(resonance, position, noise):
+    loop = tunesim.Loop(resonance, minimum = MINIMUM, noise = noise, rng = random.Random(1))
+    controller = tunesim.Controller(loop, position)
+    assert controller.tune()
+    assert controller.position == pytest.approx(resonance, abs = 0.5)
+    assert controller.vswr() < MINIMUM + 0.05
+    # The bracket probes and the final move to the better of the last two
+    assert 2 <= controller.probes <= tunesim.REFINE_MOVES + 1
+    
+def test_search_settles_before_each_probe():
+    loop = tunesim.Loop(50.0, minimum = MINIMUM)
+    controller = tunesim.Controller(loop, 20.0)
+    controller.tune()
+    # Each probe and the stop at the end of the sweep settle for MOTOR_DELAY
+    assert controller.elapsed >= (controller.probes + 1)*tunesim.MOTOR_DELAY
+    
+def test_search_is_faster_than_the_nudge_loop_from_far_away():
+    for resonance, position in [(25.0, 80.0), (75.0, 20.0), (50.0, 50.0)]:
+        current = tunesim.Controller(tunesim.Loop(resonance, minimum = MINIMUM), position)
+        legacy = tunesim.Controller(tunesim.Loop(resonance, minimum = MINIMUM), position, legacy = True)
+        assert current.tune() and legacy.tune()
+        assert current.elapsed < legacy.elapsed
+        
+def test_no_match_outside_the_span():
+    controller = tunesim.Controller(tunesim.Loop(95.0), 50.0)
+    assert not controller.tune()
+    
+def test_warm_start_finds_it_in_the_window():
+    controller = tunesim.Controller(tunesim.Loop(50.0, minimum = MINIMUM), 45.0)
+    matched, inWindow = controller.warmTune(50, 3)
+    assert matched and inWindow
+    assert controller.position == pytest.approx(50.0, abs = 0.5)
+    
+def test_warm_start_falls_back_to_the_full_span():
+    controller = tunesim.Controller(tunesim.Loop(30.0, minimum = MINIMUM), 60.0)
+    matched, inWindow = controller.warmTune(60, 3)
+    assert matched and not inWindow
+    assert controller.position == pytest.approx(30.0, abs = 0.5)